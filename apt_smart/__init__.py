@@ -15,11 +15,11 @@ an example that uses the :class:`AptMirrorUpdater` class.
 
 # Standard library modules.
 import fnmatch
+import json
 import logging
 import os
 import sys
 import time
-import calendar
 
 # Python 2.x / 3.x compatibility.
 try:
@@ -30,7 +30,7 @@ except ImportError:
 # External dependencies.
 from capturer import CaptureOutput
 from executor.contexts import ChangeRootContext, LocalContext
-from humanfriendly import AutomaticSpinner, Timer, compact, format_timespan, pluralize
+from humanfriendly import AutomaticSpinner, Timer, compact, format_size, format_timespan, pluralize
 try:
     from property_manager3 import (
         PropertyManager,
@@ -53,7 +53,28 @@ from six import text_type
 from six.moves.urllib.parse import urlparse
 
 # Modules included in our package.
-from apt_smart.http import NotFoundError, fetch_concurrent, fetch_url, get_default_concurrency
+from apt_smart.cache import RANKING_TTL, HttpCache, RankingCache, get_cache_directory
+from apt_smart.daemon import DaemonClient
+from apt_smart.health import CircuitBreaker, MirrorHistory
+from apt_smart.http import (
+    BANDWIDTH_PROBE_SIZE,
+    DEFAULT_ENGINE,
+    MAX_PROBE_SIZE,
+    ConnectionPool,
+    NotFoundError,
+    TrafficShaper,
+    bandwidth_worker,
+    digest_worker,
+    fetch_concurrent,
+    fetch_url,
+    iter_concurrent,
+    get_default_concurrency,
+    looks_like_release_file,
+    parse_release_date,
+    percentile,
+    pipeline_worker,
+)
+from apt_smart.location import LocationResolver
 from apt_smart.releases import coerce_release
 from apt_smart.releases import discover_releases
 
@@ -72,6 +93,47 @@ URL_CHAR_LEN = 34
 LAST_UPDATED_DEFAULT = 60 * 60 * 24 * 7 * 4
 """A default, pessimistic :attr:`~CandidateMirror.last_updated` value (a number)."""
 
+MAX_CONNECTIONS_PER_HOST = 2
+"""The default value of :attr:`AptMirrorUpdater.max_connections_per_host` (an integer)."""
+
+BANDWIDTH_PROBE_CONCURRENCY = 4
+"""
+The maximum number of simultaneous bandwidth probes (an integer).
+
+Bandwidth probes share the local network link, so running many of them at
+the same time would mostly measure how the link is divided between them.
+"""
+
+SAMPLE_INTERVAL = 1
+"""The minimum number of seconds between the samples of a mirror (see :attr:`AptMirrorUpdater.samples`)."""
+
+TOURNAMENT_FINALISTS = 4
+"""The number of mirrors that reach the last round of :attr:`AptMirrorUpdater.tournament` (an integer)."""
+
+TOURNAMENT_PROBE_SIZE = 1024 * 128
+"""The number of bytes downloaded in the second round of :attr:`AptMirrorUpdater.tournament` (an integer)."""
+
+RANKING_CACHE_FIELDS = (
+    'mirror_url',
+    'is_available',
+    'is_updating',
+    'last_updated',
+    'bandwidth',
+    'release_date',
+    'release_gpg_latency',
+    'dns_time',
+    'connect_time',
+    'tls_time',
+    'first_byte_time',
+    'transfer_time',
+    'tournament_round',
+    'latency_samples',
+    'bandwidth_samples',
+    'index_count',
+    'index_size',
+)
+"""The :class:`CandidateMirror` properties stored in :attr:`AptMirrorUpdater.ranking_cache` (a tuple of strings)."""
+
 # Initialize a logger for this module.
 logger = logging.getLogger(__name__)
 
@@ -81,10 +143,12 @@ class AptMirrorUpdater(PropertyManager):
     """Python API for the `apt-smart` program."""
 
     repr_properties = (
+        'adaptive_concurrency',
         'architecture',
         'backend',
         'blacklist',
         'concurrency',
+        'concurrency_engine',
         'context',
         'distribution_codename',
         'distributor_id',
@@ -109,6 +173,18 @@ class AptMirrorUpdater(PropertyManager):
     .. _infinite recursion: https://travis-ci.org/xolox/python-apt-mirror-updater/jobs/395421319
     """
 
+    @mutable_property
+    def adaptive_concurrency(self):
+        """
+        Whether to adjust the concurrency while ranking mirrors (a boolean, defaults to :data:`False`).
+
+        When this is :data:`True` the value of :attr:`concurrency` is only the
+        initial number of simultaneous requests, it is raised or lowered
+        based on the observed throughput and timeout rate (refer to
+        :class:`.AdaptiveConcurrency` for details).
+        """
+        return False
+
     @mutable_property
     def architecture(self):
         """
@@ -150,7 +226,7 @@ class AptMirrorUpdater(PropertyManager):
                 base_url_prefix = self.backend.BASE_URL.split('/dists/codename/Release')[0]
                 mirrors.add(CandidateMirror(mirror_url=base_url_prefix, updater=self))
             logger.info(base_url_prefix)
-            for candidate in self.backend.discover_mirrors():
+            for candidate in self.backend.discover_mirrors(updater=self):
                 if any(fnmatch.fnmatch(candidate.mirror_url, pattern) for pattern in self.blacklist)\
                         and normalize_mirror_url(candidate.mirror_url) != base_url_prefix:
                     logger.warning("Ignoring blacklisted mirror %s.", candidate.mirror_url)
@@ -191,6 +267,22 @@ class AptMirrorUpdater(PropertyManager):
         else:
             return sys.modules[module_path]
 
+    @mutable_property
+    def bandwidth_probe(self):
+        """
+        Whether to measure bandwidth using a byte range of a large index file (a boolean).
+
+        By default :attr:`CandidateMirror.bandwidth` is computed from the
+        download of a small ``Release`` file, which mostly measures latency
+        (the connection never leaves TCP slow start). When this property is
+        :data:`True` (it defaults to :data:`False`) the available mirrors are
+        additionally probed by downloading the first
+        :data:`.BANDWIDTH_PROBE_SIZE` bytes of
+        :attr:`CandidateMirror.bandwidth_probe_url` using
+        :func:`.probe_bandwidth()`.
+        """
+        return False
+
     @cached_property
     def best_mirror(self):
         """
@@ -217,16 +309,59 @@ class AptMirrorUpdater(PropertyManager):
         """
         return set()
 
+    @mutable_property
+    def cache_directory(self):
+        """
+        The pathname of the directory where on-disk caches are stored (a string).
+
+        The value of this property defaults to the value computed by
+        :func:`.get_cache_directory()`.
+        """
+        return get_cache_directory()
+
+    @cached_property
+    def circuit_breaker(self):
+        """
+        The circuit breaker that skips mirror hosts which keep failing (a :class:`.CircuitBreaker` object).
+
+        Its state is stored in the file ``circuit-breaker.json`` in
+        :attr:`cache_directory` so that chronically dead mirrors stop costing
+        a timeout on every run. When :attr:`use_cache` is :data:`False` the
+        state is only kept in memory.
+        """
+        return CircuitBreaker(os.path.join(self.cache_directory, 'circuit-breaker.json') if self.use_cache else None)
+
     @mutable_property
     def concurrency(self):
         """
         The number of concurrent HTTP connections allowed while ranking mirrors (a number).
 
         The value of this property defaults to the value computed by
-        :func:`.get_default_concurrency()`.
+        :func:`.get_default_concurrency()`. When :attr:`adaptive_concurrency`
+        is enabled this is the initial concurrency.
         """
         return get_default_concurrency()
 
+    @mutable_property
+    def concurrency_engine(self):
+        """
+        The engine used to rank mirrors concurrently (a string, defaults to :data:`.DEFAULT_ENGINE`).
+
+        Refer to :func:`.fetch_concurrent()` for the supported values.
+        """
+        return DEFAULT_ENGINE
+
+    @cached_property
+    def connection_pool(self):
+        """
+        The keep-alive connections used to rank and validate mirrors (a :class:`.ConnectionPool` object).
+
+        Because the connection pool is shared between :attr:`ranked_mirrors`
+        and :func:`validate_mirror()`, later requests to the same mirror can
+        skip the TCP and TLS handshakes.
+        """
+        return ConnectionPool(shaper=self.traffic_shaper)
+
     @mutable_property(cached=True)
     def context(self):
         """
@@ -237,6 +372,17 @@ class AptMirrorUpdater(PropertyManager):
         """
         return LocalContext()
 
+    @mutable_property
+    def country(self):
+        """
+        The country whose mirrors are preferred (a string like 'Germany' or :data:`None`).
+
+        When this is set (using the ``--country`` option) the
+        :attr:`location_resolver` isn't used. The value of this property
+        defaults to :data:`None` which means the country is determined
+        automatically (see :attr:`resolved_country`).
+        """
+
     @mutable_property(cached=True)
     def current_mirror(self):
         """
@@ -252,6 +398,17 @@ class AptMirrorUpdater(PropertyManager):
             logger.debug("Parsing %s to find current mirror of %s ..", self.main_sources_list, self.context)
             return find_current_mirror(self.get_sources_list())
 
+    @mutable_property
+    def daemon_socket(self):
+        """
+        The pathname of the UNIX socket of a :class:`.RankingDaemon` (a string or :data:`None`).
+
+        When this is set the ranking of the mirrors is requested from the
+        daemon (which answers in milliseconds) before falling back to
+        :attr:`ranking_cache` or ranking the mirrors. Defaults to
+        :data:`None` (the daemon isn't used).
+        """
+
     @mutable_property
     def distribution_codename_old(self):
         """
@@ -312,6 +469,50 @@ class AptMirrorUpdater(PropertyManager):
         """
         return self.release.distributor_id
 
+    @cached_property
+    def http_cache(self):
+        """
+        The on-disk cache of mirror discovery pages (a :class:`.HttpCache` object or :data:`None`).
+
+        The cached pages are stored in the ``http`` subdirectory of
+        :attr:`cache_directory`. When :attr:`use_cache` is :data:`False`
+        the value of this property is :data:`None`.
+        """
+        if self.use_cache:
+            return HttpCache(os.path.join(self.cache_directory, 'http'))
+
+    @mutable_property
+    def index_files(self):
+        """
+        The index files that ``apt-get update`` downloads for each suite (a list of strings).
+
+        The paths are relative to the ``Release`` file and don't include a
+        compression extension (e.g. ``main/binary-amd64/Packages``). Their
+        sizes are read from the ``Release`` file of each mirror to predict
+        how long an update would take (see
+        :attr:`CandidateMirror.predicted_update_time`). By default the
+        ``Packages`` and English ``Translation`` files of all components of
+        :attr:`backend` for :attr:`architecture` are included.
+        """
+        index_files = []
+        for component in self.backend.VALID_COMPONENTS:
+            index_files.append('%s/binary-%s/Packages' % (component, self.architecture))
+            index_files.append('%s/i18n/Translation-en' % component)
+        return index_files
+
+    @cached_property
+    def location_resolver(self):
+        """
+        The resolver that finds the country of the system (a :class:`.LocationResolver` object).
+
+        The country of each network is cached in the file ``location.json``
+        in :attr:`cache_directory` (unless :attr:`use_cache` is
+        :data:`False`), so the geolocation services are only queried when
+        the time zone and locale don't give an answer and the network hasn't
+        been seen recently.
+        """
+        return LocationResolver(os.path.join(self.cache_directory, 'location.json') if self.use_cache else None)
+
     @cached_property
     def main_sources_list(self):
         """
@@ -327,11 +528,48 @@ class AptMirrorUpdater(PropertyManager):
         else:
             return '/etc/apt/sources.list'
 
+    @mutable_property
+    def keep_release_contents(self):
+        """
+        Whether to keep the ``Release`` files downloaded while ranking mirrors (a boolean, defaults to :data:`False`).
+
+        By default the ``Release`` files are summarized (see
+        :class:`.ProbeDigest`) and discarded as soon as they have been
+        downloaded. Set this to :data:`True` to make them available as
+        :attr:`CandidateMirror.release_gpg_contents`.
+        """
+        return False
+
+    @mutable_property
+    def max_connections_per_host(self):
+        """
+        The maximum number of simultaneous requests to a single host while ranking mirrors (an integer).
+
+        Several candidate URLs can share a host (for example the HTTP and
+        HTTPS variants of a mirror), this limit avoids tripping rate limits
+        of such hosts. It defaults to :data:`MAX_CONNECTIONS_PER_HOST`,
+        :data:`None` disables the limit.
+        """
+        return MAX_CONNECTIONS_PER_HOST
+
     @mutable_property
     def max_mirrors(self):
         """Limits the number of mirrors to rank (a number, defaults to :data:`MAX_MIRRORS`)."""
         return MAX_MIRRORS
 
+    @cached_property
+    def mirror_history(self):
+        """
+        The performance history of the mirrors (a :class:`.MirrorHistory` object).
+
+        The history is stored in the SQLite database ``history.sqlite3`` in
+        :attr:`cache_directory`. Its estimates decide the order in which
+        mirrors are probed and smooth out the noise of a single probe in
+        :attr:`CandidateMirror.sort_key`. When :attr:`use_cache` is
+        :data:`False` the history is only kept in memory.
+        """
+        return MirrorHistory(os.path.join(self.cache_directory, 'history.sqlite3') if self.use_cache else None)
+
     @mutable_property
     def url_char_len(self):
         """
@@ -341,6 +579,15 @@ class AptMirrorUpdater(PropertyManager):
         """
         return URL_CHAR_LEN
 
+    @mutable_property
+    def use_cache(self):
+        """
+        Whether on-disk caches should be used (a boolean, defaults to :data:`True`).
+
+        Can be set to :data:`False` using the ``--no-cache`` option.
+        """
+        return True
+
     @mutable_property
     def ubuntu_mode(self):
         """
@@ -368,6 +615,118 @@ class AptMirrorUpdater(PropertyManager):
         The value of this property is gotten from :attr:`base_url`'s update date as minuend
         """
 
+    @mutable_property
+    def provisional_best_mirror(self):
+        """
+        The best mirror found so far by :func:`iter_ranked_mirrors()` (a :class:`CandidateMirror` or :data:`None`).
+
+        While the mirrors are being tested this property is updated every time
+        an available mirror that is better than the previous one is found.
+        Because the Archive-Update-in-Progress markers are checked after all
+        mirrors have responded this is only a provisional answer, once
+        :attr:`ranked_mirrors` is known use :attr:`best_mirror` instead.
+        """
+
+    @mutable_property
+    def ranking_budget(self):
+        """
+        The maximum number of bytes that ranking mirrors may download (a number or :data:`None`).
+
+        Once the budget is exhausted no new requests are sent and the mirrors
+        that haven't been tested yet are considered unavailable. Defaults to
+        :data:`None` which means no limit.
+        """
+
+    @cached_property
+    def ranking_cache(self):
+        """
+        The on-disk cache of mirror rankings (a :class:`.RankingCache` object or :data:`None`).
+
+        The rankings are stored in the ``rankings`` subdirectory of
+        :attr:`cache_directory`. When :attr:`use_cache` is :data:`False`
+        the value of this property is :data:`None`.
+        """
+        if self.use_cache:
+            return RankingCache(os.path.join(self.cache_directory, 'rankings'))
+
+    @mutable_property
+    def ranking_cache_key(self):
+        """The key of the ranking of :attr:`available_mirrors` in :attr:`ranking_cache` (a string)."""
+        return self.ranking_cache.get_key(**self.ranking_parameters)
+
+    @mutable_property
+    def ranking_cache_ttl(self):
+        """
+        The number of seconds that a cached ranking of the mirrors is used (a number).
+
+        Defaults to :data:`.RANKING_TTL`. Once a cached ranking is older
+        than this the mirrors are ranked again, unless
+        :attr:`stale_while_revalidate` is enabled.
+        """
+        return RANKING_TTL
+
+    @mutable_property
+    def ranking_parameters(self):
+        """
+        The parameters that the ranking of :attr:`available_mirrors` depends on (a dictionary).
+
+        The dictionary contains :attr:`distributor_id`,
+        :attr:`distribution_codename`, :attr:`architecture`,
+        :attr:`blacklist` (as a sorted list), :attr:`custom_mirror_file_path`
+        and :attr:`country` (which decide which mirrors are ranked) and
+        :attr:`scoring_policy` (by name), :attr:`tournament`,
+        :attr:`samples`, :attr:`bandwidth_probe`, :attr:`index_files` and
+        :attr:`ranking_budget` (which decide how the mirrors are ranked).
+        A ranking is only reused (from :attr:`ranking_cache` or the daemon)
+        when the parameters match.
+        """
+        policy = self.scoring_policy
+        return dict(
+            distributor_id=self.distributor_id,
+            distribution_codename=self.distribution_codename,
+            architecture=self.architecture,
+            blacklist=sorted(self.blacklist),
+            custom_mirror_file_path=self.custom_mirror_file_path,
+            country=self.country,
+            scoring_policy='%s.%s' % (getattr(policy, '__module__', None), getattr(policy, '__name__', repr(policy))),
+            tournament=bool(self.tournament),
+            samples=self.samples,
+            bandwidth_probe=bool(self.bandwidth_probe),
+            index_files=sorted(self.index_files),
+            ranking_budget=self.ranking_budget,
+        )
+
+    @mutable_property
+    def ranking_rate_limit(self):
+        """
+        The maximum number of bytes per second downloaded while ranking mirrors (a number or :data:`None`).
+
+        This keeps the burst of probes from competing with real traffic on
+        shared links. Bandwidth probes (see :attr:`bandwidth_probe` and
+        :attr:`tournament`) aren't throttled because that would make all
+        mirrors look equally fast, they do count against
+        :attr:`ranking_budget`. Defaults to :data:`None` which means no limit.
+        """
+
+    @mutable_property
+    def ranking_age(self):
+        """
+        The age in seconds of the ranking used by :func:`iter_ranked_mirrors()` (a number or :data:`None`).
+
+        This is :data:`None` when the mirrors were tested during this run,
+        refer to :attr:`ranking_source` for where a ranking came from.
+        """
+
+    @mutable_property
+    def ranking_source(self):
+        """
+        Where the ranking used by :func:`iter_ranked_mirrors()` came from (a string or :data:`None`).
+
+        This is 'daemon' (see :func:`get_daemon_ranking()`), 'cache' (see
+        :attr:`ranking_cache`) or :data:`None` when the mirrors were tested
+        during this run.
+        """
+
     @cached_property
     def ranked_mirrors(self):
         """
@@ -378,68 +737,80 @@ class AptMirrorUpdater(PropertyManager):
 
         - availability (:attr:`~CandidateMirror.is_available`)
         - connection speed (:attr:`~CandidateMirror.bandwidth`)
+        - the time spent in each phase of the request
+          (:attr:`~CandidateMirror.dns_time`,
+          :attr:`~CandidateMirror.connect_time`,
+          :attr:`~CandidateMirror.tls_time`,
+          :attr:`~CandidateMirror.first_byte_time` and
+          :attr:`~CandidateMirror.transfer_time`)
         - update status (:attr:`~CandidateMirror.is_updating`)
 
+        Before any HTTP requests are made the host names of all mirrors are
+        resolved concurrently (see :class:`~apt_smart.http.Resolver`) and
+        mirrors whose host name doesn't exist are marked as unavailable.
+
         The number of mirrors to test is limited to :attr:`max_mirrors` and you
         can change the number of simultaneous HTTP connections allowed by
-        setting :attr:`concurrency`.
+        setting :attr:`concurrency` (and :attr:`adaptive_concurrency`).
+
+        To process the results while the mirrors are being tested use
+        :func:`iter_ranked_mirrors()` instead (it sets this property when
+        it's done). Rankings are cached in :attr:`ranking_cache` for
+        :attr:`ranking_cache_ttl` seconds.
         """
-        timer = Timer()
-        # Sort the candidates based on the currently available information
-        # (and transform the input argument into a list in the process).
-        mirrors = sorted(self.available_mirrors, key=lambda c: c.sort_key, reverse=True)
-        # Limit the number of candidates to a reasonable number?
-        # NO, we don't need to now since the backends.debian can smartly get mirrors within a country.
-        # Without max_mirrors limit we can fix errors within United States (Travis CI reported) where
-        # where we can get 80+ mirrors. If limit applies, base_url mirror may be deleted, then error occurs.
+        with AutomaticSpinner(label="Checking mirrors"):
+            for candidate in self.iter_ranked_mirrors():
+                pass
+        return self.ranked_mirrors
+
+    @mutable_property
+    def tournament(self):
         """
-        if self.max_mirrors and len(mirrors) > self.max_mirrors:
-            mirrors = mirrors[:self.max_mirrors]
+        Whether to rank the mirrors using successive halving (a boolean, defaults to :data:`False`).
+
+        When this is :data:`True` the mirrors are ranked in three rounds of
+        increasingly expensive probes:
+
+        1. All mirrors are probed by downloading their small ``Release``
+           file (this measures availability, freshness and latency).
+        2. The best half of the available mirrors (but at least
+           :data:`TOURNAMENT_FINALISTS`) download the first
+           :data:`TOURNAMENT_PROBE_SIZE` bytes of
+           :attr:`CandidateMirror.bandwidth_probe_url`.
+        3. The :data:`TOURNAMENT_FINALISTS` mirrors with the highest
+           bandwidth in the second round download the first
+           :data:`.BANDWIDTH_PROBE_SIZE` bytes of the same file.
+
+        Only the mirrors that matter get the expensive probes, so large mirror
+        lists (Launchpad can return well over a hundred mirrors for some
+        countries) can be ranked on sustained throughput without downloading
+        hundreds of large files. This takes precedence over
+        :attr:`bandwidth_probe`.
         """
-        # Prepare the Release.gpg URLs to fetch.
-        mapping = dict((c.release_gpg_url, c) for c in mirrors)
-        num_mirrors = pluralize(len(mapping), "mirror")
-        logger.info("Checking %s for availability and performance ..", num_mirrors)
-        # Concurrently fetch the Release.gpg files.
-        with AutomaticSpinner(label="Checking mirrors"):
-            for url, data, elapsed_time in fetch_concurrent(mapping.keys(), concurrency=self.concurrency):
-                candidate = mapping[url]
-                candidate.release_gpg_contents = data
-                candidate.release_gpg_latency = elapsed_time
+        return False
 
-        logger.info("Start retrieving :attr:`base_last_updated` using is_available")
-        self.base_last_updated = 0
-        if self.release_is_eol:
-            self.base_last_updated = int(time.time())
-            logger.warning("%s is EOL, so using time.time() as :attr:`base_last_updated`: %i",
-                           self.release, self.base_last_updated)
-        elif mapping[self.base_url].is_available:
-            logger.debug(":attr:`base_last_updated`: %i", self.base_last_updated)
-            # base_url 's contents are up-to-date naturally,so set its last_updated 0
-            mapping[self.base_url].last_updated = 0
-        else:  # base_url not available, use time at the moment as base_last_updated.
-            self.base_last_updated = int(time.time())
-            logger.warning("%s is not available, so using time.time() as :attr:`base_last_updated`: %i",
-                           self.base_url, self.base_last_updated)
-        # Concurrently check for Archive-Update-in-Progress markers.
-        update_mapping = dict((c.archive_update_in_progress_url, c) for c in mirrors if c.is_available)
-        logger.info("Checking %s for Archive-Update-in-Progress marker ..",
-                    pluralize(len(update_mapping), "mirror"))
-        with AutomaticSpinner(label="Checking mirrors"):
-            for url, data, elapsed_time in fetch_concurrent(update_mapping.keys(), concurrency=self.concurrency):
-                update_mapping[url].is_updating = data is not None
-        # Sanity check our results.
-        mirrors = list(mapping.values())
-        logger.info("Finished checking %s (took %s).", num_mirrors, timer)
-        if not any(c.is_available for c in mirrors):
-            raise Exception("It looks like all %s are unavailable!" % num_mirrors)
-        if all(c.is_updating for c in mirrors):
-            logger.warning("It looks like all %s are being updated?!", num_mirrors)
-        # blacklist BASE_URL mirror if matches blacklist pattern
-        if any(fnmatch.fnmatch(mapping[self.base_url].mirror_url, pattern) for pattern in self.blacklist):
-            logger.warning("Ignoring blacklisted BASE_URL mirror %s.", mapping[self.base_url].mirror_url)
-            mirrors.remove(mapping[self.base_url])
-        return sorted(mirrors, key=lambda c: c.sort_key, reverse=True)
+    @cached_property
+    def traffic_shaper(self):
+        """
+        The traffic limits applied while ranking mirrors (a :class:`.TrafficShaper` object).
+
+        The limits are based on :attr:`ranking_rate_limit`,
+        :attr:`ranking_budget` and :attr:`max_connections_per_host`, they
+        apply to all requests made using :attr:`connection_pool`.
+        """
+        return TrafficShaper(rate=self.ranking_rate_limit, budget=self.ranking_budget,
+                             per_host=self.max_connections_per_host)
+
+    @cached_property
+    def resolved_country(self):
+        """
+        The country whose mirrors are preferred during discovery (a string or :data:`None`).
+
+        This is :attr:`country` when it's set, otherwise the result of
+        :attr:`location_resolver` (:data:`None` when the country couldn't
+        be determined).
+        """
+        return self.country or self.location_resolver.resolve()
 
     @cached_property
     def release(self):
@@ -509,6 +880,47 @@ class AptMirrorUpdater(PropertyManager):
         )
         return release_is_eol
 
+    @mutable_property
+    def samples(self):
+        """
+        The number of times the ``Release`` file of each mirror is fetched (an integer, defaults to 1).
+
+        A single sample lets a mirror that got lucky once beat a mirror that
+        is consistently fast. When this is larger than one the additional
+        samples are taken in rounds that each cover all available mirrors
+        (so the samples of a mirror are spaced out by at least
+        :data:`SAMPLE_INTERVAL` seconds and interleaved with the samples of
+        the other mirrors) and the mirrors are ranked on the median and
+        tail of their samples (see :attr:`CandidateMirror.bandwidth`).
+        """
+        return 1
+
+    @mutable_property
+    def scoring_policy(self):
+        """
+        The function that ranks the mirrors (a callable, defaults to :func:`rank_by_update_time()`).
+
+        The function is given a :class:`CandidateMirror` object and returns
+        a sort key (see :attr:`CandidateMirror.sort_key`), mirrors with a
+        higher sort key are better. Set this to :func:`rank_by_bandwidth()`
+        to rank the mirrors on bandwidth alone (this is how `apt-smart`
+        used to rank mirrors) or to your own function.
+        """
+        return rank_by_update_time
+
+    @mutable_property
+    def stale_while_revalidate(self):
+        """
+        Whether to use rankings that are older than :attr:`ranking_cache_ttl` (a boolean, defaults to :data:`False`).
+
+        When this is :data:`True` an expired ranking in
+        :attr:`ranking_cache` is used anyway (so the answer is immediate)
+        while the mirrors are ranked again in a detached background process
+        (see :func:`.RankingCache.refresh_in_background()`), so the next
+        run gets a fresh ranking.
+        """
+        return False
+
     @mutable_property
     def security_url(self):
         """The URL of the mirror that serves security updates for this :attr:`backend` (a string)."""
@@ -635,6 +1047,29 @@ class AptMirrorUpdater(PropertyManager):
         )
         logger.info("Successfully cleared package list cache of %s in %s.", self.context, timer)
 
+    def collect_samples(self, candidates):
+        """
+        Fetch the ``Release`` files of the given mirrors until each mirror has :attr:`samples` samples.
+
+        :param candidates: A list of :class:`CandidateMirror` objects.
+
+        The samples are taken in rounds that each fetch the ``Release`` file
+        of every mirror, with at least :data:`SAMPLE_INTERVAL` seconds
+        between consecutive rounds (so a short hiccup of the
+        network or of a mirror affects only one sample of each mirror).
+        """
+        mapping = dict((c.release_gpg_url, c) for c in candidates)
+        timer = Timer()
+        for number in range(2, self.samples + 1):
+            time.sleep(max(0, SAMPLE_INTERVAL - timer.elapsed_time))
+            timer = Timer()
+            logger.info("Taking sample %i of %i of %s ..", number, self.samples, pluralize(len(mapping), "mirror"))
+            for url, digest in iter_concurrent(mapping.keys(), concurrency=self.concurrency,
+                                               engine=self.concurrency_engine, adaptive=self.adaptive_concurrency,
+                                               pool=self.connection_pool, worker=digest_worker,
+                                               validate=looks_like_release_file):
+                mapping[url].add_sample(digest)
+
     def create_chroot(self, directory, codename=None, arch=None):
         """
         Bootstrap a basic Debian or Ubuntu system using debootstrap_.
@@ -831,6 +1266,12 @@ class AptMirrorUpdater(PropertyManager):
         and :attr:`stable_mirror` are cleared. This makes sure that mirrors
         blacklisted after mirror discovery has already run are ignored.
         """
+        # Forget a cached ranking that includes the mirror (it probably
+        # misbehaved, otherwise we wouldn't be ignoring it).
+        if self.ranking_cache:
+            cached = self.ranking_cache.lookup(self.ranking_cache_key)
+            if cached and any(fnmatch.fnmatch(fields['mirror_url'], pattern) for fields in cached[0]):
+                self.ranking_cache.invalidate(self.ranking_cache_key)
         # Update the blacklist.
         logger.info("Adding pattern to mirror discovery blacklist: %s", pattern)
         self.blacklist.add(pattern)
@@ -840,6 +1281,84 @@ class AptMirrorUpdater(PropertyManager):
         del self.ranked_mirrors
         del self.stable_mirror
 
+    def export_mirrors(self, mirrors):
+        """
+        Convert :class:`CandidateMirror` objects to JSON serializable dictionaries.
+
+        :param mirrors: An iterable of :class:`CandidateMirror` objects.
+        :returns: A list of dictionaries with the properties in :data:`RANKING_CACHE_FIELDS`.
+        """
+        return [dict((name, getattr(candidate, name)) for name in RANKING_CACHE_FIELDS) for candidate in mirrors]
+
+    def get_cached_ranking(self):
+        """
+        Get the ranking of :attr:`available_mirrors` from the daemon or :attr:`ranking_cache`.
+
+        :returns: A list of :class:`CandidateMirror` objects (ordered from
+                  best to worst) or :data:`None` when no usable ranking is
+                  cached.
+
+        When :attr:`daemon_socket` is set the daemon is asked first (see
+        :func:`get_daemon_ranking()`). An expired ranking from
+        :attr:`ranking_cache` is only returned when
+        :attr:`stale_while_revalidate` is enabled, in which case a
+        background refresh is started.
+        """
+        if self.daemon_socket:
+            ranking = self.get_daemon_ranking()
+            if ranking is not None:
+                return ranking
+        if not self.ranking_cache:
+            return None
+        key = self.ranking_cache_key
+        cached = self.ranking_cache.lookup(key)
+        if cached is None:
+            return None
+        mirrors, age = cached
+        if age > self.ranking_cache_ttl:
+            if not self.stale_while_revalidate:
+                logger.debug("Cached ranking expired %s ago, ranking mirrors again.",
+                             format_timespan(age - self.ranking_cache_ttl))
+                return None
+            self.ranking_cache.refresh_in_background(key, self.refresh_ranking)
+        logger.info("Using cached ranking of %s (from %s ago).", pluralize(len(mirrors), "mirror"),
+                    format_timespan(age))
+        self.ranking_source = 'cache'
+        self.ranking_age = age
+        return self.import_mirrors(mirrors)
+
+    def get_daemon_ranking(self):
+        """
+        Get the ranking of :attr:`available_mirrors` from the daemon listening on :attr:`daemon_socket`.
+
+        :returns: A list of :class:`CandidateMirror` objects (ordered from
+                  best to worst) or :data:`None` when the daemon can't be
+                  reached, hasn't ranked the mirrors yet or ranked the
+                  mirrors using different :attr:`ranking_parameters`.
+        """
+        try:
+            response = DaemonClient(self.daemon_socket).query('ranked_mirrors')
+        except Exception as e:
+            logger.warning("Failed to get ranking from daemon on %s! (%s)", self.daemon_socket, e)
+            return None
+        if response['parameters'] != json.loads(json.dumps(self.ranking_parameters)):
+            logger.info("Ignoring ranking from daemon because it was made with different parameters.")
+            return None
+        logger.info("Using ranking of %s from daemon (from %s ago).", pluralize(len(response['mirrors']), "mirror"),
+                    format_timespan(response['age']))
+        self.ranking_source = 'daemon'
+        self.ranking_age = response['age']
+        return self.import_mirrors(response['mirrors'])
+
+    def import_mirrors(self, mirrors):
+        """
+        Convert dictionaries created by :func:`export_mirrors()` back to :class:`CandidateMirror` objects.
+
+        :param mirrors: A list of dictionaries.
+        :returns: A list of :class:`CandidateMirror` objects.
+        """
+        return [CandidateMirror(updater=self, **fields) for fields in mirrors]
+
     def install_sources_list(self, contents):
         """
         Install a new ``/etc/apt/sources.list`` file.
@@ -878,6 +1397,296 @@ class AptMirrorUpdater(PropertyManager):
                 sudo=True,
             )
 
+    def iter_ranked_mirrors(self, cached=True):
+        """
+        Test the mirrors in :attr:`available_mirrors`, yielding each mirror as soon as it has been tested.
+
+        :param cached: :data:`True` to use a ranking from :attr:`ranking_cache`
+                       (when available), :data:`False` to always test the
+                       mirrors.
+        :returns: A generator of :class:`CandidateMirror` objects (in the
+                  order in which the mirrors responded).
+        :raises: The same exceptions as :attr:`ranked_mirrors`.
+
+        This performs the same tests as :attr:`ranked_mirrors` but doesn't
+        block until the slowest mirror has responded (or timed out). Each
+        mirror is tested by a single pipeline (see :func:`.pipeline_worker()`)
+        that fetches its ``Release`` file and then immediately checks its
+        Archive-Update-in-Progress marker over the same connection, so the
+        mirror is yielded as soon as it has been tested (when
+        :attr:`~CandidateMirror.is_available`,
+        :attr:`~CandidateMirror.is_updating`,
+        :attr:`~CandidateMirror.last_updated` and the request timings are
+        known) without waiting for slower mirrors. The age of each mirror is
+        resolved as soon as the base mirror has responded and
+        :attr:`provisional_best_mirror` is kept up to date in the mean time.
+        Additional samples (see :attr:`samples`) and the optional bandwidth
+        probes are taken after all mirrors have been yielded, once the
+        generator is exhausted :attr:`ranked_mirrors` is set.
+
+        When a usable ranking is found in :attr:`ranking_cache` its mirrors
+        are yielded (in order of preference) without testing them (see
+        :attr:`ranking_source` and :attr:`ranking_age`).
+        """
+        if cached:
+            ranking = self.get_cached_ranking()
+            if ranking is not None:
+                for candidate in ranking:
+                    self.update_provisional_best_mirror(candidate)
+                    yield candidate
+                set_property(self, 'ranked_mirrors', ranking)
+                return
+        self.ranking_source = None
+        self.ranking_age = None
+        timer = Timer()
+        # Sort the candidates based on the currently available information
+        # (and transform the input argument into a list in the process).
+        mirrors = sorted(self.available_mirrors, key=lambda c: c.sort_key, reverse=True)
+        # Limit the number of candidates to a reasonable number?
+        # NO, we don't need to now since the backends.debian can smartly get mirrors within a country.
+        # Without max_mirrors limit we can fix errors within United States (Travis CI reported) where
+        # where we can get 80+ mirrors. If limit applies, base_url mirror may be deleted, then error occurs.
+        """
+        if self.max_mirrors and len(mirrors) > self.max_mirrors:
+            mirrors = mirrors[:self.max_mirrors]
+        """
+        # Prepare the Release.gpg URLs to fetch.
+        mapping = dict((c.release_gpg_url, c) for c in mirrors)
+        num_mirrors = pluralize(len(mapping), "mirror")
+        # Skip the mirrors that failed repeatedly during previous runs (the
+        # base mirror is always probed because the other mirrors are compared
+        # to it). This happens first so that their host names aren't even
+        # resolved and every host counted below went through allow().
+        hosts = set(urlparse(url).hostname for url in mapping)
+        allowed = dict((host, self.circuit_breaker.allow(host)) for host in hosts)
+        probe_urls = [url for url in mapping if url == self.base_url or allowed[urlparse(url).hostname]]
+        if len(probe_urls) < len(mapping):
+            logger.info("Skipping %s that failed repeatedly (circuit breaker is open).",
+                        pluralize(len(mapping) - len(probe_urls), "mirror"))
+        # Concurrently resolve the host names of the mirrors so that mirrors
+        # whose domain doesn't exist (anymore) are skipped immediately. When
+        # a proxy is used it resolves the host names, so we can't tell.
+        unresolvable = self.connection_pool.resolver.prefetch(
+            urlparse(url).hostname for url in probe_urls if self.connection_pool.supports(url)
+        )
+        num_probes = len(probe_urls)
+        probe_urls = [url for url in probe_urls if urlparse(url).hostname not in unresolvable]
+        if unresolvable:
+            logger.info("Skipping %s whose host name doesn't resolve.",
+                        pluralize(num_probes - len(probe_urls), "mirror"))
+        # Probe the base mirror (which the other mirrors are compared to) and
+        # the mirrors that performed best during previous runs first, so
+        # they are tested early when the concurrency is limited (and before
+        # the traffic budget runs out).
+        for candidate in mirrors:
+            candidate.estimate = self.mirror_history.estimate(candidate.mirror_url)
+        probe_urls.sort(key=lambda url: (url != self.base_url, mapping[url].prior_key))
+        logger.info("Checking %s for availability and performance ..", num_mirrors)
+        logger.info("Limiting ranking traffic to %s.", self.traffic_shaper)
+        self.base_last_updated = 0
+        self.provisional_best_mirror = None
+        if self.release_is_eol:
+            self.base_last_updated = int(time.time())
+            logger.warning("%s is EOL, so using time.time() as :attr:`base_last_updated`: %i",
+                           self.release, self.base_last_updated)
+            base_resolved = True
+        elif self.base_url not in probe_urls:
+            self.resolve_base_last_updated(mapping[self.base_url])
+            base_resolved = True
+        else:
+            base_resolved = False
+        # Concurrently test the mirrors. Each mirror's Archive-Update-in-Progress
+        # marker is checked as soon as its Release file has been fetched. Because
+        # the age of each mirror is relative to the date of the base mirror, the
+        # results are held back until the base mirror has responded.
+        markers = dict((url, mapping[url].archive_update_in_progress_url) for url in probe_urls)
+        finished = []
+        for url, digest, updating in iter_concurrent(probe_urls, concurrency=self.concurrency,
+                                                     engine=self.concurrency_engine,
+                                                     adaptive=self.adaptive_concurrency, pool=self.connection_pool,
+                                                     worker=pipeline_worker, markers=markers,
+                                                     index_files=self.index_files,
+                                                     validate=looks_like_release_file,
+                                                     keep_body=self.keep_release_contents):
+            candidate = mapping[url]
+            candidate.probe_digest = digest
+            candidate.is_updating = bool(updating)
+            if digest is not None:
+                candidate.release_gpg_contents = digest.body
+                candidate.release_gpg_latency = digest.elapsed_time
+                candidate.dns_time = digest.timings.get('dns')
+                candidate.connect_time = digest.timings.get('connect')
+                candidate.tls_time = digest.timings.get('tls')
+                candidate.first_byte_time = digest.timings.get('ttfb')
+                candidate.transfer_time = digest.timings.get('transfer')
+            candidate.add_sample(digest)
+            finished.append(candidate)
+            if url == self.base_url and not base_resolved:
+                self.resolve_base_last_updated(candidate)
+                base_resolved = True
+            if base_resolved:
+                for candidate in finished:
+                    self.update_provisional_best_mirror(candidate)
+                    yield candidate
+                finished = []
+        budget = self.traffic_shaper.budget
+        budget_exhausted = budget is not None and self.traffic_shaper.consumed >= budget
+        if budget_exhausted:
+            logger.warning("Traffic budget exhausted, mirrors that weren't tested are considered unavailable.")
+        # Update the circuit breaker (a host is healthy when any of its URLs
+        # worked). Failures caused by the traffic budget don't count and
+        # neither do failures while the base mirror (or every mirror) failed,
+        # because then our own network is the likely culprit.
+        healthy = dict()
+        for url in probe_urls:
+            host = urlparse(url).hostname
+            healthy[host] = healthy.get(host, False) or mapping[url].is_available
+        for host in unresolvable:
+            healthy[host] = False
+        base_failed = self.base_url in probe_urls and not mapping[self.base_url].is_available
+        network_failed = base_failed or not any(healthy.values())
+        if network_failed:
+            logger.warning("Base mirror (or every mirror) failed, not counting failures against mirrors.")
+        for host, is_healthy in healthy.items():
+            if is_healthy:
+                self.circuit_breaker.record_success(host)
+            elif not (budget_exhausted or network_failed):
+                self.circuit_breaker.record_failure(host)
+        self.circuit_breaker.save()
+        # Mirrors whose host name doesn't resolve were never probed.
+        for url in mapping:
+            if url not in probe_urls:
+                yield mapping[url]
+        if self.samples > 1:
+            self.collect_samples([c for c in mirrors if c.is_available])
+        # The history only records the bandwidth achieved while fetching the
+        # Release files, because the bandwidth probes below (which replace
+        # it depending on the options) measure something else entirely.
+        release_bandwidth = dict((url, candidate.bandwidth) for url, candidate in mapping.items())
+        if self.tournament:
+            self.run_tournament(c for c in mirrors if c.is_available and not c.is_updating)
+        elif self.bandwidth_probe:
+            # Replace the bandwidth estimates based on the small Release files.
+            probe_mapping = dict((c.bandwidth_probe_url, c) for c in mirrors if c.is_available)
+            logger.info("Probing bandwidth of %s ..", pluralize(len(probe_mapping), "mirror"))
+            for url, bandwidth in fetch_concurrent(probe_mapping.keys(),
+                                                   concurrency=min(self.concurrency, BANDWIDTH_PROBE_CONCURRENCY),
+                                                   engine=self.concurrency_engine,
+                                                   pool=self.connection_pool,
+                                                   worker=bandwidth_worker):
+                if bandwidth:
+                    probe_mapping[url].bandwidth = bandwidth
+                else:
+                    logger.debug("Bandwidth probe failed, keeping estimate based on %s.",
+                                 probe_mapping[url].release_gpg_url)
+        # Update the performance history (and the estimates used for ranking).
+        for url, candidate in mapping.items():
+            if urlparse(url).hostname not in unresolvable:
+                if url not in probe_urls:
+                    # Skipped because the circuit breaker is open.
+                    continue
+                if budget_exhausted and candidate.probe_digest is None:
+                    # Not tested because the traffic budget ran out.
+                    continue
+            candidate.estimate = self.mirror_history.record(
+                candidate.mirror_url, candidate.is_available,
+                latency=candidate.release_gpg_latency,
+                bandwidth=release_bandwidth[url],
+                last_updated=candidate.last_updated,
+            ) or candidate.estimate
+        self.mirror_history.save()
+        # Sanity check our results.
+        mirrors = list(mapping.values())
+        logger.info("Finished checking %s (took %s).", num_mirrors, timer)
+        if not any(c.is_available for c in mirrors):
+            raise Exception("It looks like all %s are unavailable!" % num_mirrors)
+        if all(c.is_updating for c in mirrors):
+            logger.warning("It looks like all %s are being updated?!", num_mirrors)
+        # blacklist BASE_URL mirror if matches blacklist pattern
+        if any(fnmatch.fnmatch(mapping[self.base_url].mirror_url, pattern) for pattern in self.blacklist):
+            logger.warning("Ignoring blacklisted BASE_URL mirror %s.", mapping[self.base_url].mirror_url)
+            mirrors.remove(mapping[self.base_url])
+        ranking = sorted(mirrors, key=lambda c: c.sort_key, reverse=True)
+        set_property(self, 'ranked_mirrors', ranking)
+        # A ranking cut short by the traffic budget isn't worth caching.
+        if self.ranking_cache and not budget_exhausted:
+            self.ranking_cache.store(self.ranking_cache_key, self.export_mirrors(ranking))
+
+    def refresh_ranking(self):
+        """
+        Rank the mirrors again (ignoring :attr:`ranking_cache`) and store the new ranking in the cache.
+
+        This runs in the background process that's forked by
+        :func:`.RankingCache.refresh_in_background()`. The SQLite connection
+        of :attr:`mirror_history`, the keep-alive connections and locks of
+        :attr:`connection_pool` and the other objects created by the parent
+        process must not be used after the fork, so they're created again
+        (the inherited objects are kept alive until the process exits,
+        because even closing an inherited SQLite connection isn't safe).
+        """
+        self.inherited_objects = []
+        for name in ('circuit_breaker', 'connection_pool', 'http_cache', 'mirror_history',
+                     'ranking_cache', 'traffic_shaper'):
+            self.inherited_objects.append(self.__dict__.get(name))
+            delattr(self, name)
+        for candidate in self.iter_ranked_mirrors(cached=False):
+            pass
+
+    def resolve_base_last_updated(self, candidate):
+        """
+        Set :attr:`base_last_updated` based on the ``Release`` file of the base mirror.
+
+        :param candidate: The :class:`CandidateMirror` of :attr:`base_url`.
+        """
+        logger.info("Start retrieving :attr:`base_last_updated` using is_available")
+        if candidate.is_available:
+            logger.debug(":attr:`base_last_updated`: %i", self.base_last_updated)
+            # base_url 's contents are up-to-date naturally,so set its last_updated 0
+            candidate.last_updated = 0
+        else:  # base_url not available, use time at the moment as base_last_updated.
+            self.base_last_updated = int(time.time())
+            logger.warning("%s is not available, so using time.time() as :attr:`base_last_updated`: %i",
+                           self.base_url, self.base_last_updated)
+
+    def run_tournament(self, candidates):
+        """
+        Probe the bandwidth of the most promising mirrors in rounds of successive halving.
+
+        :param candidates: An iterable of available :class:`CandidateMirror`
+                           objects whose ``Release`` file has been fetched
+                           (this is the first round).
+
+        Refer to :attr:`tournament` for details. Each mirror that survives a
+        round gets its :attr:`~CandidateMirror.tournament_round` incremented
+        and its :attr:`~CandidateMirror.bandwidth` replaced by the throughput
+        measured in that round.
+        """
+        contenders = sorted(candidates, key=lambda c: c.sort_key, reverse=True)
+        rounds = ((max(TOURNAMENT_FINALISTS, (len(contenders) + 1) // 2), TOURNAMENT_PROBE_SIZE),
+                  (TOURNAMENT_FINALISTS, BANDWIDTH_PROBE_SIZE))
+        for number, (limit, size) in enumerate(rounds, start=2):
+            contenders = contenders[:limit]
+            if not contenders:
+                break
+            logger.info("Tournament round %i: Probing bandwidth of %s (%s each) ..",
+                        number, pluralize(len(contenders), "mirror"), format_size(size))
+            probe_mapping = dict((c.bandwidth_probe_url, c) for c in contenders)
+            survivors = []
+            for url, bandwidth in fetch_concurrent(probe_mapping.keys(),
+                                                   concurrency=min(self.concurrency, BANDWIDTH_PROBE_CONCURRENCY),
+                                                   engine=self.concurrency_engine,
+                                                   pool=self.connection_pool,
+                                                   worker=bandwidth_worker,
+                                                   size=size):
+                if bandwidth:
+                    candidate = probe_mapping[url]
+                    candidate.bandwidth = bandwidth
+                    candidate.tournament_round = number
+                    survivors.append(candidate)
+                else:
+                    logger.debug("Bandwidth probe failed, %s is out of the tournament.", url)
+            contenders = sorted(survivors, key=lambda c: c.bandwidth, reverse=True)
+
     def smart_update(self, *args, **kw):
         """
         Update the system's package lists (switching mirrors if necessary).
@@ -950,6 +1759,18 @@ class AptMirrorUpdater(PropertyManager):
                                 backoff_time += backoff_time / 3
         raise Exception("Failed to update package lists %i consecutive times?!" % max_attempts)
 
+    def update_provisional_best_mirror(self, candidate):
+        """
+        Update :attr:`provisional_best_mirror` after a mirror has been tested.
+
+        :param candidate: The :class:`CandidateMirror` that was tested.
+        """
+        if candidate.is_available:
+            best = self.provisional_best_mirror
+            if best is None or candidate.sort_key > best.sort_key:
+                logger.debug("Best mirror so far: %s", candidate.mirror_url)
+                self.provisional_best_mirror = candidate
+
     def validate_mirror(self, mirror_url):
         """
         Make sure a mirror serves :attr:`distribution_codename`.
@@ -968,7 +1789,13 @@ class AptMirrorUpdater(PropertyManager):
             # to be relatively small.
             try:
                 mirror = CandidateMirror(mirror_url=mirror_url, updater=self)
-                mirror.release_gpg_contents = fetch_url(mirror.release_gpg_url, retry=False)
+                # The traffic limits only apply to ranking the mirrors (once
+                # the budget is exhausted validation would fail otherwise).
+                with self.traffic_shaper.exempt():
+                    mirror.release_gpg_contents = fetch_url(mirror.release_gpg_url, retry=False,
+                                                            pool=self.connection_pool,
+                                                            max_size=MAX_PROBE_SIZE,
+                                                            validate=looks_like_release_file)
                 value = (MirrorStatus.AVAILABLE if mirror.is_available else MirrorStatus.UNAVAILABLE)
             except NotFoundError:
                 # When the mirror is serving 404 responses it can be an
@@ -993,11 +1820,52 @@ class CandidateMirror(PropertyManager):
         """
         The bytes per second achieved while fetching :attr:`release_gpg_url` (a number or :data:`None`).
 
-        The value of this property is computed based on the values of
-        :attr:`release_gpg_contents` and :attr:`release_gpg_latency`.
+        The value of this property is computed based on the size of the
+        ``Release`` file (from :attr:`probe_digest` or
+        :attr:`release_gpg_contents`) and :attr:`release_gpg_latency`. When
+        :attr:`AptMirrorUpdater.bandwidth_probe` is enabled it's replaced
+        by the throughput measured on :attr:`bandwidth_probe_url`.
+
+        When multiple samples were taken (see :attr:`AptMirrorUpdater.samples`)
+        this is the harmonic mean of :attr:`median_bandwidth` and
+        :attr:`p95_bandwidth`, so a mirror with a bad tail ranks lower even
+        when its median is good.
+        """
+        if len(self.bandwidth_samples or []) > 1:
+            median, tail = self.median_bandwidth, self.p95_bandwidth
+            return 2 * median * tail / (median + tail) if median and tail else 0
+        if self.probe_digest is not None:
+            size = self.probe_digest.size
+        else:
+            size = len(self.release_gpg_contents or b'')
+        if size and self.release_gpg_latency:
+            return size / self.release_gpg_latency
+
+    @mutable_property
+    def bandwidth_samples(self):
+        """
+        The bytes per second achieved by each request for :attr:`release_gpg_url` (a list of numbers).
+
+        Failed requests are counted as zero bytes per second.
+        """
+
+    @mutable_property
+    def bandwidth_probe_url(self):
         """
-        if self.release_gpg_contents and self.release_gpg_latency:
-            return len(self.release_gpg_contents) / self.release_gpg_latency
+        The URL of a large index file used to probe bandwidth (a string or :data:`None`).
+
+        This is the ``Packages`` file of the ``main`` component for the
+        :attr:`~AptMirrorUpdater.architecture` of the :attr:`updater`
+        object, which is always present and large enough to measure sustained
+        throughput (see :attr:`AptMirrorUpdater.bandwidth_probe`).
+        """
+        if self.updater and self.updater.distribution_codename:
+            # Linux Mint only publishes gzip compressed package lists.
+            extension = 'gz' if self.updater.distributor_id == 'linuxmint' else 'xz'
+            return '%s/dists/%s/main/binary-%s/Packages.%s' % (
+                self.mirror_url, self.updater.distribution_codename,
+                self.updater.architecture, extension,
+            )
 
     @lazy_property
     def archive_update_in_progress_url(self):
@@ -1011,6 +1879,49 @@ class CandidateMirror(PropertyManager):
             self.mirror_url, urlparse(self.mirror_url).netloc,
         )
 
+    @mutable_property
+    def connect_time(self):
+        """The seconds it took to establish the TCP connection to the mirror (a number or :data:`None`)."""
+
+    @mutable_property
+    def dns_time(self):
+        """The seconds it took to resolve the host name of the mirror (a number or :data:`None`)."""
+
+    @mutable_property
+    def estimate(self):
+        """
+        The smoothed performance of the mirror across runs (a :class:`.MirrorEstimate` object or :data:`None`).
+
+        This is set by :func:`AptMirrorUpdater.iter_ranked_mirrors()` based
+        on :attr:`AptMirrorUpdater.mirror_history`, it's :data:`None` for
+        mirrors that have never been probed before.
+        """
+
+    @mutable_property
+    def first_byte_time(self):
+        """
+        The seconds between sending the request for :attr:`release_gpg_url` and receiving the response headers.
+
+        This is the time to first byte (a number or :data:`None`), which
+        mostly consists of the round trip time to the mirror. Because ``apt-get
+        update`` downloads many small index files this matters as much as
+        :attr:`bandwidth` does.
+        """
+
+    @mutable_property
+    def latency_samples(self):
+        """The time to first byte of each successful request for :attr:`release_gpg_url` (a list of numbers)."""
+
+    @mutable_property
+    def median_bandwidth(self):
+        """The median of :attr:`bandwidth_samples` (a number or :data:`None`)."""
+        return percentile(self.bandwidth_samples or [], 50)
+
+    @mutable_property
+    def median_latency(self):
+        """The median of :attr:`latency_samples` (a number or :data:`None`)."""
+        return percentile(self.latency_samples or [], 50)
+
     @key_property
     def mirror_url(self):
         """The base URL of the mirror (a string)."""
@@ -1020,14 +1931,27 @@ class CandidateMirror(PropertyManager):
         """Normalize the mirror URL when set."""
         set_property(self, 'mirror_url', normalize_mirror_url(value))
 
+    @mutable_property
+    def index_count(self):
+        """The number of :attr:`~AptMirrorUpdater.index_files` in the ``Release`` file (an integer or :data:`None`)."""
+        if self.probe_digest is not None:
+            return self.probe_digest.index_count
+
+    @mutable_property
+    def index_size(self):
+        """The total size in bytes of the index files counted by :attr:`index_count` (a number or :data:`None`)."""
+        if self.probe_digest is not None:
+            return self.probe_digest.index_size
+
     @mutable_property
     def is_available(self):
         """
-        :data:`True` if :attr:`release_gpg_contents` contains the expected data, :data:`False` otherwise.
+        :data:`True` if the ``Release`` file contains the expected data, :data:`False` otherwise.
 
-        The value of this property is computed by checking whether
-        :attr:`release_gpg_contents` contains the expected data.
-        This may seem like a rather obscure way of
+        The value of this property is computed by checking whether the
+        ``Release`` file (summarized by :attr:`probe_digest` or stored in
+        :attr:`release_gpg_contents`) contains a valid ``Date:`` field
+        (see :attr:`release_date`). This may seem like a rather obscure way of
         validating a mirror, but it was specifically chosen to detect
         all sorts of ways in which mirrors can be broken:
 
@@ -1039,32 +1963,20 @@ class CandidateMirror(PropertyManager):
           (whether they "exist" or not).
         """
         value = False
-        if self.release_gpg_contents:
-            value = b'Date:' in self.release_gpg_contents
-            if not value:
-                logger.debug("Missing data, considering mirror unavailable (%s).", self.release_gpg_url)
+        if self.probe_digest is not None or self.release_gpg_contents:
+            last_updated_time = self.release_date
+            if last_updated_time is None:
+                logger.debug("Missing Date, considering mirror unavailable (%s).", self.release_gpg_url)
             else:
-                # Get all data following "Date: "
-                date_string_raw = self.release_gpg_contents.decode('utf-8').split("Date: ", 1)
-                if len(date_string_raw) == 2:  # split succussfully using "Date: "
-                    # Get only date string like "Sun, 25 Aug 2019 23:35:36 UTC", drop other data
-                    date_string = date_string_raw[1].split("\n")[0]
-                    if date_string.endswith("UTC"):
-                        # Convert it into UNIX timestamp
-                        last_updated_time = calendar.timegm(time.strptime(date_string, "%a, %d %b %Y %H:%M:%S %Z"))
-                        if self.updater.base_last_updated == 0:  # First time launch this method, must be base_url
-                            self.updater.base_last_updated = last_updated_time
-                            logger.debug("base_last_updated: %i", self.updater.base_last_updated)
-                        else:
-                            # if last_updated is 0 means this mirror is up-to-date
-                            self.last_updated = self.updater.base_last_updated - last_updated_time
-                            logger.debug("last_updated: %i", self.last_updated)
-                    else:
-                        logger.debug("Not UTC? Correct me. " + date_string)
-                    logger.debug("Looks good, %s is_available return True", self.release_gpg_url)
-                else:  # split fails because lacking "Date: "
-                    logger.debug("Missing Date, considering mirror unavailable (%s).", self.release_gpg_url)
-                    value = False
+                value = True
+                if self.updater.base_last_updated == 0:  # First time launch this method, must be base_url
+                    self.updater.base_last_updated = last_updated_time
+                    logger.debug("base_last_updated: %i", self.updater.base_last_updated)
+                else:
+                    # if last_updated is 0 means this mirror is up-to-date
+                    self.last_updated = self.updater.base_last_updated - last_updated_time
+                    logger.debug("last_updated: %i", self.last_updated)
+                logger.debug("Looks good, %s is_available return True", self.release_gpg_url)
             set_property(self, 'is_available', value)
         return value
 
@@ -1076,11 +1988,86 @@ class CandidateMirror(PropertyManager):
     def last_updated(self):
         """The time in seconds since the most recent mirror update (a number or :data:`None`)."""
 
+    @mutable_property
+    def p95_bandwidth(self):
+        """The bandwidth achieved by at least 95% of :attr:`bandwidth_samples` (a number or :data:`None`)."""
+        return percentile(self.bandwidth_samples or [], 5)
+
+    @mutable_property
+    def p95_latency(self):
+        """The 95th percentile of :attr:`latency_samples` (a number or :data:`None`)."""
+        return percentile(self.latency_samples or [], 95)
+
+    @mutable_property
+    def predicted_update_time(self):
+        """
+        The number of seconds that ``apt-get update`` is predicted to take using this mirror (a number or :data:`None`).
+
+        The prediction is based on the round trip time (the median of
+        :attr:`latency_samples` or :attr:`first_byte_time`) and the
+        throughput (:attr:`bandwidth` as measured during this run, or the
+        average bandwidth from :attr:`estimate` when it wasn't measured) of
+        the mirror: Every index file counted by
+        :attr:`index_count` costs a round trip and the transfer of
+        :attr:`index_size` bytes is limited by the throughput. When the sizes
+        of the index files are unknown the prediction is the time to fetch
+        the ``Release`` file. The value is :data:`None` when the mirror
+        wasn't measured.
+        """
+        round_trip_time = self.median_latency or self.first_byte_time
+        throughput = self.bandwidth or (self.estimate.bandwidth if self.estimate else None)
+        if round_trip_time is None or not throughput:
+            return None
+        if self.index_count:
+            return self.index_count * round_trip_time + self.index_size / throughput
+        size = self.probe_digest.size if self.probe_digest is not None else len(self.release_gpg_contents or b'')
+        return round_trip_time + size / throughput
+
+    @mutable_property
+    def prior_key(self):
+        """
+        A tuple that decides the order in which mirrors are probed (lower values are probed first).
+
+        The tuple contains the negated fraction of previous probes that
+        succeeded and the average latency (from :attr:`estimate`). Mirrors
+        that have never been probed are assumed to be available half of the
+        time and are probed after the mirrors that are known to be reliable.
+        """
+        if self.estimate is None:
+            return (-0.5, float('inf'))
+        return (-self.estimate.availability,
+                self.estimate.latency if self.estimate.latency is not None else float('inf'))
+
+    @mutable_property
+    def probe_digest(self):
+        """
+        The summary of the response to :attr:`release_gpg_url` (a :class:`.ProbeDigest` object or :data:`None`).
+
+        This is set while ranking mirrors (see
+        :func:`AptMirrorUpdater.iter_ranked_mirrors()`).
+        """
+
+    @mutable_property
+    def release_date(self):
+        """
+        The ``Date:`` field of the ``Release`` file as a Unix timestamp (a number or :data:`None`).
+
+        The value of this property is taken from :attr:`probe_digest` or
+        parsed from :attr:`release_gpg_contents`.
+        """
+        if self.probe_digest is not None:
+            return self.probe_digest.date
+        if self.release_gpg_contents:
+            return parse_release_date(self.release_gpg_contents)
+
     @mutable_property
     def release_gpg_contents(self):
         """
         The contents downloaded from :attr:`release_gpg_url` (a string or :data:`None`).
 
+        While ranking mirrors this is only set when
+        :attr:`AptMirrorUpdater.keep_release_contents` is :data:`True`.
+
         By downloading the file available at :attr:`release_gpg_url` and
         setting :attr:`release_gpg_contents` and :attr:`release_gpg_latency`
         you enable the :attr:`bandwidth` and :attr:`is_available` properties to
@@ -1121,38 +2108,61 @@ class CandidateMirror(PropertyManager):
                     self.mirror_url, self.updater.distribution_codename,
                 )
 
+    @mutable_property
+    def tls_time(self):
+        """The seconds it took to perform the TLS handshake (a number, or :data:`None` for plain HTTP)."""
+
+    @mutable_property
+    def tournament_round(self):
+        """
+        The last round of :attr:`AptMirrorUpdater.tournament` that the mirror reached (an integer).
+
+        Defaults to 1 (every mirror takes part in the first round).
+        """
+        return 1
+
+    @mutable_property
+    def transfer_time(self):
+        """The seconds it took to receive the body of :attr:`release_gpg_url` (a number or :data:`None`)."""
+
     @mutable_property
     def sort_key(self):
         """
         A tuple that can be used to sort the mirror by its availability/performance metrics.
 
-        The tuple created by this property contains four numbers in the following order:
-
-        1. The number 1 when :attr:`is_available` is :data:`True` or
-           the number 0 when :attr:`is_available` is :data:`False`
-           (because most importantly a mirror must be available).
-        2. The number 0 when :attr:`is_updating` is :data:`True` or
-           the number 1 when :attr:`is_updating` is :data:`False`
-           (because being updated at this very moment is *bad*).
-        3. The negated value of :attr:`last_updated` (because the
-           lower :attr:`last_updated` is, the better). If :attr:`last_updated`
-           is :data:`None` then :data:`LAST_UPDATED_DEFAULT` is used instead.
-        4. The value of :attr:`bandwidth` (because the higher
-           :attr:`bandwidth` is, the better).
-
-        By sorting :class:`CandidateMirror` objects on these tuples in
-        ascending order, the last mirror in the sorted results will be the
-        "most suitable mirror" (given the available information).
-        """
-        return (int(self.is_available),
-                int(not self.is_updating),
-                -(self.last_updated if self.last_updated is not None else LAST_UPDATED_DEFAULT),
-                self.bandwidth or 0)
+        The tuple is created by :attr:`AptMirrorUpdater.scoring_policy`
+        (which defaults to :func:`rank_by_update_time()`). By sorting
+        :class:`CandidateMirror` objects on these tuples in ascending order,
+        the last mirror in the sorted results will be the "most suitable
+        mirror" (given the available information).
+        """
+        policy = self.updater.scoring_policy if self.updater is not None else rank_by_update_time
+        return policy(self)
 
     @mutable_property(repr=False)
     def updater(self):
         """A reference to the :class:`AptMirrorUpdater` object that created the candidate."""
 
+    def add_sample(self, digest):
+        """
+        Record the outcome of a request for :attr:`release_gpg_url`.
+
+        :param digest: A :class:`.ProbeDigest` object or :data:`None` when
+                       the request failed.
+
+        The outcome is added to :attr:`latency_samples` and :attr:`bandwidth_samples`.
+        """
+        if self.latency_samples is None:
+            self.latency_samples = []
+        if self.bandwidth_samples is None:
+            self.bandwidth_samples = []
+        if digest is not None:
+            if digest.timings.get('ttfb') is not None:
+                self.latency_samples.append(digest.timings['ttfb'])
+            self.bandwidth_samples.append(digest.size / digest.elapsed_time if digest.elapsed_time else 0)
+        else:
+            self.bandwidth_samples.append(0)
+
 
 class MirrorStatus(Enum):
 
@@ -1215,3 +2225,54 @@ def normalize_mirror_url(url):
     :returns: The normalized mirror URL (a string).
     """
     return url.rstrip('/')
+
+
+def rank_by_bandwidth(candidate):
+    """
+    Rank a mirror by its availability, freshness and bandwidth (a scoring policy).
+
+    :param candidate: A :class:`CandidateMirror` object.
+    :returns: A tuple with five numbers in the following order:
+
+              1. The number 1 when :attr:`~CandidateMirror.is_available` is
+                 :data:`True` or the number 0 when it's :data:`False`
+                 (because most importantly a mirror must be available).
+              2. The number 0 when :attr:`~CandidateMirror.is_updating` is
+                 :data:`True` or the number 1 when it's :data:`False`
+                 (because being updated at this very moment is *bad*).
+              3. The negated value of :attr:`~CandidateMirror.last_updated`
+                 (because the lower it is, the better). If it's :data:`None`
+                 then :data:`LAST_UPDATED_DEFAULT` is used instead.
+              4. The value of :attr:`~CandidateMirror.tournament_round`
+                 (because bandwidth measured with larger probes isn't
+                 comparable to bandwidth measured with smaller probes).
+              5. The value of :attr:`~CandidateMirror.bandwidth` (because
+                 the higher the bandwidth is, the better). Mirrors whose
+                 bandwidth wasn't measured during this run fall back to the
+                 average bandwidth across runs from
+                 :attr:`~CandidateMirror.estimate`.
+    """
+    bandwidth = candidate.bandwidth or (candidate.estimate.bandwidth if candidate.estimate else None)
+    return (int(candidate.is_available),
+            int(not candidate.is_updating),
+            -(candidate.last_updated if candidate.last_updated is not None else LAST_UPDATED_DEFAULT),
+            candidate.tournament_round,
+            bandwidth or 0)
+
+
+def rank_by_update_time(candidate):
+    """
+    Rank a mirror by how long ``apt-get update`` is predicted to take (the default scoring policy).
+
+    :param candidate: A :class:`CandidateMirror` object.
+    :returns: A tuple that's the same as the one returned by
+              :func:`rank_by_bandwidth()` except that the last element is
+              the negated :attr:`~CandidateMirror.predicted_update_time`
+              (because the faster an update is, the better). Unlike
+              bandwidth alone this accounts for the round trip time of the
+              many requests made by ``apt-get update``.
+    """
+    predicted_update_time = candidate.predicted_update_time
+    return rank_by_bandwidth(candidate)[:-1] + (
+        -predicted_update_time if predicted_update_time is not None else float('-inf'),
+    )
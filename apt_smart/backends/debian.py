@@ -13,21 +13,25 @@ working on this module:
 - `Notes about sources.list on the Debian wiki <https://wiki.debian.org/SourcesList>`_
 - `The Debian backports webpages <https://backports.debian.org/Instructions/>`_
 - `Documentation about the "proposed-updates" mechanism <https://www.debian.org/releases/proposed-updates.html>`_
+- `The Debian mirror masterlist <https://salsa.debian.org/mirror-team/masterlist>`_
 """
 
 # Standard library modules.
-import logging
+import hashlib
 import json
+import logging
+import os
 
 # External dependencies.
-import six
-from bs4 import BeautifulSoup
 from humanfriendly import Timer, format, pluralize
 
 # Modules included in our package.
 from apt_smart import CandidateMirror, mirrors_are_equal
+from apt_smart.cache import write_file
 
 from apt_smart.http import fetch_url
+from apt_smart.location import find_country
+from apt_smart.tables import TableParser
 
 LTS_ARCHITECTURES = ('i386', 'amd64', 'armel', 'armhf')
 """The names of the architectures supported by the Debian LTS team (a tuple of strings)."""
@@ -48,6 +52,16 @@ originally reported in `issue #5`_).
 .. _issue #5: https://github.com/xolox/python-apt-mirror-updater/issues/5
 """
 
+MASTERLIST_URL = 'https://salsa.debian.org/mirror-team/masterlist/-/raw/master/Mirrors.masterlist'
+"""The URL of the machine readable list of all Debian mirrors maintained by the Debian mirror team (a string)."""
+
+MASTERLIST_PROTOCOLS = 'http', 'https'
+"""
+The protocols of the mirror URLs taken from :data:`MASTERLIST_URL` (a tuple of strings).
+
+Sites are included once, using the first protocol in this tuple that they support.
+"""
+
 MIRRORS_URL = 'https://www.debian.org/mirror/list'
 """The URL of the HTML page listing all primary Debian mirrors (a string)."""
 
@@ -75,14 +89,24 @@ VALID_SUITES = 'release', 'security', 'updates', 'backports', 'proposed-updates'
 logger = logging.getLogger(__name__)
 
 
-def discover_mirrors():
+def discover_mirrors(updater=None):
     """
-    Discover available Debian mirrors by querying :data:`MIRRORS_URL`.
+    Discover available Debian mirrors by querying :data:`MASTERLIST_URL` or :data:`MIRRORS_URL`.
 
+    :param updater: The :class:`~apt_smart.AptMirrorUpdater` object whose
+                    :attr:`~apt_smart.AptMirrorUpdater.http_cache`,
+                    :attr:`~apt_smart.AptMirrorUpdater.cache_directory` and
+                    :attr:`~apt_smart.AptMirrorUpdater.architecture` should
+                    be used (optional).
     :returns: A set of :class:`.CandidateMirror` objects that have their
              :attr:`~.CandidateMirror.mirror_url` property set.
     :raises: If no mirrors are discovered an exception is raised.
 
+    The mirrors are taken from the machine readable masterlist (see
+    :func:`discover_masterlist_mirrors()`), the HTML page is only used when
+    the masterlist can't be fetched or parsed (see
+    :func:`discover_mirror_list()`).
+
     An example run:
 
     >>> from apt_smart.backends.debian import discover_mirrors
@@ -101,52 +125,263 @@ def discover_mirrors():
          ...])
     """
     timer = Timer()
-    logger.info("Discovering Debian mirrors at %s ..", MIRRORS_URL)
     # Find which country the user is in to get mirrors in that country
+    country = find_country(updater)
     try:
-        url = 'https://ipapi.co/json'
-        response = fetch_url(url, timeout=2)
-        # On py3 response is bytes and json.loads throws TypeError in py3.4 and 3.5,
-        # so decode it to str
-        if isinstance(response, six.binary_type):
-            response = response.decode('utf-8')
-        data = json.loads(response)
-        country = data['country_name']
-        logger.info("Found your location: %s by %s", country, url)
-    except Exception:
-        url = 'http://ip-api.com/json'
-        response = fetch_url(url, timeout=5)
-        if isinstance(response, six.binary_type):
-            response = response.decode('utf-8')
-        data = json.loads(response)
-        country = data['country']
-        logger.info("Found your location: %s by %s", country, url)
-
-    data = fetch_url(MIRRORS_URL, timeout=20, retry=True)
-    soup = BeautifulSoup(data, 'html.parser')
-    tables = soup.findAll('table')
-    flag = False  # flag is True when find the row's text is that country
-    mirrors = set()
-    if not tables:
-        raise Exception("Failed to locate <table> element in Debian mirror page! (%s)" % MIRRORS_URL)
-    else:
-        for row in tables[1].findAll("tr"):  # tables[1] organises mirrors by country.
-            if flag:
-                if not row.a:  # End of mirrors located in that country
-                    break
-                else:
-                    mirrors.add(CandidateMirror(mirror_url=row.a['href']))
-            if row.get_text() == country:
-                flag = True
+        mirrors = discover_masterlist_mirrors(updater, country)
+    except Exception as e:
+        logger.warning("Failed to discover Debian mirrors using %s, falling back to %s! (%s)",
+                       MASTERLIST_URL, MIRRORS_URL, e)
+        mirrors = discover_mirror_list(updater, country)
+    logger.info("Discovered %s in %s.", pluralize(len(mirrors), "Debian mirror"), timer)
+    return mirrors
+
+
+def discover_masterlist_mirrors(updater=None, country=None):
+    """
+    Discover available Debian mirrors using :data:`MASTERLIST_URL`.
 
+    :param updater: The :class:`~apt_smart.AptMirrorUpdater` object (optional).
+    :param country: The name or code of the country whose mirrors are preferred
+                    (a string or :data:`None`).
+    :returns: A set of :class:`.CandidateMirror` objects.
+    :raises: If no mirrors are discovered an exception is raised.
+
+    Only mirrors that carry the architecture of the system are returned.
+    When fewer than three such mirrors are located in `country` the primary
+    mirrors are added.
+    """
+    logger.info("Discovering Debian mirrors at %s ..", MASTERLIST_URL)
+    index = MasterlistIndex.load(updater)
+    architecture = updater.architecture if updater else None
+    mirrors = set(CandidateMirror(mirror_url=url) for url in index.lookup(country, architecture))
+    if len(mirrors) < 3:  # Too few, add the primary Debian mirror sites all around the world.
+        mirrors.update(CandidateMirror(mirror_url=url) for url in index.lookup(None, architecture))
+    if not mirrors:
+        raise Exception("Failed to discover any Debian mirrors! (using %s)" % MASTERLIST_URL)
+    return mirrors
+
+
+def discover_mirror_list(updater=None, country=None):
+    """
+    Discover available Debian mirrors by scraping :data:`MIRRORS_URL`.
+
+    :param updater: The :class:`~apt_smart.AptMirrorUpdater` object whose
+                    :attr:`~apt_smart.AptMirrorUpdater.http_cache` should be
+                    used (optional).
+    :param country: The name of the country whose mirrors are preferred (a
+                    string or :data:`None`).
+    :returns: A set of :class:`.CandidateMirror` objects.
+    :raises: If no mirrors are discovered an exception is raised.
+    """
+    logger.info("Discovering Debian mirrors at %s ..", MIRRORS_URL)
+    parser = fetch_url(MIRRORS_URL, timeout=20, hedge=True, cache=updater.http_cache if updater else None,
+                       parser=lambda: MirrorListParser(country))
+    if not parser.num_tables:
+        raise Exception("Failed to locate <table> element in Debian mirror page! (%s)" % MIRRORS_URL)
+    mirrors = set(CandidateMirror(mirror_url=url) for url in parser.country_mirrors)
     if len(mirrors) < 3:  # Too few, add tables[0] which contains Primary Debian mirror sites all around the world.
-        mirrors.add(CandidateMirror(mirror_url=a['href']) for a in tables[0].findAll('a', href=True))
+        mirrors.update(CandidateMirror(mirror_url=url) for url in parser.primary_mirrors)
     if not mirrors:
         raise Exception("Failed to discover any Debian mirrors! (using %s)" % MIRRORS_URL)
-    logger.info("Discovered %s in %s.", pluralize(len(mirrors), "Debian mirror"), timer)
     return mirrors
 
 
+class MasterlistIndex(object):
+
+    """
+    Index of the Debian mirror masterlist by country, architecture and protocol.
+
+    The masterlist (see :data:`MASTERLIST_URL`) is a text file with one
+    stanza of ``Field: value`` lines per mirror site. Parsing it (see
+    :func:`parse()`) results in a nested dictionary that maps country codes
+    to architectures to protocols to lists of mirror URLs, so finding the
+    mirrors of a country that carry a given architecture is a few dictionary
+    lookups. The primary mirrors (``Type: Push-Primary``) are indexed under
+    the country code ``Primary``. Because the index only depends on the contents of the
+    masterlist it's cached on disk (see :func:`load()`) and the masterlist
+    is only parsed again when it changes.
+    """
+
+    def __init__(self, mirrors, countries, digest=None):
+        """
+        Initialize a :class:`MasterlistIndex` object.
+
+        :param mirrors: A dictionary that maps country codes to dictionaries
+                        that map architectures to dictionaries that map
+                        protocols to lists of mirror URLs. Sites that carry
+                        all architectures are indexed under the architecture
+                        ``any``, sites that exclude an architecture are also
+                        indexed under ``!`` followed by its name.
+        :param countries: A dictionary that maps lowercase country names to
+                          country codes.
+        :param digest: The SHA1 digest of the masterlist (a string or
+                       :data:`None`).
+        """
+        self.mirrors = mirrors
+        self.countries = countries
+        self.digest = digest
+
+    @classmethod
+    def parse(cls, data):
+        """
+        Parse the masterlist.
+
+        :param data: The contents of the masterlist (a byte string).
+        :returns: A :class:`MasterlistIndex` object.
+        """
+        mirrors = {}
+        countries = {}
+        for stanza in data.decode('UTF-8', 'replace').split('\n\n'):
+            fields = {}
+            name = None
+            for line in stanza.splitlines():
+                if line[:1].isspace() and name:
+                    # Continuation line.
+                    fields[name] += ' ' + line.strip()
+                elif ':' in line and not line.startswith('#'):
+                    name, _, value = line.partition(':')
+                    name = name.strip().lower()
+                    fields[name] = value.strip()
+            site = fields.get('site')
+            code, _, country = fields.get('country', '').partition(' ')
+            if not site or not code:
+                continue
+            countries[country.strip().lower()] = code
+            architectures = fields.get('archive-architecture', 'any').split()
+            # Sites that carry all architectures (except the excluded ones).
+            if any(a.lower() in ('any', 'all') for a in architectures) or all(a.startswith('!') for a in architectures):
+                architectures = ['any'] + [a for a in architectures if a.startswith('!')]
+            for protocol in MASTERLIST_PROTOCOLS:
+                path = fields.get('archive-%s' % protocol)
+                if path:
+                    url = '%s://%s/%s' % (protocol, site, path.lstrip('/'))
+                    # The primary mirrors are of type Push-Primary.
+                    for key in set([code] + (['Primary'] if 'primary' in fields.get('type', '').lower() else [])):
+                        for architecture in architectures:
+                            by_protocol = mirrors.setdefault(key, {}).setdefault(architecture, {})
+                            by_protocol.setdefault(protocol, []).append(url)
+        return cls(mirrors=mirrors, countries=countries, digest=hashlib.sha1(data).hexdigest())
+
+    @classmethod
+    def load(cls, updater=None):
+        """
+        Get the index of the current masterlist.
+
+        :param updater: The :class:`~apt_smart.AptMirrorUpdater` object whose
+                        :attr:`~apt_smart.AptMirrorUpdater.http_cache` and
+                        :attr:`~apt_smart.AptMirrorUpdater.cache_directory`
+                        should be used (optional).
+        :returns: A :class:`MasterlistIndex` object.
+
+        The masterlist is fetched (or revalidated) using the HTTP cache. When
+        the index stored in ``debian-masterlist.json`` in the cache directory
+        was made from the same masterlist it's used as is, otherwise the
+        masterlist is parsed and the new index is stored.
+        """
+        data = fetch_url(MASTERLIST_URL, timeout=20, hedge=True, cache=updater.http_cache if updater else None)
+        digest = hashlib.sha1(data).hexdigest()
+        filename = (os.path.join(updater.cache_directory, 'debian-masterlist.json')
+                    if updater and updater.use_cache else None)
+        if filename:
+            try:
+                with open(filename) as handle:
+                    cached = json.load(handle)
+                if cached.get('digest') == digest:
+                    logger.debug("Using cached index of %s.", MASTERLIST_URL)
+                    return cls(**cached)
+            except (IOError, OSError, TypeError, ValueError):
+                pass
+        index = cls.parse(data)
+        if filename:
+            try:
+                write_file(filename, json.dumps(dict(
+                    mirrors=index.mirrors,
+                    countries=index.countries,
+                    digest=index.digest,
+                )).encode('UTF-8'))
+            except (IOError, OSError) as e:
+                logger.warning("Failed to cache index of %s! (%s)", MASTERLIST_URL, e)
+        return index
+
+    def lookup(self, country=None, architecture=None, protocols=MASTERLIST_PROTOCOLS):
+        """
+        Find the mirrors of a country that carry an architecture.
+
+        :param country: The name or code of a country (a string) or
+                        :data:`None` to find the primary mirrors.
+        :param architecture: The name of a Debian architecture (a string) or
+                             :data:`None` to find the mirrors that carry any
+                             architecture.
+        :param protocols: The acceptable protocols in order of preference (a
+                          tuple of strings, defaults to :data:`MASTERLIST_PROTOCOLS`).
+        :returns: A list of mirror URLs (strings, one per site).
+        """
+        if country:
+            code = self.countries.get(country.lower(), country.upper())
+        else:
+            code = 'Primary'
+        by_architecture = self.mirrors.get(code, {})
+        if architecture:
+            excluded = set(url for urls in by_architecture.get('!' + architecture, {}).values() for url in urls)
+            candidates = [by_architecture.get(architecture, {}), dict(
+                (protocol, [url for url in urls if url not in excluded])
+                for protocol, urls in by_architecture.get('any', {}).items()
+            )]
+        else:
+            candidates = list(by_architecture.values())
+        urls = []
+        sites = set()
+        for protocol in protocols:
+            for by_protocol in candidates:
+                for url in by_protocol.get(protocol, []):
+                    site = url.split('/')[2]
+                    if site not in sites:
+                        sites.add(site)
+                        urls.append(url)
+        return urls
+
+
+class MirrorListParser(TableParser):
+
+    """
+    Incremental parser for :data:`MIRRORS_URL`.
+
+    The first table on the page lists the primary Debian mirrors all around
+    the world, the second table organises the mirrors by country: A row with
+    the name of the country is followed by one row per mirror. Parsing stops
+    at the end of the rows of the country of the user.
+    """
+
+    def __init__(self, country):
+        """
+        Initialize a :class:`MirrorListParser` object.
+
+        :param country: The name of the country whose mirrors should be
+                        collected (a string or :data:`None`).
+        """
+        TableParser.__init__(self)
+        self.country = country
+        self.in_country = False
+        self.primary_mirrors = []
+        self.country_mirrors = []
+
+    def handle_row(self, table, row):
+        """Collect the primary mirrors and the mirrors located in :attr:`country`."""
+        if table == 0:
+            self.primary_mirrors.extend(row.links)
+        elif table == 1:
+            if self.in_country:
+                if not row.links:  # End of mirrors located in that country
+                    return True
+                self.country_mirrors.append(row.links[0])
+            elif row.text == self.country:
+                self.in_country = True
+        else:
+            return True
+        return False
+
+
 def generate_sources_list(mirror_url, codename,
                           suites=DEFAULT_SUITES,
                           components=VALID_COMPONENTS,
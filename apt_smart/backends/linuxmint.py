@@ -7,17 +7,16 @@
 """Discovery of Linux Mint package archive mirrors."""
 
 # Standard library modules.
-import json
 import logging
 
 # External dependencies.
-import six
-from bs4 import BeautifulSoup
 from humanfriendly import Timer, pluralize
 
 # Modules included in our package.
 from apt_smart import CandidateMirror
 from apt_smart.http import fetch_url
+from apt_smart.location import find_country
+from apt_smart.tables import TableParser
 
 MIRRORS_URL = 'https://linuxmint.com/mirrors.php'
 """The URL of the HTML page listing official Linux Mint mirrors (a string)."""
@@ -54,10 +53,13 @@ suites available: ``xenial`` (this is the release suite), ``xenial-security``,
 logger = logging.getLogger(__name__)
 
 
-def discover_mirrors():
+def discover_mirrors(updater=None):
     """
     Discover available Linux Mint mirrors.
 
+    :param updater: The :class:`~apt_smart.AptMirrorUpdater` object whose
+                    :attr:`~apt_smart.AptMirrorUpdater.http_cache` should be
+                    used (optional).
     :returns: A set of :class:`.CandidateMirror` objects that have their
               :attr:`~.CandidateMirror.mirror_url` property set and may have
               the :attr:`~.CandidateMirror.last_updated` property set.
@@ -81,51 +83,58 @@ def discover_mirrors():
     mirrors = set()
     logger.info("Discovering Linux Mint mirrors at %s ..", MIRRORS_URL)
     # Find which country the user is in to get mirrors in that country
-    try:
-        url = 'https://ipapi.co/json'
-        response = fetch_url(url, timeout=2)
-        # On py3 response is bytes and json.loads throws TypeError in py3.4 and 3.5,
-        # so decode it to str
-        if isinstance(response, six.binary_type):
-            response = response.decode('utf-8')
-        data = json.loads(response)
-        country = data['country_name']
-        logger.info("Found your location: %s by %s", country, url)
-    except Exception:
-        url = 'http://ip-api.com/json'
-        response = fetch_url(url, timeout=5)
-        if isinstance(response, six.binary_type):
-            response = response.decode('utf-8')
-        data = json.loads(response)
-        country = data['country']
-        logger.info("Found your location: %s by %s", country, url)
+    country = find_country(updater) or 'Worldwide'
     if country == 'United States':
         country = 'USA'
-    try:
-        data = fetch_url(MIRRORS_URL, timeout=15)
-    except Exception:
-        logger.warning("Time out, try again")
-        data = fetch_url(MIRRORS_URL, timeout=70, retry=True)
-    soup = BeautifulSoup(data, 'html.parser')
-    tables = soup.findAll('table')
-    if not tables:
+    cache = updater.http_cache if updater else None
+    parser = fetch_url(MIRRORS_URL, timeout=70, hedge=True, cache=cache, parser=lambda: MirrorListParser(country))
+    if not parser.num_tables:
         raise Exception("Failed to locate <table> element in Linux Mint mirror page! (%s)" % MIRRORS_URL)
-    else:
-        while len(mirrors) < 3:
-            for row in tables[2].findAll("tr"):
-                if country in row.get_text():
-                    for data in row.findAll("td"):
-                        data_text = data.get_text()
-                        # Check if the link looks like a mirror URL.
-                        if data_text.startswith(('http://', 'https://')):
-                            mirrors.add(CandidateMirror(mirror_url=data_text))
-            if country == 'Worldwide':
-                break  # break while loop when already set to 'Worldwide'
-            if len(mirrors) < 3:
-                logging.info("Too few mirrors found in your country, get more Worldwide mirrors.")
-                country = 'Worldwide'
+    mirrors.update(CandidateMirror(mirror_url=url) for url in parser.country_mirrors)
+    if len(mirrors) < 3 and country != 'Worldwide':
+        logger.info("Too few mirrors found in your country, get more Worldwide mirrors.")
+        mirrors.update(CandidateMirror(mirror_url=url) for url in parser.worldwide_mirrors)
 
     if not mirrors:
         raise Exception("Failed to discover any Linux Mint mirrors! (using %s)" % MIRRORS_URL)
     logger.info("Discovered %s in %s.", pluralize(len(mirrors), "Linux Mint mirror"), timer)
     return mirrors
+
+
+class MirrorListParser(TableParser):
+
+    """
+    Incremental parser for :data:`MIRRORS_URL`.
+
+    The third table on the page lists the mirrors, one row per mirror with
+    the name of its country. Because the rows aren't grouped by country the
+    whole table is parsed (the mirrors of the country of the user and the
+    worldwide mirrors are collected in a single pass), parsing stops at the
+    end of the table.
+    """
+
+    def __init__(self, country):
+        """
+        Initialize a :class:`MirrorListParser` object.
+
+        :param country: The name of the country whose mirrors should be
+                        collected (a string).
+        """
+        TableParser.__init__(self)
+        self.country = country
+        self.country_mirrors = []
+        self.worldwide_mirrors = []
+
+    def handle_row(self, table, row):
+        """Collect the mirrors located in :attr:`country` and the worldwide mirrors."""
+        if table < 2:
+            return False
+        if table > 2:
+            return True
+        # Check if the cell looks like a mirror URL.
+        urls = [text for text in row.cells if text.startswith(('http://', 'https://'))]
+        if self.country in row.text:
+            self.country_mirrors.extend(urls)
+        if 'Worldwide' in row.text:
+            self.worldwide_mirrors.extend(urls)
+        return False
@@ -7,17 +7,17 @@
 """Discovery of Ubuntu package archive mirrors."""
 
 # Standard library modules.
-import json
 import logging
 
 # External dependencies.
-import six
-from bs4 import BeautifulSoup, UnicodeDammit
+from bs4 import UnicodeDammit
 from humanfriendly import Timer, format, pluralize
 
 # Modules included in our package.
 from apt_smart import CandidateMirror, mirrors_are_equal
 from apt_smart.http import fetch_url
+from apt_smart.location import find_country
+from apt_smart.tables import TableParser
 
 MIRRORS_URL = 'https://launchpad.net/ubuntu/+archivemirrors'
 """The URL of the HTML page listing official Ubuntu mirrors (a string)."""
@@ -60,10 +60,13 @@ suites available: ``xenial`` (this is the release suite), ``xenial-security``,
 logger = logging.getLogger(__name__)
 
 
-def discover_mirrors_old():
+def discover_mirrors_old(updater=None):
     """
     Discover available Ubuntu mirrors. (fallback)
 
+    :param updater: The :class:`~apt_smart.AptMirrorUpdater` object whose
+                    :attr:`~apt_smart.AptMirrorUpdater.http_cache` should be
+                    used (optional).
     :returns: A set of :class:`.CandidateMirror` objects that have their
               :attr:`~.CandidateMirror.mirror_url` property set and may have
               the :attr:`~.CandidateMirror.last_updated` property set.
@@ -104,53 +107,25 @@ def discover_mirrors_old():
     mirrors = set()
     logger.info("Discovering Ubuntu mirrors at %s ..", MIRRORS_URL)
     # Find which country the user is in to get mirrors in that country
-    try:
-        url = 'https://ipapi.co/json'
-        response = fetch_url(url, timeout=2)
-        # On py3 response is bytes and json.loads throws TypeError in py3.4 and 3.5,
-        # so decode it to str
-        if isinstance(response, six.binary_type):
-            response = response.decode('utf-8')
-        data = json.loads(response)
-        country = data['country_name']
-        logger.info("Found your location: %s by %s", country, url)
-    except Exception:
-        url = 'http://ip-api.com/json'
-        response = fetch_url(url, timeout=5)
-        if isinstance(response, six.binary_type):
-            response = response.decode('utf-8')
-        data = json.loads(response)
-        country = data['country']
-        logger.info("Found your location: %s by %s", country, url)
-
-    data = fetch_url(MIRRORS_URL, timeout=70, retry=True)
-    soup = BeautifulSoup(data, 'html.parser')
-    tables = soup.findAll('table')
-    flag = False  # flag is True when find the row's text is that country
-    if not tables:
-        raise Exception("Failed to locate <table> element in Ubuntu mirror page! (%s)" % MIRRORS_URL)
-    else:
-        for row in tables[0].findAll("tr"):
-            if flag:
-                if not row.a:  # End of mirrors located in that country
-                    break
-                else:
-                    for a in row.findAll('a', href=True):
-                        # Check if the link looks like a mirror URL.
-                        if a['href'].startswith(('http://', 'https://')):
-                            mirrors.add(CandidateMirror(mirror_url=a['href']))
-            if row.th and row.th.get_text() == country:
-                flag = True
+    country = find_country(updater)
 
+    parser = fetch_url(MIRRORS_URL, timeout=70, hedge=True, cache=updater.http_cache if updater else None,
+                       parser=lambda: MirrorListParser(country))
+    if not parser.num_tables:
+        raise Exception("Failed to locate <table> element in Ubuntu mirror page! (%s)" % MIRRORS_URL)
+    mirrors.update(CandidateMirror(mirror_url=url) for url in parser.mirrors)
     if not mirrors:
         raise Exception("Failed to discover any Ubuntu mirrors! (using %s)" % MIRRORS_URL)
     return mirrors
 
 
-def discover_mirrors():
+def discover_mirrors(updater=None):
     """
     Discover available Ubuntu mirrors.
 
+    :param updater: The :class:`~apt_smart.AptMirrorUpdater` object that's
+                    passed on to :func:`discover_mirror_selection()` and
+                    :func:`discover_mirrors_old()` (optional).
     :returns: A set of :class:`.CandidateMirror` objects that have their
               :attr:`~.CandidateMirror.mirror_url` property set and may have
               the :attr:`~.CandidateMirror.last_updated` property set.
@@ -165,24 +140,32 @@ def discover_mirrors():
     """
     timer = Timer()
     mirrors = set()
-    mirrors = discover_mirror_selection()
+    mirrors = discover_mirror_selection(updater)
     if not mirrors:
         logger.warning("Failed to discover any Ubuntu mirrors! (using %s)" % MIRROR_SELECTION_URL)
         logger.info("Trying to use %s as fallback" % MIRRORS_URL)
-        mirrors = discover_mirrors_old()
+        mirrors = discover_mirrors_old(updater)
     elif len(mirrors) < 2:
         logger.warning("Too few mirrors, trying to use %s to find more" % MIRRORS_URL)
-        mirrors |= discover_mirrors_old()  # add mirrors from discover_mirrors_old()
+        mirrors |= discover_mirrors_old(updater)  # add mirrors from discover_mirrors_old()
     logger.info("Discovered %s in %s.", pluralize(len(mirrors), "Ubuntu mirror"), timer)
     return mirrors
 
 
-def discover_mirror_selection():
-    """Discover "geographically suitable" Ubuntu mirrors."""
+def discover_mirror_selection(updater=None):
+    """
+    Discover "geographically suitable" Ubuntu mirrors.
+
+    :param updater: The :class:`~apt_smart.AptMirrorUpdater` object whose
+                    :attr:`~apt_smart.AptMirrorUpdater.http_cache` should be
+                    used (optional).
+    :returns: A set of :class:`.CandidateMirror` objects.
+    """
     timer = Timer()
     logger.info("Identifying fast Ubuntu mirrors using %s ..", MIRROR_SELECTION_URL)
-    data = fetch_url(MIRROR_SELECTION_URL, timeout=3, retry=True, max_attempts=5)
-    # shorter timeout with more retries is good for unstable connections to MIRROR_SELECTION_URL
+    # Hedged requests with a short timeout are good for unstable connections to MIRROR_SELECTION_URL.
+    data = fetch_url(MIRROR_SELECTION_URL, timeout=3, hedge=True, max_attempts=5,
+                     cache=updater.http_cache if updater else None)
     dammit = UnicodeDammit(data)
     mirrors = set(
         CandidateMirror(mirror_url=mirror_url.strip())
@@ -193,6 +176,42 @@ def discover_mirror_selection():
     return mirrors
 
 
+class MirrorListParser(TableParser):
+
+    """
+    Incremental parser for :data:`MIRRORS_URL`.
+
+    The first table on the page organises the mirrors by country: A row with
+    the name of the country in its header is followed by one row per mirror.
+    Parsing stops at the end of the rows of the country of the user.
+    """
+
+    def __init__(self, country):
+        """
+        Initialize a :class:`MirrorListParser` object.
+
+        :param country: The name of the country whose mirrors should be
+                        collected (a string or :data:`None`).
+        """
+        TableParser.__init__(self)
+        self.country = country
+        self.in_country = False
+        self.mirrors = []
+
+    def handle_row(self, table, row):
+        """Collect the mirrors located in :attr:`country`."""
+        if table != 0:
+            return True
+        if self.in_country:
+            if not row.links:  # End of mirrors located in that country
+                return True
+            # Check if the link looks like a mirror URL.
+            self.mirrors.extend(url for url in row.links if url.startswith(('http://', 'https://')))
+        elif row.header == self.country:
+            self.in_country = True
+        return False
+
+
 def generate_sources_list(mirror_url, codename,
                           suites=DEFAULT_SUITES,
                           components=VALID_COMPONENTS,
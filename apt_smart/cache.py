@@ -0,0 +1,373 @@
+# Automated, robust apt-get mirror selection for Debian and Ubuntu.
+#
+# Author: martin68 and Peter Odding
+# Last Change: October 16, 2026
+# URL: https://apt-smart.readthedocs.io
+
+"""
+Persistent on-disk caches used by `apt-smart`.
+
+The mirror discovery pages of Debian, Ubuntu and Linux Mint are large HTML
+documents that hardly ever change, yet without a cache every run of
+`apt-smart` downloads and parses them again. The :class:`HttpCache` class
+stores these responses on disk together with their ``ETag`` and
+``Last-Modified`` headers so that :func:`~apt_smart.http.fetch_url()` can
+serve them directly (while they are fresh) or revalidate them using a
+conditional request (which costs a single round trip when the server answers
+with ``304 Not Modified``).
+
+The :class:`RankingCache` class goes one step further and stores the outcome
+of ranking the mirrors, so that frequent invocations (think cron jobs and
+provisioning scripts) can skip mirror discovery and ranking altogether.
+"""
+
+# Standard library modules.
+import hashlib
+import json
+import logging
+import os
+import tempfile
+import time
+
+# External dependencies.
+from humanfriendly import format_size
+
+CACHE_TTL = 60 * 60 * 24
+"""The number of seconds that cached responses are used without revalidation (a number)."""
+
+CACHE_MAX_SIZE = 1024 * 1024 * 16
+"""The maximum total size in bytes of the cached response bodies (a number)."""
+
+RANKING_TTL = 60 * 60
+"""The default number of seconds that a cached ranking of mirrors is used without ranking the mirrors again."""
+
+REFRESH_TIMEOUT = 60 * 10
+"""The number of seconds after which the lock of a background refresh is considered stale (a number)."""
+
+# Initialize a logger for this module.
+logger = logging.getLogger(__name__)
+
+
+def get_cache_directory():
+    """
+    Get the default directory where `apt-smart` stores its caches.
+
+    :returns: The pathname of ``/var/cache/apt-smart`` for root and
+              ``$XDG_CACHE_HOME/apt-smart`` (which defaults to
+              ``~/.cache/apt-smart``) for other users (a string).
+    """
+    if os.getuid() == 0:
+        return '/var/cache/apt-smart'
+    return os.path.join(os.environ.get('XDG_CACHE_HOME') or os.path.expanduser('~/.cache'), 'apt-smart')
+
+
+def write_file(filename, contents):
+    """
+    Atomically create or replace a file.
+
+    :param filename: The pathname of the file (a string).
+    :param contents: The new contents of the file (a byte string).
+
+    The contents are written to a temporary file in the same directory which
+    is then renamed into place, so concurrent readers never see a partially
+    written file.
+    """
+    directory = os.path.dirname(filename)
+    if not os.path.isdir(directory):
+        os.makedirs(directory)
+    fd, temporary_file = tempfile.mkstemp(dir=directory, prefix='.tmp-')
+    try:
+        with os.fdopen(fd, 'wb') as handle:
+            handle.write(contents)
+        os.rename(temporary_file, filename)
+    except Exception:
+        os.unlink(temporary_file)
+        raise
+
+
+class HttpCache(object):
+
+    """
+    On-disk cache of HTTP responses with conditional revalidation.
+
+    Each response is stored as two files named after the SHA1 hash of its
+    URL: A JSON file with metadata (the URL, the ``ETag`` and
+    ``Last-Modified`` headers and the time the response was last validated)
+    and a file with the response body. Whenever a cached body is used its
+    modification time is updated, this is what the least recently used
+    eviction (see :func:`evict()`) is based on.
+    """
+
+    def __init__(self, directory, ttl=CACHE_TTL, max_size=CACHE_MAX_SIZE):
+        """
+        Initialize an :class:`HttpCache` object.
+
+        :param directory: The pathname of the directory where the cached
+                          responses are stored (a string, created on demand).
+        :param ttl: The number of seconds that a cached response is
+                    considered fresh (a number, defaults to :data:`CACHE_TTL`).
+        :param max_size: The maximum total size in bytes of the cached
+                         response bodies (a number, defaults to
+                         :data:`CACHE_MAX_SIZE`).
+        """
+        self.directory = directory
+        self.ttl = ttl
+        self.max_size = max_size
+
+    def get_filename(self, url, extension):
+        """Get the pathname of a file in the cache (a string)."""
+        key = hashlib.sha1(url.encode('UTF-8')).hexdigest()
+        return os.path.join(self.directory, key + extension)
+
+    def lookup(self, url):
+        """
+        Find a cached response.
+
+        :param url: The URL of the response (a string).
+        :returns: A :class:`CacheEntry` object or :data:`None`.
+        """
+        try:
+            with open(self.get_filename(url, '.json')) as handle:
+                metadata = json.load(handle)
+            with open(self.get_filename(url, '.data'), 'rb') as handle:
+                body = handle.read()
+        except (IOError, OSError, ValueError):
+            return None
+        if metadata.get('url') != url:
+            return None
+        return CacheEntry(cache=self, url=url, body=body, metadata=metadata)
+
+    def store(self, url, body, etag=None, last_modified=None):
+        """
+        Store a response in the cache.
+
+        :param url: The URL of the response (a string).
+        :param body: The response body (a byte string).
+        :param etag: The value of the ``ETag`` header (a string or :data:`None`).
+        :param last_modified: The value of the ``Last-Modified`` header (a
+                              string or :data:`None`).
+        """
+        metadata = dict(url=url, etag=etag, last_modified=last_modified, validated=time.time())
+        try:
+            write_file(self.get_filename(url, '.data'), body)
+            write_file(self.get_filename(url, '.json'), json.dumps(metadata).encode('UTF-8'))
+        except (IOError, OSError) as e:
+            logger.warning("Failed to store response in cache! (%s)", e)
+        else:
+            logger.debug("Stored %s response of %s in cache.", format_size(len(body)), url)
+            self.evict()
+
+    def evict(self):
+        """Remove the least recently used responses until the cache is smaller than :attr:`max_size`."""
+        entries = []
+        for filename in os.listdir(self.directory):
+            if filename.endswith('.data'):
+                pathname = os.path.join(self.directory, filename)
+                try:
+                    stat = os.stat(pathname)
+                except OSError:
+                    continue
+                entries.append((stat.st_mtime, stat.st_size, pathname))
+        total_size = sum(size for mtime, size, pathname in entries)
+        for mtime, size, pathname in sorted(entries):
+            if total_size <= self.max_size:
+                break
+            logger.debug("Evicting %s from cache ..", pathname)
+            for filename in (pathname, pathname[:-len('.data')] + '.json'):
+                try:
+                    os.unlink(filename)
+                except OSError:
+                    pass
+            total_size -= size
+
+
+class CacheEntry(object):
+
+    """A response stored in an :class:`HttpCache`."""
+
+    def __init__(self, cache, url, body, metadata):
+        """
+        Initialize a :class:`CacheEntry` object.
+
+        :param cache: The :class:`HttpCache` that contains the response.
+        :param url: The URL of the response (a string).
+        :param body: The response body (a byte string).
+        :param metadata: A dictionary with the metadata of the response.
+        """
+        self.cache = cache
+        self.url = url
+        self.body = body
+        self.metadata = metadata
+
+    @property
+    def is_fresh(self):
+        """:data:`True` if the response can be used without revalidation, :data:`False` otherwise."""
+        return time.time() - self.metadata.get('validated', 0) < self.cache.ttl
+
+    @property
+    def conditional_headers(self):
+        """A dictionary with the ``If-None-Match`` and/or ``If-Modified-Since`` headers to revalidate the response."""
+        headers = {}
+        if self.metadata.get('etag'):
+            headers['If-None-Match'] = self.metadata['etag']
+        if self.metadata.get('last_modified'):
+            headers['If-Modified-Since'] = self.metadata['last_modified']
+        return headers
+
+    def touch(self):
+        """Mark the response as recently used (for least recently used eviction)."""
+        try:
+            os.utime(self.cache.get_filename(self.url, '.data'), None)
+        except OSError:
+            pass
+
+    def revalidated(self):
+        """Record that the server confirmed (using ``304 Not Modified``) that the response is still valid."""
+        self.metadata['validated'] = time.time()
+        try:
+            write_file(self.cache.get_filename(self.url, '.json'), json.dumps(self.metadata).encode('UTF-8'))
+        except (IOError, OSError) as e:
+            logger.warning("Failed to update cache metadata! (%s)", e)
+        self.touch()
+
+
+class RankingCache(object):
+
+    """
+    On-disk cache of mirror rankings.
+
+    Each ranking is stored as a JSON file named after the SHA1 hash of its
+    key (see :func:`get_key()`), the file contains a list of dictionaries
+    (one for each mirror, in order of preference) and the time the ranking
+    was stored. The cache doesn't know anything about mirrors, converting
+    between :class:`~apt_smart.CandidateMirror` objects and dictionaries (and
+    deciding whether a ranking is too old to use) is up to the caller.
+    """
+
+    def __init__(self, directory):
+        """
+        Initialize a :class:`RankingCache` object.
+
+        :param directory: The pathname of the directory where the rankings
+                          are stored (a string, created on demand).
+        """
+        self.directory = directory
+
+    def get_key(self, **fields):
+        """
+        Get the key of a ranking.
+
+        :param fields: The values that the ranking depends on (for example
+                       the distributor, codename and architecture). Lists
+                       and sets are sorted so that the order doesn't matter.
+        :returns: A key that identifies the ranking (a string).
+        """
+        normalized = dict((name, sorted(value) if isinstance(value, (list, set, tuple)) else value)
+                          for name, value in fields.items())
+        return hashlib.sha1(json.dumps(normalized, sort_keys=True).encode('UTF-8')).hexdigest()
+
+    def get_filename(self, key, extension='.json'):
+        """Get the pathname of a file in the cache (a string)."""
+        return os.path.join(self.directory, key + extension)
+
+    def lookup(self, key):
+        """
+        Find a cached ranking.
+
+        :param key: The key of the ranking (a string).
+        :returns: A tuple of two values (or :data:`None` when there's no
+                  cached ranking):
+
+                  1. A list of dictionaries (one for each mirror).
+                  2. The age of the ranking in seconds (a number).
+        """
+        try:
+            with open(self.get_filename(key)) as handle:
+                data = json.load(handle)
+            return data['mirrors'], time.time() - data['stored']
+        except (IOError, OSError, KeyError, TypeError, ValueError):
+            return None
+
+    def store(self, key, mirrors):
+        """
+        Store a ranking in the cache.
+
+        :param key: The key of the ranking (a string).
+        :param mirrors: A list of dictionaries (one for each mirror).
+        """
+        try:
+            write_file(self.get_filename(key), json.dumps(dict(mirrors=mirrors, stored=time.time())).encode('UTF-8'))
+        except (IOError, OSError) as e:
+            logger.warning("Failed to store ranking in cache! (%s)", e)
+        else:
+            logger.debug("Stored ranking of %i mirrors in cache.", len(mirrors))
+
+    def invalidate(self, key):
+        """
+        Remove a ranking from the cache.
+
+        :param key: The key of the ranking (a string).
+        """
+        try:
+            os.unlink(self.get_filename(key))
+        except OSError:
+            pass
+
+    def refresh_in_background(self, key, function):
+        """
+        Refresh a ranking in a detached background process.
+
+        :param key: The key of the ranking (a string).
+        :param function: A callable that ranks the mirrors and stores the
+                         ranking (it's called without arguments in the
+                         background process, where it must not use the
+                         connections, locks or threads of the calling
+                         process, see :func:`~apt_smart.AptMirrorUpdater.refresh_ranking()`).
+        :returns: :data:`True` when a background process was started,
+                  :data:`False` when a refresh is already in progress (or
+                  starting one failed).
+
+        The background process is daemonized using the usual double fork, so
+        it isn't killed when the calling process exits (and it doesn't turn
+        into a zombie either). A lock file makes sure that only one refresh
+        runs at a time, a lock that's older than :data:`REFRESH_TIMEOUT`
+        is assumed to be left behind by a crashed refresh.
+        """
+        lock_file = self.get_filename(key, '.lock')
+        try:
+            if not os.path.isdir(self.directory):
+                os.makedirs(self.directory)
+            try:
+                if time.time() - os.path.getmtime(lock_file) > REFRESH_TIMEOUT:
+                    logger.debug("Removing stale lock file %s ..", lock_file)
+                    os.unlink(lock_file)
+            except OSError:
+                pass
+            os.close(os.open(lock_file, os.O_CREAT | os.O_EXCL | os.O_WRONLY))
+        except OSError:
+            logger.debug("Not refreshing ranking in background (refresh already in progress?).")
+            return False
+        try:
+            pid = os.fork()
+        except OSError as e:
+            logger.warning("Failed to refresh ranking in background! (%s)", e)
+            os.unlink(lock_file)
+            return False
+        if pid:
+            # Wait for the intermediate process (which exits right away).
+            os.waitpid(pid, 0)
+            logger.info("Refreshing ranking of mirrors in background ..")
+            return True
+        try:
+            os.setsid()
+            if os.fork():
+                os._exit(0)
+            devnull = os.open(os.devnull, os.O_RDWR)
+            for fd in (0, 1, 2):
+                os.dup2(devnull, fd)
+            try:
+                function()
+            finally:
+                os.unlink(lock_file)
+        finally:
+            os._exit(0)
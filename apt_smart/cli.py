@@ -38,12 +38,41 @@ Supported options:
   -l, --list-mirrors
 
     List available (ranked) mirrors on the terminal in a human readable format.
+    Each mirror is reported as soon as it has been tested, the ranked table
+    follows once all mirrors have been tested.
 
   -L, --url-char-len=int
 
     An integer to specify the length of chars in mirrors' URL to display when
     using --list-mirrors, default is 34
 
+  --probe-bandwidth
+
+    Measure the bandwidth of available mirrors by downloading the first
+    512 KB of a large package list (instead of estimating it based on the
+    download of a small Release file, which mostly measures latency).
+
+  --samples=COUNT
+
+    Fetch the Release file of each available mirror COUNT times (spaced out
+    and interleaved across mirrors) and rank the mirrors on the median and
+    95th percentile of the samples, so a mirror that got lucky once doesn't
+    beat a mirror that is consistently fast. The statistics are included in
+    the output of --list-mirrors.
+
+  --tournament
+
+    Rank the mirrors in rounds of increasingly expensive probes: All mirrors
+    download their Release file, the best half download 128 KB of a large
+    package list and the four fastest of those download 512 KB. This measures
+    sustained bandwidth without probing every mirror with a large download.
+
+  --adaptive-concurrency
+
+    Adjust the number of simultaneous requests while ranking mirrors based on
+    the observed throughput and timeouts, so that long lists of mirrors are
+    ranked quickly without saturating a thin uplink.
+
   -c, --change-mirror=MIRROR_URL
 
     Update /etc/apt/sources.list to use the given MIRROR_URL.
@@ -64,12 +93,63 @@ Supported options:
     Ubuntu mode for Linux Mint to deal with upstream Ubuntu mirror instead of Linux Mint mirror.
     e.g. --auto-change-mirror --ubuntu will auto-change Linux Mint's upstream Ubuntu mirror
 
+  -d, --daemon
+
+    Run as a daemon that ranks the mirrors on a schedule (every hour or as
+    configured using --ranking-ttl) and answers queries for the best mirror,
+    the ranked mirrors and the health of the current mirror over a UNIX
+    socket (/run/apt-smart.sock for root, see also --socket).
+
+  -s, --socket=PATH
+
+    The pathname of the UNIX socket of the daemon. Without --daemon this makes
+    --find-best-mirror, --list-mirrors and the other options that rank mirrors
+    use the ranking of a running daemon (answered in milliseconds), falling
+    back to ranking the mirrors when the daemon isn't running.
+
   -x, --exclude=PATTERN
 
     Add a pattern to the mirror selection blacklist. PATTERN is expected to be
     a shell pattern (containing wild cards like `?' and `*') that is matched
     against the full URL of each mirror.
 
+  --country=NAME
+
+    Prefer the mirrors in the country NAME (as it's spelled on the mirror list
+    of the distribution, e.g. Germany). By default the country is inferred from
+    the time zone or locale of the system, or looked up using a geolocation
+    service (once per network, the answer is cached for 30 days).
+
+  --no-cache
+
+    Don't use the on-disk caches. By default mirror discovery pages are reused
+    for a day and then revalidated using conditional requests (so an unchanged
+    page costs a single round trip) and the ranking of the mirrors is reused
+    for an hour.
+
+  --ranking-ttl=TIMESPAN
+
+    Reuse the cached ranking of the mirrors for TIMESPAN (e.g. 30m, 6h or 1d)
+    instead of an hour. Use 0 to always rank the mirrors again.
+
+  --stale-while-revalidate
+
+    Use the cached ranking of the mirrors even when it is older than the
+    ranking TTL, while the mirrors are ranked again in the background (so the
+    answer is immediate and the next run gets a fresh ranking).
+
+  --rate-limit=SIZE
+
+    Don't download faster than SIZE bytes per second while ranking mirrors
+    (e.g. 512K or 2M), so that ranking doesn't compete with real traffic.
+    Bandwidth probes aren't throttled (they do count against the budget).
+
+  --budget=SIZE
+
+    Don't download more than SIZE bytes in total while ranking mirrors (e.g.
+    5M). Mirrors that haven't been tested when the budget runs out are
+    considered unavailable.
+
   -v, --verbose
 
     Increase logging verbosity (can be repeated).
@@ -111,12 +191,13 @@ import os
 # External dependencies.
 import coloredlogs
 from executor.contexts import LocalContext, RemoteContext
-from humanfriendly import format_size, format_table, format_timespan
+from humanfriendly import format_size, format_table, format_timespan, parse_size, parse_timespan
 from humanfriendly.terminal import connected_to_terminal, output, usage, warning
 
 # Modules included in our package.
 from apt_smart import MAX_MIRRORS, URL_CHAR_LEN, AptMirrorUpdater
 from apt_smart import __version__ as updater_version
+from apt_smart.daemon import RankingDaemon
 
 # Initialize a logger for this module.
 logger = logging.getLogger(__name__)
@@ -137,11 +218,14 @@ def main():
     actions = []
     # Parse the command line arguments.
     try:
-        options, arguments = getopt.getopt(sys.argv[1:], 'r:fF:blL:c:auUx:m:vVR:C:qh', [
+        options, arguments = getopt.getopt(sys.argv[1:], 'r:fF:blL:c:auUds:x:m:vVR:C:qh', [
             'remote-host=', 'find-current-mirror', 'find-best-mirror', 'file-to-read=',
-            'list-mirrors', 'url-char-len=', 'change-mirror=', 'auto-change-mirror', 'update',
-            'update-package-lists', 'ubuntu', 'exclude=', 'max=', 'verbose', 'version', 'create-chroot=',
-            'codename=', 'quiet', 'help',
+            'list-mirrors', 'url-char-len=', 'probe-bandwidth', 'samples=', 'tournament', 'change-mirror=',
+            'adaptive-concurrency', 'auto-change-mirror', 'update',
+            'update-package-lists', 'ubuntu', 'daemon', 'socket=', 'exclude=', 'country=', 'max=', 'no-cache',
+            'ranking-ttl=', 'stale-while-revalidate', 'rate-limit=', 'budget=',
+            'verbose', 'version',
+            'create-chroot=', 'codename=', 'quiet', 'help',
         ])
         for option, value in options:
             if option in ('-r', '--remote-host'):
@@ -160,6 +244,14 @@ def main():
                 actions.append(functools.partial(report_available_mirrors, updater))
             elif option in ('-L', '--url-char-len'):
                 url_char_len = int(value)
+            elif option == '--probe-bandwidth':
+                updater.bandwidth_probe = True
+            elif option == '--samples':
+                updater.samples = int(value)
+            elif option == '--tournament':
+                updater.tournament = True
+            elif option == '--adaptive-concurrency':
+                updater.adaptive_concurrency = True
             elif option in ('-c', '--change-mirror'):
                 if value.strip().startswith(('http://', 'https://', 'ftp://', 'mirror://', 'mirror+file:/')):
                     actions.append(functools.partial(updater.change_mirror, value))
@@ -171,10 +263,26 @@ def main():
                 actions.append(updater.smart_update)
             elif option in ('-U', '--ubuntu'):
                 ubuntu_mode = True
+            elif option in ('-d', '--daemon'):
+                actions.append(functools.partial(run_daemon, updater))
+            elif option in ('-s', '--socket'):
+                updater.daemon_socket = value
             elif option in ('-x', '--exclude'):
                 actions.insert(0, functools.partial(updater.ignore_mirror, value))
+            elif option == '--country':
+                updater.country = value
             elif option in ('-m', '--max'):
                 limit = int(value)
+            elif option == '--no-cache':
+                updater.use_cache = False
+            elif option == '--ranking-ttl':
+                updater.ranking_cache_ttl = parse_timespan(value)
+            elif option == '--stale-while-revalidate':
+                updater.stale_while_revalidate = True
+            elif option == '--rate-limit':
+                updater.ranking_rate_limit = parse_size(value)
+            elif option == '--budget':
+                updater.ranking_budget = parse_size(value)
             elif option in ('-v', '--verbose'):
                 coloredlogs.increase_verbosity()
             elif option in ('-V', '--version'):
@@ -224,17 +332,45 @@ def report_best_mirror(updater):
     output(updater.best_mirror)
 
 
+def run_daemon(updater):
+    """Rank mirrors on a schedule and answer queries over a UNIX socket (see :class:`.RankingDaemon`)."""
+    RankingDaemon(updater, socket_path=updater.daemon_socket).serve()
+
+
 def report_available_mirrors(updater):
     """Print the available mirrors to the terminal (in a human friendly format)."""
     if connected_to_terminal() or os.getenv('TRAVIS') == 'true':  # make Travis CI test this code
         # https://docs.travis-ci.com/user/environment-variables/#default-environment-variables
+        # Report each mirror as soon as it has been tested (instead of
+        # blocking until the slowest mirror has responded or timed out).
+        for candidate in updater.iter_ranked_mirrors():
+            # Mirrors from a cached ranking weren't tested just now.
+            if not updater.ranking_source:
+                output(format_progress(candidate, candidate is updater.provisional_best_mirror))
+        if updater.ranking_source:
+            description = "cached ranking" if updater.ranking_source == 'cache' else "ranking from daemon"
+            output("Using %s (from %s ago), the mirrors weren't tested just now.",
+                   description, format_timespan(updater.ranking_age))
         have_bandwidth = any(c.bandwidth for c in updater.ranked_mirrors)
         have_last_updated = any(c.last_updated is not None for c in updater.ranked_mirrors)
+        have_timings = any(c.first_byte_time is not None for c in updater.ranked_mirrors)
+        have_tls = any(c.tls_time is not None for c in updater.ranked_mirrors)
+        have_samples = any(len(c.bandwidth_samples or []) > 1 for c in updater.ranked_mirrors)
+        have_prediction = any(c.predicted_update_time is not None for c in updater.ranked_mirrors)
         column_names = ["Rank", "Mirror URL", "Available?", "Updating?"]
         if have_last_updated:
             column_names.append("Last updated")
         if have_bandwidth:
             column_names.append("Bandwidth")
+        if have_timings:
+            column_names.extend(["DNS", "Connect"])
+            if have_tls:
+                column_names.append("TLS")
+            column_names.extend(["TTFB", "Transfer"])
+        if have_samples:
+            column_names.extend(["TTFB p50/p95", "Bandwidth p50/p95"])
+        if have_prediction:
+            column_names.append("Predicted update")
         data = []
         long_mirror_urls = {}
         if os.getenv('TRAVIS') == 'true' and updater.url_char_len < 50:
@@ -257,6 +393,19 @@ def report_available_mirrors(updater):
             if have_bandwidth:
                 row.append("%s/s" % format_size(round(candidate.bandwidth, 0))
                            if candidate.bandwidth else "Unknown")
+            if have_timings:
+                row.extend([format_duration(candidate.dns_time), format_duration(candidate.connect_time)])
+                if have_tls:
+                    row.append(format_duration(candidate.tls_time))
+                row.extend([format_duration(candidate.first_byte_time), format_duration(candidate.transfer_time)])
+            if have_samples:
+                row.append("%s / %s" % (format_duration(candidate.median_latency),
+                                        format_duration(candidate.p95_latency)))
+                row.append("%s / %s" % (format_bandwidth(candidate.median_bandwidth),
+                                        format_bandwidth(candidate.p95_bandwidth)))
+            if have_prediction:
+                row.append(format_timespan(candidate.predicted_update_time)
+                           if candidate.predicted_update_time is not None else "-")
             data.append(row)
         output(format_table(data, column_names=column_names))
         if long_mirror_urls:
@@ -268,3 +417,48 @@ def report_available_mirrors(updater):
             candidate.mirror_url for candidate in updater.ranked_mirrors
             if candidate.is_available and not candidate.is_updating
         ))
+
+
+def format_bandwidth(bandwidth):
+    """
+    Format a bandwidth sample statistic for :func:`report_available_mirrors()`.
+
+    :param bandwidth: The bandwidth in bytes per second (a number or :data:`None`).
+    :returns: The bandwidth (a string like ``1.2 MB/s``) or ``-`` when the
+              bandwidth is unknown.
+    """
+    return "%s/s" % format_size(round(bandwidth, 0)) if bandwidth is not None else "-"
+
+
+def format_duration(seconds):
+    """
+    Format the duration of a request phase for :func:`report_available_mirrors()`.
+
+    :param seconds: The duration in seconds (a number or :data:`None`).
+    :returns: The duration in milliseconds (a string like ``23 ms``) or
+              ``-`` when the duration is unknown or doesn't apply.
+    """
+    return "%i ms" % round(seconds * 1000) if seconds is not None else "-"
+
+
+def format_progress(candidate, is_best=False):
+    """
+    Format a line of progressive output for :func:`report_available_mirrors()`.
+
+    :param candidate: A :class:`.CandidateMirror` object that was just tested.
+    :param is_best: :data:`True` if `candidate` is the best mirror so far.
+    :returns: A string like ``Tested http://... (available, up to date, 1.2 MB/s)``.
+    """
+    if candidate.is_available:
+        details = ["available"]
+        if candidate.last_updated == 0:
+            details.append("up to date")
+        elif candidate.last_updated:
+            details.append("%s behind" % format_timespan(candidate.last_updated, max_units=1))
+        if candidate.bandwidth:
+            details.append("%s/s" % format_size(round(candidate.bandwidth, 0)))
+        if is_best:
+            details.append("best so far")
+    else:
+        details = ["unavailable"]
+    return "Tested %s (%s)" % (candidate.mirror_url, ", ".join(details))
@@ -0,0 +1,291 @@
+# Automated, robust apt-get mirror selection for Debian and Ubuntu.
+#
+# Author: martin68 and Peter Odding
+# Last Change: October 16, 2026
+# URL: https://apt-smart.readthedocs.io
+
+"""
+Long running mirror ranking daemon for `apt-smart`.
+
+Every run of `apt-smart` starts cold: Mirrors are discovered, probed and
+ranked before the first answer is available. The :class:`RankingDaemon`
+class ranks the mirrors on a schedule (keeping the connection pool, DNS
+cache and performance history in memory between rankings) and answers
+queries over a UNIX socket, so provisioning scripts and ``apt`` hooks get an
+answer in milliseconds. The :class:`DaemonClient` class is used by
+:class:`~apt_smart.AptMirrorUpdater` to query the daemon (see
+:attr:`~apt_smart.AptMirrorUpdater.daemon_socket`).
+
+The protocol is line based: The client sends a JSON object with a ``query``
+key and the daemon responds with a JSON object that contains either a
+``result`` or an ``error`` key. The following queries are supported:
+
+``best_mirror``
+ The URL of the best mirror.
+
+``ranked_mirrors``
+ The ranked mirrors (a list of dictionaries), the parameters that the
+ ranking depends on (see :attr:`~apt_smart.AptMirrorUpdater.ranking_parameters`)
+ and the age of the ranking in seconds.
+
+``current_mirror``
+ The URL of the mirror that the system currently uses and whether it's
+ healthy (available and not being updated according to the last ranking).
+"""
+
+# Standard library modules.
+import json
+import logging
+import os
+import socket
+import threading
+import time
+
+# External dependencies.
+from humanfriendly import Timer, format_timespan
+from six.moves import socketserver
+
+# Modules included in our package.
+from apt_smart.http import Resolver
+
+DAEMON_TIMEOUT = 5
+"""The number of seconds that :class:`DaemonClient` waits for a response (a number)."""
+
+RETRY_INTERVAL = 60
+"""The number of seconds after which :class:`RankingDaemon` retries a ranking that failed (a number)."""
+
+SYSTEM_SOCKET_PATH = '/run/apt-smart.sock'
+"""
+The pathname of the UNIX socket of the system wide ranking daemon (a string).
+
+This socket is accessible to all users (mode 0666), the sockets of per user
+daemons only to their owner (mode 0600).
+"""
+
+# Initialize a logger for this module.
+logger = logging.getLogger(__name__)
+
+
+def get_socket_path():
+    """
+    Get the default pathname of the UNIX socket of the ranking daemon.
+
+    :returns: The pathname of ``/run/apt-smart.sock`` for root and
+              ``$XDG_RUNTIME_DIR/apt-smart.sock`` (which defaults to
+              ``~/.cache/apt-smart/daemon.sock``) for other users (a string).
+    """
+    if os.getuid() == 0:
+        return SYSTEM_SOCKET_PATH
+    if os.environ.get('XDG_RUNTIME_DIR'):
+        return os.path.join(os.environ['XDG_RUNTIME_DIR'], 'apt-smart.sock')
+    return os.path.expanduser('~/.cache/apt-smart/daemon.sock')
+
+
+class RankingDaemon(socketserver.ThreadingMixIn, socketserver.UnixStreamServer):
+
+    """
+    Rank mirrors on a schedule and answer queries over a UNIX socket.
+
+    The mirrors are ranked again every
+    :attr:`~apt_smart.AptMirrorUpdater.ranking_cache_ttl` seconds in a
+    background thread, queries are answered from the last ranking while the
+    next one is in progress.
+    """
+
+    daemon_threads = True
+
+    def __init__(self, updater, socket_path=None, interval=None):
+        """
+        Initialize a :class:`RankingDaemon` object.
+
+        :param updater: The :class:`~apt_smart.AptMirrorUpdater` object
+                        used to rank the mirrors.
+        :param socket_path: The pathname of the UNIX socket (a string,
+                            defaults to the value of :func:`get_socket_path()`).
+        :param interval: The number of seconds between rankings (a number,
+                         defaults to :attr:`~apt_smart.AptMirrorUpdater.ranking_cache_ttl`).
+        :raises: :exc:`DaemonError` when another daemon is already
+                 listening on the socket.
+        """
+        self.updater = updater
+        # The daemon shouldn't ask itself for a ranking.
+        self.updater.daemon_socket = None
+        self.socket_path = socket_path or get_socket_path()
+        self.interval = interval if interval is not None else updater.ranking_cache_ttl
+        self.lock = threading.Lock()
+        self.ranked = threading.Event()
+        self.stopped = threading.Event()
+        self.ranking = None
+        self.ranked_at = None
+        directory = os.path.dirname(self.socket_path)
+        if not os.path.isdir(directory):
+            os.makedirs(directory)
+        if os.path.exists(self.socket_path):
+            # Don't take over the socket of a daemon that's still running.
+            probe = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+            try:
+                probe.connect(self.socket_path)
+            except socket.error:
+                logger.debug("Removing stale socket %s ..", self.socket_path)
+                os.unlink(self.socket_path)
+            else:
+                raise DaemonError("Another daemon is already listening on %s!" % self.socket_path)
+            finally:
+                probe.close()
+        socketserver.UnixStreamServer.__init__(self, self.socket_path, DaemonRequestHandler)
+        os.chmod(self.socket_path, 0o666 if self.socket_path == SYSTEM_SOCKET_PATH else 0o600)
+
+    def answer(self, request):
+        """
+        Answer a query.
+
+        :param request: The decoded request (a dictionary).
+        :returns: The result of the query (a JSON serializable value).
+        :raises: :exc:`DaemonError` when the query is unknown or there is
+                 no ranking yet.
+        """
+        query = request.get('query')
+        with self.lock:
+            ranking, ranked_at = self.ranking, self.ranked_at
+        if query == 'ping':
+            return dict(ranked=ranking is not None)
+        if ranking is None:
+            raise DaemonError("The mirrors haven't been ranked yet!")
+        if query == 'best_mirror':
+            return ranking['mirrors'][0]['mirror_url']
+        elif query == 'ranked_mirrors':
+            return dict(ranking, age=time.time() - ranked_at)
+        elif query == 'current_mirror':
+            mirror_url = ranking['current_mirror']
+            healthy = any(m['mirror_url'] == mirror_url and m['is_available'] and not m['is_updating']
+                          for m in ranking['mirrors'])
+            return dict(mirror_url=mirror_url, healthy=healthy)
+        raise DaemonError("Unsupported query! (%r)" % query)
+
+    def refresh(self):
+        """Rank the mirrors and make the new ranking available to clients."""
+        timer = Timer()
+        updater = self.updater
+        # Forget the previous ranking (and the discovered mirrors and country).
+        del updater.available_mirrors
+        del updater.best_mirror
+        del updater.ranked_mirrors
+        del updater.resolved_country
+        del updater.stable_mirror
+        # Forget the resolved host names, the daemon runs for much longer
+        # than the lifetime of DNS records (and temporary failures).
+        updater.connection_pool.resolver = Resolver()
+        for candidate in updater.iter_ranked_mirrors(cached=False):
+            pass
+        try:
+            current_mirror = updater.current_mirror
+        except Exception as e:
+            logger.warning("Failed to determine current mirror! (%s)", e)
+            current_mirror = None
+        ranking = dict(
+            parameters=updater.ranking_parameters,
+            mirrors=updater.export_mirrors(updater.ranked_mirrors),
+            current_mirror=current_mirror,
+        )
+        with self.lock:
+            self.ranking = ranking
+            self.ranked_at = time.time()
+        self.ranked.set()
+        logger.info("Ranked %i mirrors (took %s), ranking again in %s.",
+                    len(ranking['mirrors']), timer, format_timespan(self.interval))
+
+    def run_scheduler(self):
+        """Rank the mirrors every :attr:`interval` seconds (until :func:`shutdown()` is called)."""
+        while not self.stopped.is_set():
+            try:
+                self.refresh()
+                delay = self.interval
+            except Exception:
+                logger.exception("Failed to rank mirrors, retrying in %s ..", format_timespan(RETRY_INTERVAL))
+                delay = min(self.interval, RETRY_INTERVAL)
+            self.stopped.wait(delay)
+
+    def serve(self):
+        """Start the scheduler and answer queries until :func:`shutdown()` is called (or the process is killed)."""
+        logger.info("Answering queries on %s ..", self.socket_path)
+        scheduler = threading.Thread(target=self.run_scheduler)
+        scheduler.daemon = True
+        scheduler.start()
+        try:
+            self.serve_forever()
+        finally:
+            self.stopped.set()
+            self.server_close()
+            try:
+                os.unlink(self.socket_path)
+            except OSError:
+                pass
+
+    def shutdown(self):
+        """Stop the scheduler and the server."""
+        self.stopped.set()
+        socketserver.UnixStreamServer.shutdown(self)
+
+
+class DaemonRequestHandler(socketserver.StreamRequestHandler):
+
+    """Request handler for :class:`RankingDaemon`."""
+
+    def handle(self):
+        """Answer the queries sent over the connection (one JSON object per line)."""
+        for line in iter(self.rfile.readline, b''):
+            try:
+                response = dict(result=self.server.answer(json.loads(line.decode('UTF-8'))))
+            except Exception as e:
+                response = dict(error=str(e))
+            self.wfile.write(json.dumps(response).encode('UTF-8') + b'\n')
+            self.wfile.flush()
+
+
+class DaemonClient(object):
+
+    """Query a :class:`RankingDaemon` over its UNIX socket."""
+
+    def __init__(self, socket_path=None, timeout=DAEMON_TIMEOUT):
+        """
+        Initialize a :class:`DaemonClient` object.
+
+        :param socket_path: The pathname of the UNIX socket (a string,
+                            defaults to the value of :func:`get_socket_path()`).
+        :param timeout: The number of seconds to wait for a response (a
+                        number, defaults to :data:`DAEMON_TIMEOUT`).
+        """
+        self.socket_path = socket_path or get_socket_path()
+        self.timeout = timeout
+
+    def query(self, query):
+        """
+        Send a query to the daemon.
+
+        :param query: The name of the query (a string, see :mod:`apt_smart.daemon`).
+        :returns: The result of the query.
+        :raises: :exc:`DaemonError` when the daemon responds with an error,
+                 :exc:`~socket.error` when the daemon can't be reached.
+        """
+        connection = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        try:
+            connection.settimeout(self.timeout)
+            connection.connect(self.socket_path)
+            handle = connection.makefile('rwb')
+            handle.write(json.dumps(dict(query=query)).encode('UTF-8') + b'\n')
+            handle.flush()
+            line = handle.readline()
+            handle.close()
+        finally:
+            connection.close()
+        if not line:
+            raise DaemonError("Daemon closed connection without responding!")
+        response = json.loads(line.decode('UTF-8'))
+        if 'error' in response:
+            raise DaemonError(response['error'])
+        return response['result']
+
+
+class DaemonError(Exception):
+
+    """Raised by :class:`DaemonClient` when the daemon can't answer a query."""
@@ -0,0 +1,349 @@
+# Automated, robust apt-get mirror selection for Debian and Ubuntu.
+#
+# Author: martin68 and Peter Odding
+# Last Change: October 16, 2026
+# URL: https://apt-smart.readthedocs.io
+
+"""
+Tracking the health of mirrors across runs of `apt-smart`.
+
+The mirror lists of Debian, Ubuntu and Linux Mint contain mirrors that have
+been dead for a long time. Without any memory of previous runs each of them
+costs a full timeout on every run (and every time the mirrors are ranked
+again after :func:`~apt_smart.AptMirrorUpdater.ignore_mirror()`). The
+:class:`CircuitBreaker` class remembers which mirror hosts keep failing so
+that they can be skipped for a while.
+
+A single probe per mirror is also a noisy basis for a ranking. The
+:class:`MirrorHistory` class records the outcome of every probe in an SQLite
+database and maintains exponentially weighted moving averages (EWMA) of the
+performance of each mirror, which are used to order the probes and to rank
+the mirrors.
+"""
+
+# Standard library modules.
+import collections
+import json
+import logging
+import os
+import sqlite3
+import time
+
+# External dependencies.
+from humanfriendly import format_timespan
+
+# Modules included in our package.
+from apt_smart.cache import write_file
+
+FAILURE_THRESHOLD = 3
+"""The number of consecutive failures after which a mirror host is skipped (an integer)."""
+
+INITIAL_COOLDOWN = 60 * 60
+"""The number of seconds that a mirror host is skipped after it first reaches :data:`FAILURE_THRESHOLD` (a number)."""
+
+MAX_COOLDOWN = 60 * 60 * 24 * 7
+"""The maximum number of seconds that a mirror host is skipped (a number)."""
+
+HALF_OPEN_TIMEOUT = 60 * 10
+"""The number of seconds after which an unanswered half-open probe no longer blocks other probes (a number)."""
+
+HISTORY_ALPHA = 0.3
+"""The weight of the most recent sample in the moving averages of :class:`MirrorHistory` (a number)."""
+
+HISTORY_MAX_AGE = 60 * 60 * 24 * 90
+"""The number of seconds that :class:`MirrorHistory` keeps individual samples (a number)."""
+
+MirrorEstimate = collections.namedtuple('MirrorEstimate', 'availability, latency, bandwidth, last_updated, samples')
+"""
+The smoothed performance of a mirror (a :func:`~collections.namedtuple()`).
+
+The fields are the fraction of recent probes that succeeded (a number
+between 0 and 1), the exponentially weighted moving averages of the latency
+(in seconds), the bandwidth (in bytes per second) and the freshness lag (in
+seconds, see :attr:`~apt_smart.CandidateMirror.last_updated`) and the
+number of samples (an integer). Averages without samples are :data:`None`.
+"""
+
+# Initialize a logger for this module.
+logger = logging.getLogger(__name__)
+
+
+class CircuitBreaker(object):
+
+    """
+    Per host circuit breaker for mirrors that keep failing.
+
+    Each mirror host goes through three states:
+
+    closed
+     The host is probed normally. Consecutive failures are counted and once
+     there have been :attr:`threshold` of them the circuit opens.
+
+    open
+     The host is skipped until its cool-down has passed. The first cool-down
+     lasts :attr:`cooldown` seconds and it doubles every time the host fails
+     again (up to :attr:`max_cooldown` seconds).
+
+    half-open
+     Once the cool-down has passed the host is probed once more (this
+     :class:`CircuitBreaker` refuses other probes of the host until the
+     outcome of that probe has been recorded, or :data:`HALF_OPEN_TIMEOUT`
+     seconds have passed). When that probe succeeds the circuit closes
+     again, otherwise it reopens with a longer cool-down.
+
+    The state is stored in a JSON file so that it persists across runs. The
+    half-open probes in progress are only tracked in memory, so concurrent
+    runs can each send a half-open probe to the same host.
+    """
+
+    def __init__(self, filename=None, threshold=FAILURE_THRESHOLD, cooldown=INITIAL_COOLDOWN,
+                 max_cooldown=MAX_COOLDOWN):
+        """
+        Initialize a :class:`CircuitBreaker` object.
+
+        :param filename: The pathname of the JSON file that stores the state
+                         (a string or :data:`None` to keep the state in
+                         memory only).
+        :param threshold: The number of consecutive failures that open the
+                          circuit (an integer, defaults to :data:`FAILURE_THRESHOLD`).
+        :param cooldown: The initial cool-down in seconds (a number, defaults
+                         to :data:`INITIAL_COOLDOWN`).
+        :param max_cooldown: The maximum cool-down in seconds (a number,
+                             defaults to :data:`MAX_COOLDOWN`).
+        """
+        self.filename = filename
+        self.threshold = threshold
+        self.cooldown = cooldown
+        self.max_cooldown = max_cooldown
+        self.hosts = self.load()
+        self.probing = {}
+
+    def load(self):
+        """
+        Load the state from :attr:`filename`.
+
+        :returns: A dictionary that maps host names to dictionaries with the
+                  keys ``failures``, ``opened`` and ``cooldown``.
+        """
+        if self.filename:
+            try:
+                with open(self.filename) as handle:
+                    state = json.load(handle)
+                if isinstance(state, dict):
+                    return state
+            except (IOError, OSError, ValueError):
+                pass
+        return {}
+
+    def save(self):
+        """Store the state in :attr:`filename` (if set)."""
+        if self.filename:
+            try:
+                write_file(self.filename, json.dumps(self.hosts, indent=2, sort_keys=True).encode('UTF-8'))
+            except (IOError, OSError) as e:
+                logger.warning("Failed to save circuit breaker state! (%s)", e)
+
+    def allow(self, host):
+        """
+        Check whether a mirror host should be probed.
+
+        :param host: The host name of the mirror (a string).
+        :returns: :data:`False` while the circuit of the host is open (or
+                  its half-open probe is in progress), :data:`True` otherwise
+                  (including the one half-open probe).
+        """
+        state = self.hosts.get(host)
+        if state and state.get('opened'):
+            remaining = state['opened'] + state['cooldown'] - time.time()
+            if remaining > 0:
+                logger.debug("Skipping %s for another %s (failed %i times in a row).",
+                             host, format_timespan(remaining), state['failures'])
+                return False
+            if time.time() - self.probing.get(host, 0) < HALF_OPEN_TIMEOUT:
+                logger.debug("Skipping %s (half-open probe in progress).", host)
+                return False
+            logger.debug("Cool-down of %s has passed, probing it again.", host)
+            self.probing[host] = time.time()
+        return True
+
+    def record_success(self, host):
+        """
+        Close the circuit of a mirror host.
+
+        :param host: The host name of the mirror (a string).
+        """
+        self.probing.pop(host, None)
+        if self.hosts.pop(host, None):
+            logger.debug("Mirror %s is healthy again.", host)
+
+    def record_failure(self, host):
+        """
+        Count a failure of a mirror host, opening its circuit when necessary.
+
+        :param host: The host name of the mirror (a string).
+        """
+        self.probing.pop(host, None)
+        state = self.hosts.setdefault(host, dict(failures=0, opened=None, cooldown=0))
+        state['failures'] += 1
+        if state['opened']:
+            # The half-open probe failed.
+            state['cooldown'] = min(self.max_cooldown, state['cooldown'] * 2)
+        elif state['failures'] >= self.threshold:
+            state['cooldown'] = self.cooldown
+        else:
+            return
+        state['opened'] = time.time()
+        logger.debug("Skipping %s for %s (failed %i times in a row).",
+                     host, format_timespan(state['cooldown']), state['failures'])
+
+
+class MirrorHistory(object):
+
+    """
+    Per mirror performance history with exponentially weighted estimates.
+
+    Every probe of a mirror is stored as a sample (its availability, latency,
+    bandwidth and freshness lag) and folded into an exponentially weighted
+    moving average, so recent runs count most while a single slow response
+    doesn't overturn the ranking. Failed probes only affect the availability
+    estimate. Samples older than :data:`HISTORY_MAX_AGE` are pruned, the
+    estimates are kept.
+    """
+
+    def __init__(self, filename=None, alpha=HISTORY_ALPHA):
+        """
+        Initialize a :class:`MirrorHistory` object.
+
+        :param filename: The pathname of the SQLite database (a string or
+                         :data:`None` to keep the history in memory only).
+        :param alpha: The weight of the most recent sample (a number between
+                      0 and 1, defaults to :data:`HISTORY_ALPHA`).
+        """
+        self.filename = filename
+        self.alpha = alpha
+        self.connection = self.connect()
+
+    def connect(self):
+        """
+        Open the database (creating it when necessary).
+
+        :returns: A :class:`sqlite3.Connection` object.
+
+        When the database can't be opened a warning is logged and an in
+        memory database is used instead.
+        """
+        if self.filename:
+            try:
+                directory = os.path.dirname(self.filename)
+                if not os.path.isdir(directory):
+                    os.makedirs(directory)
+                return self.initialize(sqlite3.connect(self.filename, timeout=10))
+            except (IOError, OSError, sqlite3.Error) as e:
+                logger.warning("Failed to open mirror history database! (%s)", e)
+        return self.initialize(sqlite3.connect(':memory:'))
+
+    def initialize(self, connection):
+        """Create the tables of the database (if they don't exist yet) and return the connection."""
+        connection.executescript('''
+            create table if not exists samples (
+                mirror_url text not null,
+                time real not null,
+                available integer not null,
+                latency real,
+                bandwidth real,
+                last_updated real
+            );
+            create index if not exists samples_by_time on samples (time);
+            create table if not exists estimates (
+                mirror_url text primary key,
+                availability real not null,
+                latency real,
+                bandwidth real,
+                last_updated real,
+                samples integer not null
+            );
+        ''')
+        return connection
+
+    def estimate(self, mirror_url):
+        """
+        Get the smoothed performance of a mirror.
+
+        :param mirror_url: The base URL of the mirror (a string).
+        :returns: A :class:`MirrorEstimate` object or :data:`None` when the
+                  mirror has never been probed.
+        """
+        row = self.connection.execute('''
+            select availability, latency, bandwidth, last_updated, samples
+            from estimates where mirror_url = ?
+        ''', (mirror_url,)).fetchone()
+        return MirrorEstimate(*row) if row else None
+
+    def record(self, mirror_url, available, latency=None, bandwidth=None, last_updated=None):
+        """
+        Record the outcome of probing a mirror.
+
+        :param mirror_url: The base URL of the mirror (a string).
+        :param available: :data:`True` if the probe succeeded, :data:`False` otherwise.
+        :param latency: The latency in seconds (a number or :data:`None`).
+        :param bandwidth: The bandwidth in bytes per second (a number or
+                          :data:`None`). All samples of a mirror should be
+                          measured the same way (apt-smart records the
+                          bandwidth of the ``Release`` file fetch, never
+                          that of bandwidth probes) because they're averaged.
+        :param last_updated: The freshness lag in seconds (a number or :data:`None`).
+        :returns: The updated :class:`MirrorEstimate` object (or :data:`None`
+                  when the database couldn't be updated).
+        """
+        try:
+            self.connection.execute('''
+                insert into samples (mirror_url, time, available, latency, bandwidth, last_updated)
+                values (?, ?, ?, ?, ?, ?)
+            ''', (mirror_url, time.time(), int(bool(available)), latency, bandwidth, last_updated))
+            previous = self.estimate(mirror_url)
+            if previous:
+                estimate = MirrorEstimate(
+                    availability=self.smooth(previous.availability, 1.0 if available else 0.0),
+                    latency=self.smooth(previous.latency, latency),
+                    bandwidth=self.smooth(previous.bandwidth, bandwidth),
+                    last_updated=self.smooth(previous.last_updated, last_updated),
+                    samples=previous.samples + 1,
+                )
+            else:
+                estimate = MirrorEstimate(
+                    availability=1.0 if available else 0.0,
+                    latency=latency,
+                    bandwidth=bandwidth,
+                    last_updated=last_updated,
+                    samples=1,
+                )
+            self.connection.execute('''
+                insert or replace into estimates (mirror_url, availability, latency, bandwidth, last_updated, samples)
+                values (?, ?, ?, ?, ?, ?)
+            ''', (mirror_url,) + tuple(estimate))
+        except sqlite3.Error as e:
+            logger.warning("Failed to record mirror history! (%s)", e)
+            return None
+        return estimate
+
+    def smooth(self, average, value):
+        """
+        Fold a sample into an exponentially weighted moving average.
+
+        :param average: The current average (a number or :data:`None`).
+        :param value: The new sample (a number or :data:`None`).
+        :returns: The new average (a number or :data:`None`).
+        """
+        if value is None:
+            return average
+        if average is None:
+            return value
+        return self.alpha * value + (1 - self.alpha) * average
+
+    def save(self):
+        """Prune old samples and commit the changes to the database."""
+        try:
+            self.connection.execute('delete from samples where time < ?', (time.time() - HISTORY_MAX_AGE,))
+            self.connection.commit()
+        except sqlite3.Error as e:
+            logger.warning("Failed to save mirror history! (%s)", e)
@@ -7,83 +7,785 @@
 """Simple, robust and concurrent HTTP requests (designed for one very narrow use case)."""
 
 # Standard library modules.
+import calendar
+import collections
+import contextlib
+import email.utils
+import functools
+import hashlib
 import logging
 import multiprocessing
+import multiprocessing.pool
+import resource
 import signal
+import socket
+import ssl
+import threading
+import time
+import zlib
 
 # External dependencies.
-from humanfriendly import Timer, format_size
-from six.moves.urllib.request import urlopen
-from stopit import SignalTimeout  # , TimeoutException
+from humanfriendly import Timer, format_size, format_timespan
+from six.moves import http_client, queue
+from six.moves.urllib.error import HTTPError
+from six.moves.urllib.parse import urljoin, urlparse
+from six.moves.urllib.request import Request, getproxies, proxy_bypass, urlopen
+from stopit import SignalTimeout, TimeoutException
+
+ACCEPT_ENCODING = 'gzip, deflate'
+"""
+The value of the ``Accept-Encoding`` header sent by :func:`fetch_url()` (a string).
+
+Both encodings are decompressed incrementally using :mod:`zlib` (see
+:func:`read_body()`).
+"""
+
+ADAPTIVE_INCREASE = 2
+"""The number of requests by which :class:`AdaptiveConcurrency` raises the limit after a healthy round (an integer)."""
+
+ADAPTIVE_MAX_CONCURRENCY = 256
+"""The highest number of simultaneous requests that :class:`AdaptiveConcurrency` will allow (an integer)."""
+
+ADAPTIVE_MAX_TIMEOUT_RATE = 0.1
+"""The fraction of requests per round that may time out before :class:`AdaptiveConcurrency` backs off (a number)."""
+
+ADAPTIVE_MIN_CONCURRENCY = 2
+"""The lowest number of simultaneous requests that :class:`AdaptiveConcurrency` will back off to (an integer)."""
+
+ADAPTIVE_TIMEOUT_THRESHOLD = 8
+"""
+The duration in seconds after which a failed request is counted as a timeout by :class:`AdaptiveConcurrency` (a number).
+
+The workers of :func:`fetch_concurrent()` don't report why a request failed,
+but a request that fails quickly (for example with a 404 or a refused
+connection) says nothing about congestion whereas one that fails after most
+of the (default 10 second) timeout has passed does.
+"""
+
+ENGINE_PROCESSES = 'processes'
+"""The name of the :func:`fetch_concurrent()` engine that uses :mod:`multiprocessing` (a string)."""
+
+ENGINE_THREADS = 'threads'
+"""The name of the :func:`fetch_concurrent()` engine that uses a thread pool (a string)."""
+
+DEFAULT_ENGINE = ENGINE_THREADS
+"""
+The engine used by :func:`fetch_concurrent()` when none is given (a string).
+
+Fetching mirrors is I/O bound work so threads are a lot cheaper than forking
+worker processes and pickling the responses back to the parent process.
+"""
+
+BANDWIDTH_CHUNK_SIZE = 1024 * 64
+"""The number of bytes read at a time by :func:`probe_bandwidth()` (an integer)."""
+
+BANDWIDTH_PROBE_SIZE = 1024 * 512
+"""The default number of bytes downloaded by :func:`probe_bandwidth()` (an integer)."""
+
+HEDGE_DEFAULT_DELAY = 1
+"""The hedging delay in seconds used until :data:`HEDGE_MIN_SAMPLES` latencies have been observed (a number)."""
+
+HEDGE_MIN_DELAY = 0.2
+"""The lowest hedging delay in seconds (a number)."""
+
+HEDGE_MIN_SAMPLES = 5
+"""The number of latencies needed before the hedging delay is based on :data:`HEDGE_PERCENTILE` (an integer)."""
+
+HEDGE_PERCENTILE = 95
+"""
+The percentile of the observed time to first byte after which :func:`fetch_url()` sends a hedged request (a number).
+
+Sending a duplicate request when the first one takes longer than 95% of the
+requests seen so far costs at most a few percent of extra requests while
+cutting off the tail latency of the slowest requests.
+"""
+
+HEAD_FALLBACK_STATUSES = (400, 403, 405, 501)
+"""
+The status codes that make :func:`url_exists()` retry a ``HEAD`` request using ``GET`` (a tuple of integers).
+
+Some servers don't implement ``HEAD`` (405 Method Not Allowed, 501 Not
+Implemented) or reject it outright (400, 403) even though ``GET`` works.
+"""
+
+MAX_DRAIN_SIZE = 1024 * 64
+"""The maximum number of unread bytes that :func:`Response.close()` drains to keep a connection alive (an integer)."""
+
+MAX_PROBE_SIZE = 1024 * 1024
+"""
+The maximum size in bytes of the responses to mirror probes (an integer).
+
+``Release`` files are (at the time of writing) a few hundred kilobytes at
+most, anything bigger than this can't be a valid response.
+"""
+
+MAX_REDIRECTS = 5
+"""The maximum number of redirects followed by :class:`ConnectionPool` (an integer)."""
+
+REDIRECT_STATUSES = (301, 302, 303, 307, 308)
+"""The HTTP status codes that are treated as redirects (a tuple of integers)."""
+
+READ_CHUNK_SIZE = 1024 * 16
+"""The number of bytes read at a time by :func:`read_body()` (an integer)."""
+
+RESOLVER_ATTEMPTS = 2
+"""The number of times :func:`Resolver.lookup()` tries to resolve a host name that fails temporarily (an integer)."""
+
+RESOLVER_CONCURRENCY = 32
+"""The maximum number of host names resolved simultaneously by :func:`Resolver.prefetch()` (an integer)."""
+
+SNIFF_SIZE = 1024 * 4
+"""The number of bytes passed to the `validate` callback of :func:`read_body()` (an integer)."""
+
+TIMING_PHASES = ('dns', 'connect', 'tls', 'ttfb', 'transfer')
+"""
+The phases of a request whose duration is recorded in :attr:`Response.timings` (a tuple of strings).
+
+- ``dns``: Resolving the host name.
+- ``connect``: Establishing the TCP connection.
+- ``tls``: The TLS handshake (:data:`None` for plain HTTP).
+- ``ttfb``: Sending the request until the response headers have been received
+  (the time to first byte).
+- ``transfer``: Receiving the response body.
+
+The ``dns``, ``connect`` and ``tls`` phases are zero when a keep-alive
+connection is reused and :data:`None` when they can't be measured (for
+example because the request was sent through a proxy).
+"""
+
+INDEX_COMPRESSION_EXTENSIONS = ('.xz', '.gz', '.bz2', '')
+"""The file name extensions of compressed index files in order of preference of ``apt-get`` (a tuple of strings)."""
+
+ProbeDigest = collections.namedtuple('ProbeDigest', 'status, size, date, sha256, elapsed_time, timings, body, '
+                                                    'index_count, index_size')
+"""
+A compact summary of a mirror probe returned by :func:`digest_worker()`.
+
+The fields are the HTTP status code, the size of the response body in bytes,
+the ``Date:`` of the ``Release`` file as a Unix timestamp (see
+:func:`parse_release_date()`, :data:`None` when missing), the SHA256 hex
+digest of the body, the number of seconds the request took, a dictionary
+with the durations of the :data:`TIMING_PHASES`, the body itself (only
+when it was requested, :data:`None` otherwise) and the number and total size
+of the index files listed in the ``Release`` file that ``apt-get update``
+would download (see :func:`parse_index_sizes()`, :data:`None` when no index
+files were requested).
+"""
 
 # Initialize a logger for this module.
 logger = logging.getLogger(__name__)
 
+# The time to first byte of recent requests to each host, used to compute the hedging delay.
+latency_history = {}
+
 # Stop the `stopit' logger from logging tracebacks.
 logging.getLogger('stopit').setLevel(logging.ERROR)
 
 
-def fetch_url(url, timeout=10, retry=False, max_attempts=3):
+def fetch_url(url, timeout=10, retry=False, max_attempts=3, pool=None, cache=None, timings=None,
+              max_size=None, validate=None, compressed=True, hedge=False, alternates=None, parser=None):
     """
     Fetch a URL, optionally retrying on failure.
 
     :param url: The URL to fetch (a string).
     :param timeout: The maximum time in seconds that's allowed to pass before
                     the request is aborted (a number, defaults to 10 seconds).
+                    This is used as the socket level connect and read timeout
+                    and (in the main thread only) as an overall deadline.
     :param retry: Whether to retry on failure (defaults to :data:`False`).
     :param max_attempts: The maximum number of attempts when retrying is
                          enabled (an integer, defaults to three).
-    :returns: The response body (a byte string).
+    :param pool: A :class:`ConnectionPool` object whose keep-alive
+                 connections should be used (defaults to :data:`None`
+                 which means a new connection is opened).
+    :param cache: A :class:`~apt_smart.cache.HttpCache` object (defaults to
+                  :data:`None` which means no cache is used). Fresh cached
+                  responses are returned without any network traffic, stale
+                  ones are revalidated using a conditional request and
+                  (when the URL can't be fetched) used as a last resort.
+    :param timings: A dictionary that is updated with the durations of the
+                    :data:`TIMING_PHASES` of the (last) request (optional).
+    :param max_size: The maximum size of the response body in bytes (an
+                     integer, defaults to :data:`None` which means no limit).
+    :param validate: A callable that's given the first :data:`SNIFF_SIZE`
+                     bytes of the response body and returns :data:`False`
+                     when the download should be aborted because the body
+                     can't be valid (defaults to :data:`None`).
+    :param compressed: :data:`True` to ask the server for a compressed
+                       response (see :data:`ACCEPT_ENCODING`), :data:`False`
+                       to transfer the raw bytes (so that the duration of the
+                       request says something about the bandwidth).
+    :param hedge: :data:`True` to send a duplicate request when the first
+                  one is slow instead of waiting for it to time out before
+                  retrying (see :func:`fetch_hedged()`). This implies
+                  `retry`, `max_attempts` bounds the total number of
+                  requests and `timeout` is enforced as an overall deadline
+                  in any thread.
+    :param alternates: A list of alternate URLs with the same content that
+                       hedged requests are sent to (optional).
+    :param parser: A callable that creates an incremental parser (an object
+                   with the methods ``feed()`` and ``close()``, see
+                   :class:`~apt_smart.tables.TableParser`). Every attempt
+                   creates a new parser and feeds it the response body as
+                   it arrives. When ``feed()`` returns :data:`True` the
+                   parser has seen enough (and ignores further data) and
+                   the rest of the response body isn't downloaded, unless
+                   `cache` is given: Then the rest of the body is still
+                   downloaded (but not parsed) so that the complete
+                   response can be cached and revalidated by later runs.
+    :returns: The response body (a byte string, decompressed if necessary)
+              or the parser created by `parser` (after it was given the
+              response body).
     :raises: Any of the following exceptions can be raised:
 
              - :exc:`NotFoundError` when the URL returns a 404 status code.
              - :exc:`InvalidResponseError` when the URL returns a status code
-               that isn't 200.
+               that isn't 200 or the response body is rejected by `validate`.
+             - :exc:`ResponseTooLargeError` when the response body is larger
+               than `max_size`.
+             - :exc:`socket.timeout` when connecting to the server or reading
+               from the connection stalls for more than `timeout` seconds.
              - :exc:`stopit.TimeoutException` when the request takes longer
                than `timeout` seconds (refer to the `stopit documentation
-               <https://pypi.python.org/pypi/stopit>`_ for details).
+               <https://pypi.python.org/pypi/stopit>`_ for details). Because
+               :mod:`signal` handlers can only be installed in the main thread
+               this overall deadline isn't enforced in worker threads.
              - Any exception raised by Python's standard library in the last
                attempt (assuming all attempts raise an exception).
     """
+    if hedge:
+        return fetch_hedged([url] + list(alternates or []), timeout=timeout, max_attempts=max_attempts, pool=pool,
+                            cache=cache, timings=timings, max_size=max_size, validate=validate,
+                            compressed=compressed, parser=parser)
     timer = Timer()
+    cached = cache.lookup(url) if cache is not None else None
+    if cached is not None and cached.is_fresh:
+        logger.debug("Using cached response of %s.", url)
+        cached.touch()
+        return parse_body(parser, cached.body) if parser else cached.body
+    headers = cached.conditional_headers if cached is not None else {}
+    if compressed:
+        headers['Accept-Encoding'] = ACCEPT_ENCODING
     logger.debug("Fetching %s ..", url)
     for i in range(1, max_attempts + 1):
         try:
-            with SignalTimeout(timeout, swallow_exc=False):
-                response = urlopen(url)
-                status_code = response.getcode()
-                if status_code != 200:
-                    exc_type = (NotFoundError if status_code == 404 else InvalidResponseError)
-                    raise exc_type("URL returned unexpected status code %s! (%s)" % (status_code, url))
-                response_body = response.read()
+            with deadline(timeout):
+                response = open_url(url, timeout=timeout, pool=pool, headers=headers)
+                record_latency(url, response.timings['ttfb'])
+                if timings is not None:
+                    timings.update(response.timings)
+                try:
+                    if response.status == 304 and cached is not None:
+                        logger.debug("Cached response of %s is still valid (took %s).", url, timer)
+                        cached.revalidated()
+                        return parse_body(parser, cached.body) if parser else cached.body
+                    if response.status != 200:
+                        exc_type = (NotFoundError if response.status == 404 else InvalidResponseError)
+                        raise exc_type("URL returned unexpected status code %s! (%s)" % (response.status, url))
+                    if parser:
+                        instance = parser()
+                        chunks = [] if cache is not None else None
+                        read_body(response, max_size=max_size, validate=validate,
+                                  stream=functools.partial(feed_parser, instance, chunks))
+                        instance.close()
+                        response_body = b''.join(chunks) if chunks is not None else None
+                    else:
+                        response_body = read_body(response, max_size=max_size, validate=validate)
+                finally:
+                    response.close()
+                    if timings is not None:
+                        timings.update(response.timings)
                 logger.debug("Took %s to fetch %s.", timer, url)
-                return response_body
-        except NotFoundError:
-            # We never retry 404 responses but retry timeouts.
+                if cache is not None and response_body is not None:
+                    cache.store(url, response_body,
+                                etag=response.getheader('ETag'),
+                                last_modified=response.getheader('Last-Modified'))
+                return instance if parser else response_body
+        except (NotFoundError, ResponseTooLargeError):
+            # We never retry 404 responses or oversized responses but retry timeouts.
             raise
         except Exception as e:
             if retry and i < max_attempts:
                 logger.warning("Failed to fetch %s, retrying (%i/%i, error was: %s)", url, i, max_attempts, e)
+            elif cached is not None:
+                logger.warning("Failed to fetch %s, using stale cached response (error was: %s)", url, e)
+                return parse_body(parser, cached.body) if parser else cached.body
             else:
                 raise
 
 
-def fetch_concurrent(urls, concurrency=None):
+def fetch_hedged(urls, timeout=10, max_attempts=3, timings=None, **options):
+    """
+    Fetch a URL, sending duplicate requests when the server is slow to respond.
+
+    :param urls: A list with the URL to fetch followed by alternate URLs with
+                 the same content (strings).
+    :param timeout: The socket level connect and read timeout and the
+                    overall deadline of all requests together (a number).
+    :param max_attempts: The maximum total number of requests (an integer).
+    :param timings: A dictionary that is updated with the durations of the
+                    :data:`TIMING_PHASES` of the winning request (optional).
+    :param options: Any keyword arguments are passed on to :func:`fetch_url()`.
+    :returns: The response body of the first request that succeeded (a byte string).
+    :raises: The exception raised by the last request when all requests fail
+             or :exc:`stopit.TimeoutException` when no request succeeded
+             within `timeout` seconds.
+
+    The first request is sent to the first URL. Whenever none of the pending
+    requests has received its response headers within the delay computed by
+    :func:`get_hedge_delay()` another request is sent, and when a request
+    fails another request is sent right away (in both cases to the next
+    alternate URL, or the same URL over a new connection, which may resolve
+    to a different address when a host name has several). Requests whose
+    response is already being transferred aren't duplicated, so large pages
+    on slow links aren't downloaded twice. Whichever request finishes first
+    wins, the others are abandoned.
+
+    The requests run in background threads where :func:`deadline()` can't
+    interrupt them, so the overall deadline is enforced here (abandoning
+    the requests that are still pending).
+    """
+    timer = Timer()
+    results = queue.Queue()
+    delay = min(get_hedge_delay(urls[0]), timeout)
+    pending = {}
+    launched = 0
+    finished = 0
+
+    def attempt(index, url):
+        try:
+            body = fetch_url(url, timeout=timeout, timings=pending[index], **options)
+            results.put((index, url, body, None))
+        except Exception as e:
+            results.put((index, url, None, e))
+
+    launch = True
+    while True:
+        if launch and launched < max_attempts:
+            url = urls[launched % len(urls)]
+            if launched > 0:
+                logger.debug("Sending hedged request #%i to %s ..", launched + 1, url)
+            pending[launched] = {}
+            thread = threading.Thread(target=attempt, args=(launched, url))
+            thread.daemon = True
+            thread.start()
+            launched += 1
+        remaining = timeout - timer.elapsed_time
+        if remaining <= 0:
+            msg = "Hedged requests didn't finish within %s! (%s)"
+            raise TimeoutException(msg % (format_timespan(timeout), urls[0]))
+        try:
+            # Waiting with a timeout keeps Control-C working on Python 2.
+            index, url, body, error = results.get(True, min(delay if launched < max_attempts else 1, remaining))
+        except queue.Empty:
+            # Only hedge when none of the pending requests got a response yet.
+            launch = not any('ttfb' in attempt_timings for attempt_timings in pending.values())
+            continue
+        finished += 1
+        attempt_timings = pending.pop(index)
+        if error is None:
+            if timings is not None:
+                timings.update(attempt_timings)
+            return body
+        logger.debug("Hedged request to %s failed! (%s)", url, error)
+        if finished >= max_attempts or (len(urls) == 1 and isinstance(error, (NotFoundError, ResponseTooLargeError))):
+            raise error
+        launch = True
+
+
+def get_hedge_delay(url):
+    """
+    Get the time after which :func:`fetch_hedged()` sends another request.
+
+    :param url: The URL that is about to be fetched (a string).
+    :returns: The :data:`HEDGE_PERCENTILE` of the time to first byte of
+              recent requests to the host of the URL (at least
+              :data:`HEDGE_MIN_DELAY` seconds) or :data:`HEDGE_DEFAULT_DELAY`
+              when fewer than :data:`HEDGE_MIN_SAMPLES` requests to the host
+              have been observed.
+
+    The latencies are tracked per host because the mirrors probed while
+    ranking have nothing to say about the latency of (for example) the
+    server that publishes the mirror list.
+    """
+    history = latency_history.get(urlparse(url).hostname, ())
+    if len(history) < HEDGE_MIN_SAMPLES:
+        return HEDGE_DEFAULT_DELAY
+    return max(HEDGE_MIN_DELAY, percentile(history, HEDGE_PERCENTILE))
+
+
+def record_latency(url, ttfb):
+    """
+    Remember the time to first byte of a request for :func:`get_hedge_delay()`.
+
+    :param url: The URL that was requested (a string).
+    :param ttfb: The time to first byte in seconds (a number).
+    """
+    history = latency_history.setdefault(urlparse(url).hostname, collections.deque(maxlen=100))
+    history.append(ttfb)
+
+
+def percentile(values, percent):
+    """
+    Get a percentile of a sample (using the nearest rank method).
+
+    :param values: An iterable of numbers.
+    :param percent: The percentile to get (a number between 0 and 100).
+    :returns: The smallest value that's larger than or equal to `percent`
+              percent of the values (a number) or :data:`None` when there
+              are no values.
+    """
+    values = sorted(values)
+    if values:
+        return values[min(len(values) - 1, int(len(values) * percent / 100.0))]
+
+
+def parse_body(parser, body):
+    """
+    Give a complete response body to a new incremental parser.
+
+    :param parser: A callable that creates an incremental parser (see :func:`fetch_url()`).
+    :param body: The response body (a byte string).
+    :returns: The parser.
+    """
+    instance = parser()
+    instance.feed(body)
+    instance.close()
+    return instance
+
+
+def feed_parser(instance, chunks, data):
+    """
+    Give a chunk of a response body to an incremental parser (the `stream` of :func:`read_body()`).
+
+    :param instance: The incremental parser (see :func:`fetch_url()`).
+    :param chunks: A list to which the chunk is appended (or :data:`None`).
+    :param data: The chunk of the response body (a byte string).
+    :returns: The result of the parser's ``feed()`` method or :data:`False`
+              when `chunks` is given (the complete body is needed then).
+    """
+    if chunks is None:
+        return instance.feed(data)
+    chunks.append(data)
+    instance.feed(data)
+    return False
+
+
+def read_body(response, max_size=None, validate=None, stream=None):
+    """
+    Read a response body in chunks, aborting as soon as it's clear that the body is unacceptable.
+
+    :param response: A :class:`Response` object.
+    :param max_size: The maximum size of the response body in bytes (an
+                     integer or :data:`None`).
+    :param validate: A callable that's given the first :data:`SNIFF_SIZE`
+                     bytes of the body and returns :data:`False` to abort
+                     the download (optional).
+    :param stream: A callable that's given each (decompressed) chunk of the
+                   body as it arrives and returns :data:`True` to stop
+                   reading because the rest of the body isn't needed
+                   (optional).
+    :returns: The response body (a byte string) or, when `stream` is given
+              (the body isn't kept in memory then), :data:`True` when
+              `stream` stopped reading and :data:`False` otherwise.
+    :raises: :exc:`ResponseTooLargeError` when the body is larger than
+             `max_size` and :exc:`InvalidResponseError` when the body is
+             rejected by `validate` or uses an unsupported
+             ``Content-Encoding``.
+
+    This bounds the memory and time spent on broken or hostile servers, for
+    example expired mirror domains that are being squatted and answer every
+    request with a big HTML page.
+
+    Bodies compressed using one of the encodings in :data:`ACCEPT_ENCODING`
+    are decompressed while they are being read, `max_size` and `validate`
+    apply to the decompressed body.
+    """
+    content_length = response.getheader('Content-Length')
+    if max_size is not None and content_length and content_length.isdigit() and int(content_length) > max_size:
+        msg = "Response of %s is too large! (%s)"
+        raise ResponseTooLargeError(msg % (format_size(int(content_length)), response.url))
+    encoding = (response.getheader('Content-Encoding') or 'identity').strip().lower()
+    if encoding in ('gzip', 'x-gzip', 'deflate'):
+        # Automatically detect the gzip or zlib header.
+        decompressor = zlib.decompressobj(32 + zlib.MAX_WBITS)
+    elif encoding == 'identity':
+        decompressor = None
+    else:
+        raise InvalidResponseError("Unsupported content encoding %r! (%s)" % (encoding, response.url))
+    chunks = []
+    size = 0
+    raw_size = 0
+    validated = validate is None
+    while True:
+        data = response.read(READ_CHUNK_SIZE)
+        raw_size += len(data)
+        if decompressor is None:
+            chunk = data
+        else:
+            chunk = decompressor.decompress(data) if data else decompressor.flush()
+        if chunk:
+            if stream is None or size < SNIFF_SIZE:
+                chunks.append(chunk)
+            size += len(chunk)
+            if max_size is not None and size > max_size:
+                raise ResponseTooLargeError("Response exceeds %s! (%s)" % (format_size(max_size), response.url))
+        if not validated and (size >= SNIFF_SIZE or not data):
+            if not validate(b''.join(chunks)[:SNIFF_SIZE]):
+                raise InvalidResponseError("Response doesn't contain the expected data! (%s)" % response.url)
+            validated = True
+        if stream is not None and chunk and stream(chunk):
+            logger.debug("Stopped reading %s after %s.", response.url, format_size(size))
+            return True
+        if not data:
+            if decompressor is not None:
+                logger.debug("Received %s compressed to %s (%s).", format_size(size), format_size(raw_size),
+                             response.url)
+            return False if stream is not None else b''.join(chunks)
+
+
+def url_exists(url, timeout=10, pool=None):
+    """
+    Check whether a URL exists without downloading it.
+
+    :param url: The URL to check (a string).
+    :param timeout: The socket level connect and read timeout (a number).
+    :param pool: A :class:`ConnectionPool` object or :data:`None`.
+    :returns: :data:`True` when the URL exists, :data:`False` when the
+              server responds with 404 or 410.
+    :raises: :exc:`InvalidResponseError` when the server returns another
+             unexpected status code (or any exception raised while sending
+             the request).
+
+    A ``HEAD`` request is sent first, so when a keep-alive connection to the
+    server is available from `pool` this costs a single round trip without
+    any body transfer. Servers that respond to ``HEAD`` with one of the
+    :data:`HEAD_FALLBACK_STATUSES` or that send a malformed response are
+    asked again using ``GET`` (with the response size limited to
+    :data:`MAX_PROBE_SIZE`).
+    """
+    try:
+        with deadline(timeout):
+            response = open_url(url, timeout=timeout, pool=pool, method='HEAD')
+            response.close()
+    except http_client.HTTPException as e:
+        logger.debug("HEAD request for %s failed, falling back to GET (%s).", url, e)
+        status = None
+    else:
+        status = response.status
+    if status == 200:
+        return True
+    elif status in (404, 410):
+        return False
+    elif status is None or status in HEAD_FALLBACK_STATUSES:
+        try:
+            fetch_url(url, timeout=timeout, pool=pool, max_size=MAX_PROBE_SIZE)
+            return True
+        except NotFoundError:
+            return False
+    raise InvalidResponseError("URL returned unexpected status code %s! (%s)" % (status, url))
+
+
+def looks_like_release_file(data):
+    """
+    Check whether the start of a response body looks like a ``Release`` file.
+
+    :param data: The first bytes of the response body (a byte string).
+    :returns: :data:`True` if the data contains an ``Origin:`` or ``Date:``
+              field, :data:`False` otherwise.
+
+    This is intended to be passed as the `validate` argument of
+    :func:`fetch_url()`.
+    """
+    return b'Origin:' in data or b'Date:' in data
+
+
+def parse_release_date(data):
+    """
+    Get the ``Date:`` field of a ``Release`` file.
+
+    :param data: The contents of a ``Release`` file (a byte string).
+    :returns: The date as a Unix timestamp (an integer) or :data:`None` when
+              the field is missing or can't be parsed.
     """
-    Fetch the given URLs concurrently using :mod:`multiprocessing`.
+    for line in data.splitlines():
+        if line.startswith(b'Date: '):
+            date_string = line[len(b'Date: '):].strip().decode('ascii', 'replace')
+            if date_string.endswith('UTC'):
+                try:
+                    return calendar.timegm(time.strptime(date_string, '%a, %d %b %Y %H:%M:%S %Z'))
+                except ValueError:
+                    pass
+            # Fall back to the RFC 2822 parser for other time zones.
+            parsed = email.utils.parsedate_tz(date_string)
+            if parsed:
+                return int(email.utils.mktime_tz(parsed))
+            logger.debug("Failed to parse date of Release file! (%r)", date_string)
+            return None
+    return None
+
+
+def parse_index_sizes(data, index_files):
+    """
+    Get the sizes of index files listed in a ``Release`` file.
+
+    :param data: The contents of a ``Release`` file (a byte string).
+    :param index_files: An iterable of paths of index files relative to the
+                        ``Release`` file and without compression extension
+                        (e.g. ``main/binary-amd64/Packages``).
+    :returns: A tuple of two integers: The number of index files found and
+              their total size in bytes.
+
+    Like ``apt-get`` only one variant of each index file is counted (the
+    first available one from :data:`INDEX_COMPRESSION_EXTENSIONS`).
+    """
+    sizes = {}
+    for line in data.splitlines():
+        # The checksum sections contain lines like ' <checksum> <size> <path>'.
+        if line.startswith(b' '):
+            tokens = line.split()
+            if len(tokens) == 3 and tokens[1].isdigit():
+                sizes.setdefault(tokens[2].decode('ascii', 'replace'), int(tokens[1]))
+    count, total = 0, 0
+    for path in index_files:
+        for extension in INDEX_COMPRESSION_EXTENSIONS:
+            if path + extension in sizes:
+                count += 1
+                total += sizes[path + extension]
+                break
+    return count, total
+
+
+def open_url(url, timeout=10, pool=None, headers=None, method='GET'):
+    """
+    Send a request and return the response (without reading the response body).
+
+    :param url: The URL to fetch (a string).
+    :param timeout: The socket level connect and read timeout (a number).
+    :param pool: A :class:`ConnectionPool` object or :data:`None`.
+    :param headers: A dictionary with additional request headers (optional).
+    :param method: The HTTP method (a string, defaults to 'GET').
+    :returns: A :class:`Response` object. The caller is responsible for
+              calling :func:`Response.close()`.
+
+    When a `pool` is given and it :func:`~ConnectionPool.supports()` the URL
+    the request is sent over one of its keep-alive connections, otherwise
+    :func:`~urllib.request.urlopen()` is used (which also takes care of
+    ``ftp://`` URLs and the ``*_proxy`` environment variables).
+    """
+    shaper = pool.shaper if pool is not None else None
+    if shaper is not None:
+        shaper.check_budget(url)
+    if pool is not None and pool.supports(url):
+        return pool.request(url, timeout=timeout, headers=headers, method=method)
+    request = Request(url, headers=headers or {})
+    request.get_method = lambda: method
+    timer = Timer()
+    try:
+        raw = urlopen(request, timeout=timeout)
+    except HTTPError as e:
+        # Error responses are reported using the status code.
+        raw = e
+    timings = dict(dns=None, connect=None, tls=None, ttfb=timer.elapsed_time)
+    return Response(url=raw.geturl(), status=raw.getcode(), raw=raw, timings=timings, shaper=shaper)
+
+
+def fetch_concurrent(urls, concurrency=None, engine=None, pool=None, worker=None, adaptive=False, **options):
+    """
+    Fetch the given URLs concurrently.
 
     :param urls: An iterable of URLs (strings).
     :param concurrency: Override the concurrency (an integer, defaults to the
                         value computed by :func:`get_default_concurrency()`).
-    :returns: A list of tuples like those returned by :func:`fetch_worker()`.
+                        In adaptive mode this is the initial concurrency.
+    :param engine: The name of the engine used to run the requests
+                   concurrently (one of the strings :data:`ENGINE_THREADS`
+                   or :data:`ENGINE_PROCESSES`, defaults to
+                   :data:`DEFAULT_ENGINE`).
+    :param pool: A :class:`ConnectionPool` object whose keep-alive
+                 connections should be used (only supported by the
+                 :data:`ENGINE_THREADS` engine because connections can't
+                 be shared between processes). When the pool has a
+                 :class:`TrafficShaper` its limit on the number of
+                 requests per host is enforced here.
+    :param worker: The function that fetches a single URL (defaults to
+                   :func:`fetch_worker()`, other options are
+                   :func:`digest_worker()`, :func:`pipeline_worker()`,
+                   :func:`exists_worker()` and :func:`bandwidth_worker()`).
+    :param adaptive: :data:`True` to adjust the number of simultaneous
+                     requests while the URLs are being fetched (see
+                     :class:`AdaptiveConcurrency`), :data:`False` to use a
+                     fixed concurrency (the default). Only supported by the
+                     :data:`ENGINE_THREADS` engine.
+    :param options: Any keyword arguments are passed on to `worker`.
+    :returns: A list of tuples like those returned by :func:`fetch_worker()`
+              (or by the given `worker` function).
+    :raises: :exc:`~exceptions.ValueError` when `engine` isn't supported.
+    """
+    return list(iter_concurrent(urls, concurrency=concurrency, engine=engine, pool=pool, worker=worker,
+                                adaptive=adaptive, ordered=True, **options))
+
+
+def iter_concurrent(urls, concurrency=None, engine=None, pool=None, worker=None, adaptive=False, ordered=False,
+                    **options):
+    """
+    Fetch the given URLs concurrently, yielding the results as they become available.
+
+    :param ordered: :data:`True` to yield the results in the order of `urls`,
+                    :data:`False` to yield each result as soon as its request
+                    completes (the default).
+
+    The other parameters are the same as for :func:`fetch_concurrent()`.
+
+    :returns: A generator of tuples like those returned by
+              :func:`fetch_worker()` (or by the given `worker` function).
+    :raises: :exc:`~exceptions.ValueError` when `engine` isn't supported.
     """
+    if worker is None:
+        worker = fetch_worker
     if concurrency is None:
         concurrency = get_default_concurrency()
-    pool = multiprocessing.Pool(concurrency)
+    if engine is None:
+        engine = DEFAULT_ENGINE
+    if engine == ENGINE_PROCESSES and pool is not None:
+        logger.debug("Not using connection pool with %s engine.", engine)
+        pool = None
+    function = functools.partial(worker, pool=pool, **options)
+    shaper = pool.shaper if pool is not None else None
+    if shaper is not None and shaper.per_host:
+        function = functools.partial(call_with_host_slot, function, shaper)
+    if adaptive and engine == ENGINE_THREADS:
+        controller = AdaptiveConcurrency(initial=concurrency)
+        for result in controller.imap(function, urls, ordered=ordered):
+            yield result
+        return
+    elif adaptive:
+        logger.debug("Adaptive concurrency isn't supported by %s engine.", engine)
+    if engine == ENGINE_THREADS:
+        workers = multiprocessing.pool.ThreadPool(concurrency)
+    elif engine == ENGINE_PROCESSES:
+        workers = multiprocessing.Pool(concurrency)
+    else:
+        raise ValueError("Unsupported concurrency engine! (%r)" % engine)
     try:
-        return pool.map(fetch_worker, urls, chunksize=1)
+        method = workers.imap if ordered else workers.imap_unordered
+        for result in method(function, urls, chunksize=1):
+            yield result
     finally:
-        pool.terminate()
+        workers.terminate()
+
+
+def call_with_host_slot(function, shaper, url):
+    """
+    Call a worker function while holding one of the slots of the URL's host (see :func:`TrafficShaper.host_slot()`).
+
+    :param function: The worker function (a callable that takes a URL).
+    :param shaper: A :class:`TrafficShaper` object.
+    :param url: The URL to pass to `function` (a string).
+    :returns: The return value of `function`.
+    """
+    with shaper.host_slot(url):
+        return function(url)
 
 
 def get_default_concurrency():
@@ -95,32 +797,1023 @@ def get_default_concurrency():
     return max(4, multiprocessing.cpu_count() * 2)
 
 
-def fetch_worker(url):
+def get_concurrency_ceiling():
+    """
+    Get the highest concurrency that the open file limit allows.
+
+    :returns: A positive integer number (at most :data:`ADAPTIVE_MAX_CONCURRENCY`).
+
+    Every request in flight needs a socket and the :class:`ConnectionPool`
+    keeps idle connections open as well, so half of the soft
+    ``RLIMIT_NOFILE`` limit (after reserving some file descriptors for
+    everything else) is available for requests.
+    """
+    soft_limit, hard_limit = resource.getrlimit(resource.RLIMIT_NOFILE)
+    if soft_limit == resource.RLIM_INFINITY:
+        return ADAPTIVE_MAX_CONCURRENCY
+    return max(1, min(ADAPTIVE_MAX_CONCURRENCY, (soft_limit - 64) // 2))
+
+
+def fetch_worker(url, pool=None, max_size=MAX_PROBE_SIZE, validate=None):
     """
     Fetch the given URL for :func:`fetch_concurrent()`.
 
     :param url: The URL to fetch (a string).
-    :returns: A tuple of three values:
+    :param pool: A :class:`ConnectionPool` object or :data:`None`.
+    :param max_size: The maximum size of the response body in bytes (an
+                     integer, defaults to :data:`MAX_PROBE_SIZE`).
+    :param validate: A callable that rejects invalid response bodies (see
+                     :func:`fetch_url()`, for example
+                     :func:`looks_like_release_file()`).
+    :returns: A tuple of four values:
 
               1. The URL that was fetched (a string).
               2. The data that was fetched (a string or :data:`None`).
               3. The number of seconds it took to fetch the URL (a number).
+              4. A dictionary with the durations of the :data:`TIMING_PHASES`
+                 (empty when the request failed).
     """
-    # Ignore Control-C instead of raising KeyboardInterrupt because (due to a
-    # quirk in multiprocessing) this can cause the parent and child processes
-    # to get into a deadlock kind of state where only Control-Z will get you
-    # your precious terminal back; super annoying IMHO.
-    signal.signal(signal.SIGINT, signal.SIG_IGN)
+    if multiprocessing.current_process().name != 'MainProcess':
+        # Ignore Control-C instead of raising KeyboardInterrupt because (due to a
+        # quirk in multiprocessing) this can cause the parent and child processes
+        # to get into a deadlock kind of state where only Control-Z will get you
+        # your precious terminal back; super annoying IMHO.
+        signal.signal(signal.SIGINT, signal.SIG_IGN)
     timer = Timer()
+    timings = {}
     try:
-        data = fetch_url(url, retry=False)
+        data = fetch_url(url, retry=False, pool=pool, timings=timings, max_size=max_size, validate=validate,
+                         compressed=False)
     except Exception as e:
         logger.debug("Failed to fetch %s! (%s)", url, e)
         data = None
+        timings.clear()
     else:
         kbps = format_size(round(len(data) / timer.elapsed_time, 2))
         logger.debug("Downloaded %s at %s per second.", url, kbps)
-    return url, data, timer.elapsed_time
+    return url, data, timer.elapsed_time, timings
+
+
+def digest_worker(url, pool=None, max_size=MAX_PROBE_SIZE, validate=None, keep_body=False, index_files=None):
+    """
+    Fetch the given URL for :func:`fetch_concurrent()` and summarize the response.
+
+    :param url: The URL to fetch (a string).
+    :param pool: A :class:`ConnectionPool` object or :data:`None`.
+    :param max_size: The maximum size of the response body in bytes (an
+                     integer, defaults to :data:`MAX_PROBE_SIZE`).
+    :param validate: A callable that rejects invalid response bodies (see
+                     :func:`fetch_url()`).
+    :param keep_body: :data:`True` to include the response body in the
+                      digest, :data:`False` to discard it (the default).
+    :param index_files: The index files whose sizes should be included in
+                        the digest (see :func:`parse_index_sizes()`, optional).
+    :returns: A tuple of two values:
+
+              1. The URL that was fetched (a string).
+              2. A :class:`ProbeDigest` or :data:`None` when the request failed.
+
+    Unlike :func:`fetch_worker()` the response body is parsed in the worker,
+    so only a small fixed size digest is pickled back to the parent process
+    (when using the :data:`ENGINE_PROCESSES` engine) and kept in memory.
+    """
+    if multiprocessing.current_process().name != 'MainProcess':
+        signal.signal(signal.SIGINT, signal.SIG_IGN)
+    timer = Timer()
+    timings = {}
+    try:
+        data = fetch_url(url, retry=False, pool=pool, timings=timings, max_size=max_size, validate=validate,
+                         compressed=False)
+    except Exception as e:
+        logger.debug("Failed to fetch %s! (%s)", url, e)
+        return url, None
+    index_count, index_size = parse_index_sizes(data, index_files) if index_files else (None, None)
+    return url, ProbeDigest(
+        status=200,
+        size=len(data),
+        date=parse_release_date(data),
+        sha256=hashlib.sha256(data).hexdigest(),
+        elapsed_time=timer.elapsed_time,
+        timings=timings,
+        body=data if keep_body else None,
+        index_count=index_count,
+        index_size=index_size,
+    )
+
+
+def pipeline_worker(url, markers=None, pool=None, **options):
+    """
+    Fetch a ``Release`` file and check for an Archive-Update-in-Progress marker for :func:`fetch_concurrent()`.
+
+    :param url: The URL of the ``Release`` file (a string).
+    :param markers: A dictionary that maps ``Release`` file URLs to the URLs
+                    of the markers whose existence indicates that the
+                    mirror is being updated (optional).
+    :param pool: A :class:`ConnectionPool` object or :data:`None`.
+    :param options: Any keyword arguments are passed on to :func:`digest_worker()`.
+    :returns: A tuple of three values:
+
+              1. The URL of the ``Release`` file (a string).
+              2. A :class:`ProbeDigest` or :data:`None` when the request failed.
+              3. :data:`True` if the marker exists, :data:`False` if it
+                 doesn't and :data:`None` when it wasn't checked (because
+                 the first request failed) or the check failed.
+
+    The marker is checked as soon as the ``Release`` file has been fetched,
+    reusing the same keep-alive connection (when a `pool` is given), so
+    each mirror is tested without waiting for the other mirrors.
+    """
+    url, digest = digest_worker(url, pool=pool, **options)
+    exists = None
+    if digest is not None and markers and url in markers:
+        exists = exists_worker(markers[url], pool=pool)[1]
+    return url, digest, exists
+
+
+def exists_worker(url, pool=None):
+    """
+    Check whether the given URL exists for :func:`fetch_concurrent()`.
+
+    :param url: The URL to check (a string).
+    :param pool: A :class:`ConnectionPool` object or :data:`None`.
+    :returns: A tuple of two values:
+
+              1. The URL that was checked (a string).
+              2. :data:`True` if the URL exists, :data:`False` if it
+                 doesn't and :data:`None` when the check failed (see
+                 :func:`url_exists()`).
+    """
+    if multiprocessing.current_process().name != 'MainProcess':
+        signal.signal(signal.SIGINT, signal.SIG_IGN)
+    try:
+        exists = url_exists(url, pool=pool)
+    except Exception as e:
+        logger.debug("Failed to check whether %s exists! (%s)", url, e)
+        exists = None
+    return url, exists
+
+
+def bandwidth_worker(url, size=None, pool=None):
+    """
+    Probe the bandwidth of the given URL for :func:`fetch_concurrent()`.
+
+    :param url: The URL to probe (a string).
+    :param size: The number of bytes to download (an integer, defaults to
+                 :data:`BANDWIDTH_PROBE_SIZE`).
+    :param pool: A :class:`ConnectionPool` object or :data:`None`.
+    :returns: A tuple of two values:
+
+              1. The URL that was probed (a string).
+              2. The bandwidth in bytes per second (a number) or
+                 :data:`None` when the probe failed.
+    """
+    if multiprocessing.current_process().name != 'MainProcess':
+        signal.signal(signal.SIGINT, signal.SIG_IGN)
+    try:
+        bandwidth = probe_bandwidth(url, size=size, pool=pool)
+    except Exception as e:
+        logger.debug("Failed to probe bandwidth of %s! (%s)", url, e)
+        bandwidth = None
+    return url, bandwidth
+
+
+def probe_bandwidth(url, size=None, timeout=10, pool=None):
+    """
+    Measure the sustained throughput of a server by downloading a fixed byte window of a large file.
+
+    :param url: The URL of a large file (a string).
+    :param size: The number of bytes to download (an integer, defaults to
+                 :data:`BANDWIDTH_PROBE_SIZE`).
+    :param timeout: The socket level connect and read timeout (a number).
+    :param pool: A :class:`ConnectionPool` object or :data:`None`.
+    :returns: The bandwidth in bytes per second (a number).
+    :raises: :exc:`InvalidResponseError` when the URL doesn't return a 200
+             or 206 status code or the response is too short to measure.
+
+    Only the first `size` bytes of the file are requested using a ``Range``
+    header. Servers that ignore the header and return the complete file are
+    handled by reading only the first `size` bytes and closing the
+    connection. The time to the first byte and the first chunk of the body
+    (where TCP slow start dominates) are excluded from the measurement.
+    The response isn't subject to the rate limit of the :class:`TrafficShaper`
+    of the `pool` (only to its budget) because that would distort the
+    measurement.
+    """
+    if size is None:
+        size = BANDWIDTH_PROBE_SIZE
+    with deadline(timeout):
+        response = open_url(url, timeout=timeout, pool=pool, headers={'Range': 'bytes=0-%i' % (size - 1)})
+        response.throttle = False
+        try:
+            if response.status not in (200, 206):
+                exc_type = (NotFoundError if response.status == 404 else InvalidResponseError)
+                raise exc_type("URL returned unexpected status code %s! (%s)" % (response.status, url))
+            if response.status == 200:
+                logger.debug("Server ignored Range header, reading first %s of %s ..", format_size(size), url)
+            # Exclude the first chunk from the measurement.
+            received = len(response.read(min(size, BANDWIDTH_CHUNK_SIZE)))
+            timer = Timer()
+            measured = 0
+            while received + measured < size:
+                chunk = response.read(min(size - received - measured, BANDWIDTH_CHUNK_SIZE))
+                if not chunk:
+                    break
+                measured += len(chunk)
+            elapsed_time = timer.elapsed_time
+        finally:
+            response.close()
+    if not (measured and elapsed_time):
+        raise InvalidResponseError("Response too short to measure bandwidth! (%s)" % url)
+    bandwidth = measured / elapsed_time
+    logger.debug("Measured %s per second on %s.", format_size(round(bandwidth, 2)), url)
+    return bandwidth
+
+
+def deadline(timeout):
+    """
+    Enforce an overall deadline on a block of code (where possible).
+
+    :param timeout: The number of seconds after which the code block is
+                    interrupted (a number).
+    :returns: A context manager.
+
+    In the main thread this returns a :class:`stopit.SignalTimeout` object.
+    Signal handlers can't be installed from other threads, so there this
+    returns a context manager that does nothing and :func:`fetch_url()`
+    relies on socket level timeouts instead.
+    """
+    if is_main_thread():
+        return SignalTimeout(timeout, swallow_exc=False)
+    return NoDeadline()
+
+
+def is_main_thread():
+    """
+    Check whether the caller is running in the main thread.
+
+    :returns: :data:`True` when running in the main thread, :data:`False` otherwise.
+    """
+    if hasattr(threading, 'main_thread'):
+        return threading.current_thread() is threading.main_thread()
+    # Python 2 doesn't have threading.main_thread().
+    return threading.current_thread().name == 'MainThread'
+
+
+class AdaptiveConcurrency(object):
+
+    """
+    Run requests concurrently while adjusting the number of requests in flight.
+
+    A fixed concurrency has nothing to do with the capacity of the network
+    link: Too high saturates a thin uplink (which makes every mirror look
+    slow) and too low makes ranking long lists of mirrors take minutes.
+
+    This class uses additive increase / multiplicative decrease (AIMD): The
+    requests are divided into rounds of :attr:`limit` completed requests. After
+    a round in which few requests timed out and the throughput (the number of
+    completed requests per second) didn't drop compared to the best round so
+    far the limit is raised by :data:`ADAPTIVE_INCREASE`, otherwise it is
+    halved. The limit stays between :data:`ADAPTIVE_MIN_CONCURRENCY` and the
+    value of :func:`get_concurrency_ceiling()`.
+    """
+
+    def __init__(self, initial, minimum=ADAPTIVE_MIN_CONCURRENCY, maximum=None):
+        """
+        Initialize an :class:`AdaptiveConcurrency` object.
+
+        :param initial: The initial number of simultaneous requests (an integer).
+        :param minimum: The lowest number of simultaneous requests (an integer,
+                        defaults to :data:`ADAPTIVE_MIN_CONCURRENCY`).
+        :param maximum: The highest number of simultaneous requests (an
+                        integer, defaults to :func:`get_concurrency_ceiling()`).
+        """
+        self.maximum = maximum or get_concurrency_ceiling()
+        self.minimum = min(minimum, self.maximum)
+        self.limit = max(self.minimum, min(initial, self.maximum))
+        self.condition = threading.Condition()
+        self.in_flight = 0
+        self.best_rate = 0
+        self.reset_round()
+
+    def reset_round(self):
+        """Start measuring a new round of requests."""
+        self.round_timer = Timer()
+        self.round_completed = 0
+        self.round_timeouts = 0
+
+    def record(self, failed, elapsed_time):
+        """
+        Record the outcome of a request and adjust :attr:`limit` at the end of a round.
+
+        :param failed: :data:`True` if the request failed, :data:`False` otherwise.
+        :param elapsed_time: The duration of the request in seconds (a number).
+
+        The caller must hold :attr:`condition`.
+        """
+        self.in_flight -= 1
+        self.round_completed += 1
+        if failed and elapsed_time >= ADAPTIVE_TIMEOUT_THRESHOLD:
+            self.round_timeouts += 1
+        if self.round_completed >= self.limit:
+            rate = self.round_completed / max(self.round_timer.elapsed_time, 0.001)
+            timeout_rate = float(self.round_timeouts) / self.round_completed
+            if timeout_rate > ADAPTIVE_MAX_TIMEOUT_RATE or rate < self.best_rate * 0.8:
+                limit = max(self.minimum, self.limit // 2)
+            else:
+                limit = min(self.maximum, self.limit + ADAPTIVE_INCREASE)
+            if limit != self.limit:
+                logger.debug("Changing concurrency from %i to %i (%.1f requests/s, %i%% timeouts).",
+                             self.limit, limit, rate, timeout_rate * 100)
+                self.limit = limit
+            self.best_rate = max(self.best_rate, rate)
+            self.reset_round()
+
+    def imap(self, function, urls, ordered=True):
+        """
+        Call a worker function for each URL.
+
+        :param function: A function that takes a URL and returns a tuple
+                         whose second value is :data:`None` when the
+                         request failed (like :func:`fetch_worker()`).
+        :param urls: An iterable of URLs (strings).
+        :param ordered: :data:`True` to yield the results in the order of
+                        `urls`, :data:`False` to yield them as soon as they
+                        are available.
+        :returns: A generator of the results of `function`.
+        :raises: Any exception raised by `function`.
+        """
+        pending = list(enumerate(urls))
+        pending.reverse()
+        finished = {}
+        errors = []
+        stopped = threading.Event()
+        next_index = 0
+
+        def worker():
+            while True:
+                with self.condition:
+                    # Workers beyond the current limit stay idle.
+                    while pending and not errors and not stopped.is_set() and self.in_flight >= self.limit:
+                        self.condition.wait(1)
+                    if not pending or errors or stopped.is_set():
+                        return
+                    index, url = pending.pop()
+                    self.in_flight += 1
+                timer = Timer()
+                result = None
+                error = None
+                try:
+                    result = function(url)
+                except BaseException as e:
+                    error = e
+                with self.condition:
+                    if error is None:
+                        finished[index] = result
+                    else:
+                        errors.append(error)
+                    self.record(error is not None or result[1] is None, timer.elapsed_time)
+                    self.condition.notify_all()
+
+        # A fixed pool of workers (as large as the limit can get) is gated by the limit.
+        for i in range(min(self.maximum, len(pending))):
+            thread = threading.Thread(target=worker)
+            thread.daemon = True
+            thread.start()
+        try:
+            while True:
+                with self.condition:
+                    if ordered:
+                        ready = []
+                        while next_index in finished:
+                            ready.append(finished.pop(next_index))
+                            next_index += 1
+                    else:
+                        ready = [finished.pop(index) for index in sorted(finished)]
+                    if not ready:
+                        if errors and not self.in_flight:
+                            raise errors[0]
+                        if not (pending or self.in_flight or finished):
+                            break
+                        # Waiting with a timeout keeps Control-C working on Python 2.
+                        self.condition.wait(1)
+                for result in ready:
+                    yield result
+        finally:
+            # Let the workers exit when the caller stops early.
+            stopped.set()
+            with self.condition:
+                self.condition.notify_all()
+        logger.info("Concurrency settled on %i simultaneous requests (open file limit allows %i).",
+                    self.limit, self.maximum)
+
+
+class ConnectionPool(object):
+
+    """
+    HTTP/1.1 keep-alive connections shared between requests.
+
+    Idle connections are kept per scheme and host, so that consecutive
+    requests to the same mirror (for example the ``Release`` file followed by
+    the ``Archive-Update-in-Progress-*`` marker) skip the TCP handshake. For
+    HTTPS connections the TLS session is remembered per host and resumed when
+    a new connection needs to be opened, which avoids most of the cost of a
+    full TLS handshake.
+
+    A single :class:`ConnectionPool` object can be used by multiple threads,
+    a connection is only ever used by one thread at a time.
+    """
+
+    def __init__(self, max_idle=8, resolver=None, shaper=None):
+        """
+        Initialize a :class:`ConnectionPool` object.
+
+        :param max_idle: The maximum number of idle connections kept per host
+                         (an integer, defaults to 8).
+        :param resolver: The :class:`Resolver` used to look up host names
+                         (defaults to a new :class:`Resolver` object).
+        :param shaper: A :class:`TrafficShaper` that limits the traffic of
+                       requests made using the pool (optional).
+        """
+        self.max_idle = max_idle
+        self.resolver = resolver or Resolver()
+        self.shaper = shaper
+        self.idle_connections = {}
+        self.lock = threading.Lock()
+        self.ssl_context = ssl.create_default_context()
+        self.tls_sessions = {}
+
+    def supports(self, url):
+        """
+        Check whether a URL can be fetched using the connection pool.
+
+        :param url: The URL to check (a string).
+        :returns: :data:`True` for ``http://`` and ``https://`` URLs that
+                  aren't configured to use a proxy, :data:`False` otherwise.
+        """
+        parsed_url = urlparse(url)
+        if parsed_url.scheme not in ('http', 'https'):
+            return False
+        return not (parsed_url.scheme in getproxies() and not proxy_bypass(parsed_url.hostname or ''))
+
+    def request(self, url, timeout=10, headers=None, method='GET'):
+        """
+        Send a request over a keep-alive connection (following redirects).
+
+        :param url: The URL to fetch (a string).
+        :param timeout: The socket level connect and read timeout (a number).
+        :param headers: A dictionary with additional request headers (optional).
+        :param method: The HTTP method (a string, defaults to 'GET').
+        :returns: A :class:`Response` object that returns its connection to
+                  the pool when it's closed after reading the response body.
+        :raises: :exc:`InvalidResponseError` when more than
+                 :data:`MAX_REDIRECTS` redirects are encountered.
+        """
+        for i in range(MAX_REDIRECTS + 1):
+            connection, raw, timings = self.send(url, timeout, headers, method)
+            response = Response(url=url, status=raw.status, raw=raw, timings=timings, pool=self,
+                                connection=connection, shaper=self.shaper)
+            location = raw.getheader('Location')
+            if response.status not in REDIRECT_STATUSES or not location:
+                return response
+            # Drain the body of the redirect so the connection can be reused.
+            response.read()
+            response.close()
+            logger.debug("Following redirect from %s to %s ..", url, location)
+            url = urljoin(url, location)
+        raise InvalidResponseError("Too many redirects! (%s)" % url)
+
+    def send(self, url, timeout, headers=None, method='GET'):
+        """
+        Send a request and wait for the response headers.
+
+        :param url: The URL to fetch (a string).
+        :param timeout: The socket level connect and read timeout (a number).
+        :param headers: A dictionary with additional request headers (optional).
+        :param method: The HTTP method (a string, defaults to 'GET').
+        :returns: A tuple with the connection, its
+                  :class:`~http.client.HTTPResponse` object and a dictionary
+                  with the durations of the :data:`TIMING_PHASES` up to and
+                  including ``ttfb``.
+
+        When a reused connection turns out to have been closed by the server
+        in the mean time the request is transparently retried on a new
+        connection.
+        """
+        parsed_url = urlparse(url)
+        path = parsed_url.path or '/'
+        if parsed_url.query:
+            path += '?' + parsed_url.query
+        request_headers = dict(headers or {}, Connection='keep-alive')
+        while True:
+            connection, reused = self.acquire(parsed_url.scheme, parsed_url.netloc, timeout)
+            try:
+                if reused:
+                    timings = dict(dns=0, connect=0, tls=0 if parsed_url.scheme == 'https' else None)
+                else:
+                    connection.connect()
+                    timings = dict(connection.timings)
+                timer = Timer()
+                connection.request(method, path, headers=request_headers)
+                raw = connection.getresponse()
+                timings['ttfb'] = timer.elapsed_time
+                return connection, raw, timings
+            except socket.timeout:
+                connection.close()
+                raise
+            except (http_client.HTTPException, socket.error):
+                connection.close()
+                if not reused:
+                    raise
+                logger.debug("Reused connection to %s was closed, reconnecting ..", parsed_url.netloc)
+
+    def acquire(self, scheme, netloc, timeout):
+        """
+        Get an idle connection or create a new one.
+
+        :param scheme: The URL scheme (the string 'http' or 'https').
+        :param netloc: The host name and optional port number (a string).
+        :param timeout: The socket level connect and read timeout (a number).
+        :returns: A tuple with two values:
+
+                  1. A :class:`~http.client.HTTPConnection` object.
+                  2. :data:`True` if the connection was reused,
+                     :data:`False` if it was newly created.
+        """
+        key = (scheme, netloc)
+        with self.lock:
+            connections = self.idle_connections.get(key)
+            connection = connections.pop() if connections else None
+        if connection is not None:
+            connection.timeout = timeout
+            if connection.sock is not None:
+                connection.sock.settimeout(timeout)
+                return connection, True
+        if scheme == 'https':
+            connection = PooledHTTPSConnection(netloc, timeout=timeout, context=self.ssl_context)
+        else:
+            connection = PooledHTTPConnection(netloc, timeout=timeout)
+        connection.pool = self
+        connection.pool_key = key
+        return connection, False
+
+    def release(self, connection, reusable=True):
+        """
+        Return a connection to the pool.
+
+        :param connection: A connection created by :func:`acquire()`.
+        :param reusable: :data:`False` if the connection can't be reused (for
+                         example because the server asked to close it or the
+                         response body wasn't read completely).
+        """
+        if reusable and connection.sock is not None:
+            tls_session = getattr(connection.sock, 'session', None)
+            with self.lock:
+                if tls_session is not None:
+                    self.tls_sessions[connection.pool_key] = tls_session
+                connections = self.idle_connections.setdefault(connection.pool_key, [])
+                if len(connections) < self.max_idle:
+                    connections.append(connection)
+                    return
+        connection.close()
+
+    def close(self):
+        """Close all idle connections."""
+        with self.lock:
+            connections = [c for cs in self.idle_connections.values() for c in cs]
+            self.idle_connections.clear()
+        for connection in connections:
+            connection.close()
+
+
+class PooledHTTPConnection(http_client.HTTPConnection):
+
+    """HTTP connection that records how long it took to resolve the host name and connect."""
+
+    pool = None
+    timings = None
+
+    def connect(self):
+        """Connect to the server (recording the durations in :attr:`timings`)."""
+        self.timings = dict(tls=None)
+        self.sock = create_connection((self.host, self.port), self.timeout, self.timings,
+                                      resolver=self.pool.resolver if self.pool else None)
+
+
+class PooledHTTPSConnection(http_client.HTTPSConnection):
+
+    """HTTPS connection that resumes TLS sessions remembered by its :class:`ConnectionPool`."""
+
+    pool = None
+    timings = None
+
+    def connect(self):
+        """Connect to the server and perform the TLS handshake (resuming a previous session if possible)."""
+        self.timings = {}
+        sock = create_connection((self.host, self.port), self.timeout, self.timings,
+                                 resolver=self.pool.resolver if self.pool else None)
+        kw = dict(server_hostname=self.host)
+        session = self.pool.tls_sessions.get(self.pool_key) if self.pool else None
+        if session is not None:
+            kw['session'] = session
+        timer = Timer()
+        try:
+            self.sock = self._context.wrap_socket(sock, **kw)
+        except Exception:
+            sock.close()
+            raise
+        self.timings['tls'] = timer.elapsed_time
+
+
+def create_connection(address, timeout, timings, resolver=None):
+    """
+    Connect to a TCP server (recording how long it took to resolve the host name and connect).
+
+    :param address: A tuple with a host name (a string) and port number (an integer).
+    :param timeout: The socket level connect and read timeout (a number).
+    :param timings: A dictionary whose ``dns`` and ``connect`` keys are set
+                    to the durations of both phases.
+    :param resolver: A :class:`Resolver` object or :data:`None` (to call
+                     :func:`socket.getaddrinfo()` directly).
+    :returns: A connected :class:`socket.socket` object.
+    :raises: :exc:`socket.error` when none of the addresses of the host accept
+             the connection.
+    """
+    host, port = address
+    if resolver is not None:
+        addresses, timings['dns'] = resolver.resolve(host, port)
+    else:
+        timer = Timer()
+        addresses = socket.getaddrinfo(host, port, 0, socket.SOCK_STREAM)
+        timings['dns'] = timer.elapsed_time
+    timer = Timer()
+    error = socket.error("getaddrinfo returned an empty list")
+    for family, socktype, proto, canonname, sockaddr in addresses:
+        sock = socket.socket(family, socktype, proto)
+        try:
+            sock.settimeout(timeout)
+            sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+            sock.connect(sockaddr)
+        except socket.error as e:
+            sock.close()
+            error = e
+        else:
+            timings['connect'] = timer.elapsed_time
+            return sock
+    raise error
+
+
+class Resolver(object):
+
+    """
+    Host name resolution with a cache that lives for the duration of a run.
+
+    Many mirrors are listed under several URLs (HTTP and HTTPS, different
+    paths on the same host) and the mirror discovery pages list dozens of
+    hosts. :func:`prefetch()` resolves all of them concurrently as soon as
+    the candidates are known, after which connections are opened without
+    waiting for DNS and host names that don't exist (expired mirror domains
+    are a common failure) are known up front instead of costing a timeout.
+
+    Permanent failures (see :func:`is_unresolvable()`) are cached as well, so
+    each host name is resolved at most once. Temporary failures (like
+    ``EAI_AGAIN``) are retried and never cached, so a single hiccup of the
+    DNS resolver doesn't make a mirror fail for the rest of the run. The time
+    spent resolving a host name is remembered and reported by
+    :func:`resolve()` so that the ``dns`` timings of requests remain
+    meaningful when the lookup was prefetched.
+    """
+
+    def __init__(self):
+        """Initialize a :class:`Resolver` object."""
+        self.cache = {}
+        self.lock = threading.Lock()
+
+    def lookup(self, host):
+        """
+        Resolve a host name (using the cache when possible).
+
+        :param host: The host name (a string).
+        :returns: A tuple with two values:
+
+                  1. The result of :func:`socket.getaddrinfo()` (without a port
+                     number) or the :exc:`socket.gaierror` that it raised.
+                  2. The time spent resolving the host name (a number).
+        """
+        with self.lock:
+            entry = self.cache.get(host)
+        if entry is None:
+            timer = Timer()
+            for i in range(1, RESOLVER_ATTEMPTS + 1):
+                try:
+                    addresses = socket.getaddrinfo(host, None, 0, socket.SOCK_STREAM)
+                    break
+                except socket.gaierror as e:
+                    addresses = e
+                    if is_unresolvable(e):
+                        break
+                    logger.debug("Temporary failure resolving %s (%i/%i): %s", host, i, RESOLVER_ATTEMPTS, e)
+            entry = (addresses, timer.elapsed_time)
+            if isinstance(addresses, socket.gaierror) and not is_unresolvable(addresses):
+                return entry
+            with self.lock:
+                entry = self.cache.setdefault(host, entry)
+        return entry
+
+    def resolve(self, host, port):
+        """
+        Get the addresses to connect to.
+
+        :param host: The host name (a string).
+        :param port: The port number (an integer).
+        :returns: A tuple with two values:
+
+                  1. A list of tuples like those returned by
+                     :func:`socket.getaddrinfo()`.
+                  2. The time spent resolving the host name (a number).
+        :raises: :exc:`socket.gaierror` when the host name can't be resolved.
+        """
+        addresses, elapsed_time = self.lookup(host)
+        if isinstance(addresses, Exception):
+            raise socket.gaierror(addresses.errno, addresses.strerror)
+        return [(family, socktype, proto, canonname, sockaddr[:1] + (port,) + sockaddr[2:])
+                for family, socktype, proto, canonname, sockaddr in addresses], elapsed_time
+
+    def prefetch(self, hosts, concurrency=RESOLVER_CONCURRENCY):
+        """
+        Concurrently resolve host names.
+
+        :param hosts: An iterable of host names (strings).
+        :param concurrency: The maximum number of simultaneous lookups (an
+                            integer, defaults to :data:`RESOLVER_CONCURRENCY`).
+        :returns: A set with the host names that don't exist or don't have
+                  any addresses. Temporary failures aren't included.
+        """
+        hosts = set(hosts)
+        if not hosts:
+            return set()
+        timer = Timer()
+        workers = multiprocessing.pool.ThreadPool(min(len(hosts), concurrency))
+        try:
+            results = list(zip(hosts, workers.map(self.lookup, hosts, chunksize=1)))
+        finally:
+            workers.terminate()
+        unresolvable = set(host for host, (addresses, elapsed_time) in results if is_unresolvable(addresses))
+        logger.debug("Resolved %i host names in %s (%i don't exist).", len(hosts), timer, len(unresolvable))
+        return unresolvable
+
+
+def is_unresolvable(addresses):
+    """
+    Check whether a host name lookup failed permanently.
+
+    :param addresses: The first value returned by :func:`Resolver.lookup()`.
+    :returns: :data:`True` if the lookup resulted in NXDOMAIN or no usable
+              address, :data:`False` otherwise (including temporary failures
+              like timeouts).
+    """
+    if isinstance(addresses, socket.gaierror):
+        permanent = set(getattr(socket, name, None) for name in ('EAI_NONAME', 'EAI_NODATA', 'EAI_ADDRFAMILY'))
+        return addresses.errno in permanent - set([None])
+    return not addresses
+
+
+class TrafficShaper(object):
+
+    """
+    Limit the network traffic caused by ranking mirrors.
+
+    When mirrors are ranked on a production system the burst of probes
+    competes with real traffic, on metered links it costs money and when
+    several candidate URLs share a host it can trip rate limits. A
+    :class:`TrafficShaper` attached to a :class:`ConnectionPool` bounds all of
+    this:
+
+    - The response bodies are read no faster than `rate` bytes per second
+      (using a token bucket that allows bursts of one second worth of data).
+      Bandwidth probes are exempt because throttling them would measure the
+      rate limit instead of the mirror (see :func:`probe_bandwidth()`).
+    - Once `budget` bytes have been received no new requests are sent and
+      reading more data raises :exc:`BudgetExceededError`.
+    - At most `per_host` requests to the same host are in flight at any time
+      (enforced by :func:`iter_concurrent()`).
+    """
+
+    def __init__(self, rate=None, budget=None, per_host=None):
+        """
+        Initialize a :class:`TrafficShaper` object.
+
+        :param rate: The maximum number of bytes per second (a number or
+                     :data:`None` for no limit).
+        :param budget: The maximum total number of bytes (a number or
+                       :data:`None` for no limit).
+        :param per_host: The maximum number of simultaneous requests per host
+                         (an integer or :data:`None` for no limit).
+        """
+        self.rate = rate
+        self.budget = budget
+        self.per_host = per_host
+        self.consumed = 0
+        self.tokens = rate or 0
+        self.refilled = time.time()
+        self.lock = threading.Lock()
+        self.host_semaphores = {}
+        self.exemptions = threading.local()
+
+    def __str__(self):
+        """Describe the effective limits (a string)."""
+        limits = []
+        if self.rate:
+            limits.append("%s per second" % format_size(self.rate))
+        if self.budget:
+            limits.append("a budget of %s" % format_size(self.budget))
+        if self.per_host:
+            limits.append("%i simultaneous requests per host" % self.per_host)
+        return ", ".join(limits) or "no limits"
+
+    @contextlib.contextmanager
+    def exempt(self):
+        """
+        Don't apply the rate limit and budget to requests made by the current thread.
+
+        :returns: A context manager.
+
+        This is used for requests that aren't part of ranking the mirrors
+        (like :func:`~apt_smart.AptMirrorUpdater.validate_mirror()`) but
+        share the same :class:`ConnectionPool`. Their bytes aren't counted.
+        """
+        previous = getattr(self.exemptions, 'active', False)
+        self.exemptions.active = True
+        try:
+            yield
+        finally:
+            self.exemptions.active = previous
+
+    def check_budget(self, url):
+        """
+        Make sure the byte budget hasn't been exhausted before sending a request.
+
+        :param url: The URL that is about to be requested (a string).
+        :raises: :exc:`BudgetExceededError` when the budget is exhausted.
+        """
+        if getattr(self.exemptions, 'active', False):
+            return
+        if self.budget is not None and self.consumed >= self.budget:
+            raise BudgetExceededError("Traffic budget of %s exhausted! (%s)" % (format_size(self.budget), url))
+
+    def consume(self, size, url, throttle=True):
+        """
+        Account for bytes that were received, sleeping when they exceed the rate limit.
+
+        :param size: The number of bytes received (an integer).
+        :param url: The URL that the bytes were received from (a string).
+        :param throttle: :data:`False` to count the bytes against the budget
+                         without applying the rate limit (a boolean).
+        :raises: :exc:`BudgetExceededError` when the budget is exhausted.
+        """
+        if getattr(self.exemptions, 'active', False):
+            return
+        delay = 0
+        with self.lock:
+            self.consumed += size
+            if self.rate and throttle:
+                now = time.time()
+                self.tokens = min(self.rate, self.tokens + (now - self.refilled) * self.rate)
+                self.refilled = now
+                self.tokens -= size
+                if self.tokens < 0:
+                    delay = -self.tokens / float(self.rate)
+        if self.budget is not None and self.consumed > self.budget:
+            raise BudgetExceededError("Traffic budget of %s exceeded! (%s)" % (format_size(self.budget), url))
+        if delay > 0:
+            time.sleep(delay)
+
+    @contextlib.contextmanager
+    def host_slot(self, url):
+        """
+        Wait until fewer than :attr:`per_host` requests to the host of a URL are in flight.
+
+        :param url: The URL that is about to be requested (a string).
+        :returns: A context manager that holds the slot while it's active.
+        """
+        if not self.per_host:
+            yield
+            return
+        host = urlparse(url).hostname
+        with self.lock:
+            semaphore = self.host_semaphores.get(host)
+            if semaphore is None:
+                semaphore = threading.BoundedSemaphore(self.per_host)
+                self.host_semaphores[host] = semaphore
+        with semaphore:
+            yield
+
+
+class Response(object):
+
+    """
+    An HTTP response returned by :func:`open_url()`.
+
+    This is a thin wrapper around the response objects of Python's standard
+    library that takes care of returning keep-alive connections to their
+    :class:`ConnectionPool`.
+    """
+
+    def __init__(self, url, status, raw, timings, pool=None, connection=None, shaper=None):
+        """
+        Initialize a :class:`Response` object.
+
+        :param url: The URL of the response (a string).
+        :param status: The HTTP status code (an integer).
+        :param raw: The response object created by Python's standard library.
+        :param timings: A dictionary with the durations of the
+                        :data:`TIMING_PHASES` up to and including ``ttfb``
+                        (the ``transfer`` phase is added by :func:`read()`).
+        :param pool: The :class:`ConnectionPool` that owns `connection`.
+        :param connection: The connection that received the response.
+        :param shaper: The :class:`TrafficShaper` that accounts for the bytes
+                       read from the response body (optional).
+        """
+        self.url = url
+        self.status = status
+        self.raw = raw
+        self.timings = dict(timings, transfer=0)
+        self.pool = pool
+        self.connection = connection
+        self.shaper = shaper
+        self.throttle = True
+
+    def getheader(self, name, default=None):
+        """
+        Get the value of a response header.
+
+        :param name: The name of the header (a string, case insensitive).
+        :param default: The value to return when the header is missing.
+        :returns: The value of the header (a string) or `default`.
+        """
+        headers = getattr(self.raw, 'headers', None) or self.raw.info()
+        value = headers.get(name)
+        return default if value is None else value
+
+    def read(self, size=None):
+        """
+        Read (part of) the response body.
+
+        :param size: The maximum number of bytes to read (an integer or
+                     :data:`None` to read the remainder of the body).
+        :returns: A byte string.
+
+        The time spent reading is added to the ``transfer`` phase in
+        :attr:`timings`. When the response has a :class:`TrafficShaper` the
+        bytes are accounted for (which may sleep, unless :attr:`throttle`
+        is :data:`False`, or raise :exc:`BudgetExceededError`).
+        """
+        timer = Timer()
+        try:
+            data = self.raw.read() if size is None else self.raw.read(size)
+        finally:
+            self.timings['transfer'] += timer.elapsed_time
+        if self.shaper is not None and data:
+            self.shaper.consume(len(data), self.url, throttle=self.throttle)
+        return data
+
+    def close(self):
+        """
+        Close the response, returning the connection to the pool when possible.
+
+        When the remainder of the response body is small (for example the body
+        of an error response that was never read) it's drained first, so the
+        connection can be reused.
+        """
+        if self.connection is not None:
+            remaining = getattr(self.raw, 'length', None)
+            if not self.raw.isclosed() and remaining is not None and remaining <= MAX_DRAIN_SIZE:
+                try:
+                    self.raw.read()
+                except Exception:
+                    pass
+            reusable = self.raw.isclosed() and not self.raw.will_close
+            self.raw.close()
+            self.pool.release(self.connection, reusable=reusable)
+            self.connection = None
+        else:
+            self.raw.close()
+
+
+class NoDeadline(object):
+
+    """Context manager used by :func:`deadline()` outside of the main thread."""
+
+    def __enter__(self):
+        """Enter the context (does nothing)."""
+        return self
+
+    def __exit__(self, exc_type=None, exc_value=None, traceback=None):
+        """Leave the context (does nothing)."""
+
+
+class BudgetExceededError(Exception):
+
+    """Raised by :class:`TrafficShaper` when the traffic budget has been used up."""
 
 
 class InvalidResponseError(Exception):
@@ -131,3 +1824,8 @@ class InvalidResponseError(Exception):
 class NotFoundError(InvalidResponseError):
 
     """Raised by :func:`fetch_url()` when a URL returns a 404 status code."""
+
+
+class ResponseTooLargeError(InvalidResponseError):
+
+    """Raised by :func:`fetch_url()` when a response body exceeds the given `max_size`."""
@@ -0,0 +1,311 @@
+# Automated, robust apt-get mirror selection for Debian and Ubuntu.
+#
+# Author: martin68 and Peter Odding
+# Last Change: October 16, 2026
+# URL: https://apt-smart.readthedocs.io
+
+"""
+Finding the country of the system running `apt-smart`.
+
+The backends use the country to select mirrors that are likely to be close
+by. Asking a geolocation service costs one or two round trips (and up to
+seven seconds when the first service doesn't respond) on every run, before
+mirror discovery can even start. The :class:`LocationResolver` class tries a
+chain of local sources first:
+
+1. A cache keyed by the fingerprint of the local network (see
+   :func:`get_network_fingerprint()`), so that each network is geolocated
+   only once every :data:`LOCATION_TTL` seconds.
+2. The time zone of the system (from ``/etc/timezone`` or the
+   ``/etc/localtime`` symbolic link) mapped to a country using the
+   ``zone.tab`` file of the time zone database.
+3. The territory of the locale (for example ``de_DE.UTF-8``).
+
+Only when none of these give an answer are the :data:`GEOLOCATION_SERVICES`
+queried. An explicitly configured country (see
+:attr:`~apt_smart.AptMirrorUpdater.country`) skips the chain altogether.
+"""
+
+# Standard library modules.
+import hashlib
+import json
+import logging
+import os
+import socket
+import struct
+import time
+
+# External dependencies.
+import six
+from humanfriendly import Timer
+
+# Modules included in our package.
+from apt_smart.cache import write_file
+from apt_smart.http import fetch_url
+
+LOCATION_TTL = 60 * 60 * 24 * 30
+"""The number of seconds that the country of a network is cached (a number)."""
+
+GEOLOCATION_SERVICES = (
+    ('https://ipapi.co/json', 'country_name', 2),
+    ('http://ip-api.com/json', 'country', 5),
+)
+"""
+The geolocation services that are queried as a last resort (a tuple of tuples).
+
+Each tuple contains the URL of the service, the key in its JSON response
+that contains the name of the country and the timeout in seconds.
+"""
+
+ZONEINFO_DIRECTORY = '/usr/share/zoneinfo'
+"""The pathname of the time zone database (a string)."""
+
+COUNTRY_ALIASES = {
+    'Britain (UK)': 'United Kingdom',
+    'Czech Republic': 'Czechia',
+    'Korea (South)': 'South Korea',
+}
+"""
+A dictionary that maps names in ``iso3166.tab`` to the names used by the :data:`GEOLOCATION_SERVICES`.
+
+The mirror lists are matched against the names reported by the geolocation
+services, so countries that ``iso3166.tab`` names differently are translated.
+"""
+
+IGNORED_LOCALES = ('C', 'POSIX', 'en_US')
+"""
+Locales that don't say anything about the location of the system (a tuple of strings).
+
+The ``en_US`` locale is the default of many installers and cloud images
+regardless of where the system is located.
+"""
+
+# Initialize a logger for this module.
+logger = logging.getLogger(__name__)
+
+
+def get_network_fingerprint():
+    """
+    Get a fingerprint of the network that the system is connected to.
+
+    :returns: A SHA1 hash of the default gateway, its hardware address and
+              the DNS configuration (a string) or :data:`None` when the
+              default gateway can't be determined.
+
+    The public IP address would identify the network more precisely but
+    can't be determined without network traffic, the default gateway and
+    DNS configuration change whenever the system moves between networks,
+    which is what matters here.
+    """
+    gateway = None
+    try:
+        with open('/proc/net/route') as handle:
+            for line in handle:
+                fields = line.split()
+                if len(fields) > 2 and fields[1] == '00000000' and fields[2] != '00000000':
+                    gateway = socket.inet_ntoa(struct.pack('<L', int(fields[2], 16)))
+                    break
+    except (IOError, OSError, ValueError):
+        pass
+    if not gateway:
+        return None
+    tokens = [gateway]
+    try:
+        with open('/proc/net/arp') as handle:
+            for line in handle:
+                fields = line.split()
+                if len(fields) > 3 and fields[0] == gateway:
+                    tokens.append(fields[3])
+    except (IOError, OSError):
+        pass
+    try:
+        with open('/etc/resolv.conf') as handle:
+            tokens.extend(sorted(line.strip() for line in handle
+                                 if line.startswith(('nameserver', 'search', 'domain'))))
+    except (IOError, OSError):
+        pass
+    return hashlib.sha1('\n'.join(tokens).encode('UTF-8')).hexdigest()
+
+
+def get_system_timezone():
+    """
+    Get the time zone of the system.
+
+    :returns: The name of the time zone (a string like ``Europe/Amsterdam``)
+              or :data:`None` when it can't be determined.
+    """
+    try:
+        with open('/etc/timezone') as handle:
+            name = handle.read().strip()
+        if name:
+            return name
+    except (IOError, OSError):
+        pass
+    try:
+        target = os.path.realpath('/etc/localtime')
+    except OSError:
+        return None
+    marker = '/zoneinfo/'
+    if marker in target:
+        return target.split(marker, 1)[1]
+    return None
+
+
+def read_table(filename, key_index, value_index):
+    """
+    Read a tab separated file from the time zone database.
+
+    :param filename: The name of the file in :data:`ZONEINFO_DIRECTORY` (a string).
+    :param key_index: The index of the column with the keys (an integer).
+    :param value_index: The index of the column with the values (an integer).
+    :returns: A dictionary (empty when the file doesn't exist).
+    """
+    table = {}
+    try:
+        with open(os.path.join(ZONEINFO_DIRECTORY, filename)) as handle:
+            for line in handle:
+                if line.strip() and not line.startswith('#'):
+                    fields = line.rstrip('\n').split('\t')
+                    if len(fields) > max(key_index, value_index):
+                        table[fields[key_index]] = fields[value_index]
+    except (IOError, OSError):
+        pass
+    return table
+
+
+def get_country_name(code):
+    """
+    Translate an ISO 3166 country code to the name of the country.
+
+    :param code: A two letter country code (a string).
+    :returns: The name of the country (a string) or :data:`None`.
+    """
+    name = read_table('iso3166.tab', 0, 1).get(code.upper())
+    return COUNTRY_ALIASES.get(name, name)
+
+
+def find_country(updater=None):
+    """
+    Find the country whose mirrors should be preferred.
+
+    :param updater: The :class:`~apt_smart.AptMirrorUpdater` object whose
+                    :attr:`~apt_smart.AptMirrorUpdater.resolved_country`
+                    should be used (optional, when it's not given the
+                    country is resolved without a cache).
+    :returns: The name of the country (a string) or :data:`None`.
+    """
+    return updater.resolved_country if updater else LocationResolver().resolve()
+
+
+class LocationResolver(object):
+
+    """Find the country of the system using the cheapest source that gives an answer."""
+
+    def __init__(self, filename=None, ttl=LOCATION_TTL):
+        """
+        Initialize a :class:`LocationResolver` object.
+
+        :param filename: The pathname of the JSON file that caches the
+                         country of each network (a string or :data:`None`
+                         to disable the cache).
+        :param ttl: The number of seconds that a cached country is used (a
+                    number, defaults to :data:`LOCATION_TTL`).
+        """
+        self.filename = filename
+        self.ttl = ttl
+
+    def resolve(self):
+        """
+        Find the country of the system.
+
+        :returns: The name of the country (a string) or :data:`None` when
+                  all sources failed.
+        """
+        timer = Timer()
+        fingerprint = get_network_fingerprint() if self.filename else None
+        country = self.lookup(fingerprint)
+        if country:
+            logger.debug("Using cached location of network: %s", country)
+            return country
+        for source in (self.from_timezone, self.from_locale, self.from_services):
+            country = source()
+            if country:
+                logger.info("Found your location: %s (using %s, took %s).", country, source.__name__, timer)
+                if source == self.from_services:
+                    self.store(fingerprint, country)
+                return country
+        logger.warning("Failed to determine your location, not selecting mirrors by country.")
+        return None
+
+    def from_timezone(self):
+        """Infer the country from the time zone of the system (a string or :data:`None`)."""
+        zone = get_system_timezone()
+        if zone:
+            code = read_table('zone.tab', 2, 0).get(zone)
+            if code:
+                return get_country_name(code)
+        return None
+
+    def from_locale(self):
+        """Infer the country from the territory of the locale (a string or :data:`None`)."""
+        for name in ('LC_ALL', 'LC_MESSAGES', 'LANG'):
+            value = os.environ.get(name)
+            if value:
+                locale = value.split('.')[0].split('@')[0]
+                if locale not in IGNORED_LOCALES and '_' in locale:
+                    return get_country_name(locale.split('_')[1])
+                return None
+        return None
+
+    def from_services(self):
+        """Ask the :data:`GEOLOCATION_SERVICES` for the country (a string or :data:`None`)."""
+        for url, key, timeout in GEOLOCATION_SERVICES:
+            try:
+                response = fetch_url(url, timeout=timeout)
+                # On py3 response is bytes and json.loads throws TypeError in py3.4 and 3.5,
+                # so decode it to str
+                if isinstance(response, six.binary_type):
+                    response = response.decode('utf-8')
+                return json.loads(response)[key]
+            except Exception as e:
+                logger.debug("Failed to determine location using %s! (%s)", url, e)
+        return None
+
+    def lookup(self, fingerprint):
+        """
+        Find the cached country of a network.
+
+        :param fingerprint: The result of :func:`get_network_fingerprint()`.
+        :returns: The name of the country (a string) or :data:`None`.
+        """
+        if fingerprint:
+            entry = self.load().get(fingerprint)
+            if entry and time.time() - entry.get('stored', 0) < self.ttl:
+                return entry.get('country')
+        return None
+
+    def store(self, fingerprint, country):
+        """
+        Cache the country of a network.
+
+        :param fingerprint: The result of :func:`get_network_fingerprint()`.
+        :param country: The name of the country (a string).
+        """
+        if fingerprint:
+            entries = self.load()
+            entries[fingerprint] = dict(country=country, stored=time.time())
+            try:
+                write_file(self.filename, json.dumps(entries, indent=2, sort_keys=True).encode('UTF-8'))
+            except (IOError, OSError) as e:
+                logger.warning("Failed to cache location! (%s)", e)
+
+    def load(self):
+        """Load the cached countries (a dictionary that maps network fingerprints to dictionaries)."""
+        try:
+            with open(self.filename) as handle:
+                entries = json.load(handle)
+            if isinstance(entries, dict):
+                return entries
+        except (IOError, OSError, TypeError, ValueError):
+            pass
+        return {}
@@ -0,0 +1,166 @@
+# Automated, robust apt-get mirror selection for Debian and Ubuntu.
+#
+# Author: martin68 and Peter Odding
+# Last Change: October 16, 2026
+# URL: https://apt-smart.readthedocs.io
+
+"""
+Incremental parsing of the HTML tables on mirror pages.
+
+The mirror pages of Debian, Ubuntu and Linux Mint are big HTML documents
+(the Ubuntu page is over 250 KB) of which only a few table rows are needed:
+The mirrors located in the country of the user. Building a complete document
+tree of such a page before looking at the rows wastes both time and memory.
+The :class:`TableParser` class is fed the page while it's being downloaded
+(see the `parser` argument of :func:`~apt_smart.http.fetch_url()`), hands
+each table row to :func:`~TableParser.handle_row()` as soon as it's complete
+and tells the caller to stop downloading once the interesting rows have been
+seen.
+"""
+
+# Standard library modules.
+import codecs
+import collections
+
+# External dependencies.
+import six
+from six.moves.html_parser import HTMLParser
+
+try:
+    # Python 3.4+ (HTMLParser.unescape() was removed in Python 3.9).
+    from html import unescape
+except ImportError:
+    # Python 2.
+    unescape = HTMLParser().unescape
+
+TableRow = collections.namedtuple('TableRow', 'text, header, cells, links')
+"""
+A row of an HTML table (a :func:`~collections.namedtuple()`).
+
+The fields are the text of the row (a string, like the ``get_text()``
+method of Beautiful Soup), the text of its first ``<th>`` element (a string
+or :data:`None`), the texts of its ``<td>`` elements (a list of strings) and
+the ``href`` attributes of its links (a list of strings).
+"""
+
+
+class TableParser(HTMLParser):
+
+    """
+    Incremental HTML parser that reports the rows of tables.
+
+    Subclasses override :func:`handle_row()`. Tables are numbered in
+    document order starting from zero (like ``soup.findAll('table')``),
+    rows of nested tables are attributed to the innermost table.
+    """
+
+    def __init__(self):
+        """Initialize a :class:`TableParser` object."""
+        # HTMLParser is an old style class on Python 2.
+        HTMLParser.__init__(self)
+        self.decoder = codecs.getincrementaldecoder('UTF-8')(errors='replace')
+        self.done = False
+        self.num_tables = 0
+        self.open_tables = []
+        self.row = None
+        self.cell = None
+
+    def feed(self, data):
+        """
+        Parse the next chunk of the document.
+
+        :param data: The next chunk (a byte string encoded using UTF-8 or a
+                     Unicode string).
+        :returns: :data:`True` when :func:`handle_row()` has seen enough
+                  (the rest of the document is ignored), :data:`False`
+                  otherwise.
+        """
+        if not self.done:
+            if isinstance(data, six.binary_type):
+                data = self.decoder.decode(data)
+            HTMLParser.feed(self, data)
+        return self.done
+
+    def close(self):
+        """Parse any buffered data and report the last row (when the document is truncated)."""
+        if not self.done:
+            HTMLParser.close(self)
+            self.end_row()
+
+    def handle_starttag(self, tag, attrs):
+        """Keep track of the tables, rows, cells and links."""
+        if self.done:
+            return
+        if tag == 'table':
+            self.open_tables.append(self.num_tables)
+            self.num_tables += 1
+        elif tag == 'tr' and self.open_tables:
+            # The end tag of table rows is optional.
+            self.end_row()
+            self.row = dict(text=[], header=None, cells=[], links=[])
+        elif tag in ('td', 'th') and self.row is not None:
+            self.end_cell()
+            self.cell = dict(tag=tag, text=[])
+        elif tag == 'a' and self.row is not None:
+            href = dict(attrs).get('href')
+            if href:
+                self.row['links'].append(href)
+
+    def handle_endtag(self, tag):
+        """Report rows as soon as they are complete."""
+        if self.done:
+            return
+        if tag in ('td', 'th'):
+            self.end_cell()
+        elif tag == 'tr':
+            self.end_row()
+        elif tag == 'table' and self.open_tables:
+            self.end_row()
+            self.open_tables.pop()
+
+    def handle_data(self, data):
+        """Collect the text of rows and cells."""
+        if self.row is not None:
+            self.row['text'].append(data)
+            if self.cell is not None:
+                self.cell['text'].append(data)
+
+    def handle_entityref(self, name):
+        """Collect character references (only used on Python 2, Python 3 converts them to text)."""
+        self.handle_data(unescape('&%s;' % name))
+
+    def handle_charref(self, name):
+        """Collect character references (only used on Python 2, Python 3 converts them to text)."""
+        self.handle_data(unescape('&#%s;' % name))
+
+    def end_cell(self):
+        """Add the current cell to the current row."""
+        if self.cell is not None and self.row is not None:
+            text = ''.join(self.cell['text'])
+            if self.cell['tag'] == 'td':
+                self.row['cells'].append(text)
+            elif self.row['header'] is None:
+                self.row['header'] = text
+        self.cell = None
+
+    def end_row(self):
+        """Report the current row to :func:`handle_row()`."""
+        self.end_cell()
+        if self.row is not None:
+            row = TableRow(text=''.join(self.row['text']), header=self.row['header'],
+                           cells=self.row['cells'], links=self.row['links'])
+            self.row = None
+            if self.handle_row(self.open_tables[-1], row):
+                self.done = True
+
+    def handle_row(self, table, row):
+        """
+        Process a table row (to be overridden by subclasses).
+
+        :param table: The number of the table that contains the row (an integer).
+        :param row: A :class:`TableRow` object.
+        :returns: :data:`True` when the rest of the document isn't needed,
+                  :data:`False` otherwise (the default implementation
+                  ignores the row and returns :data:`False`).
+        """
+        return False
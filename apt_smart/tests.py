@@ -8,18 +8,68 @@
 
 # Standard library modules.
 import decimal
+import hashlib
 import logging
 import os
+import shutil
+import socket
+import stat
+import tempfile
+import threading
 import time
+import zlib
 
 # External dependencies.
 from executor import execute
-from humanfriendly.testing import TestCase, run_cli
+from humanfriendly.testing import CaptureOutput, PatchedAttribute, PatchedItem, TestCase, run_cli
+from six.moves.BaseHTTPServer import BaseHTTPRequestHandler, HTTPServer
+from six.moves.socketserver import ThreadingMixIn
+from stopit import TimeoutException
+try:
+    from property_manager3 import set_property
+except ImportError:
+    from property_manager import set_property
 # from humanfriendly.text import split
 
 # Modules included in our package.
-from apt_smart import AptMirrorUpdater, normalize_mirror_url, MirrorStatus
-from apt_smart.cli import main
+from apt_smart import AptMirrorUpdater, CandidateMirror, normalize_mirror_url, MirrorStatus, rank_by_bandwidth
+from apt_smart import location
+from apt_smart.backends import debian, ubuntu
+from apt_smart.backends.debian import MasterlistIndex, MirrorListParser
+from apt_smart.cache import HttpCache, RankingCache
+from apt_smart import cli
+from apt_smart.cli import main, report_available_mirrors
+from apt_smart.daemon import DaemonClient, DaemonError, RankingDaemon
+from apt_smart.health import CircuitBreaker, MirrorEstimate, MirrorHistory
+from apt_smart.http import (
+    ENGINE_PROCESSES,
+    ENGINE_THREADS,
+    HEDGE_DEFAULT_DELAY,
+    AdaptiveConcurrency,
+    ConnectionPool,
+    InvalidResponseError,
+    ProbeDigest,
+    BudgetExceededError,
+    NotFoundError,
+    Resolver,
+    ResponseTooLargeError,
+    TrafficShaper,
+    fetch_concurrent,
+    fetch_url,
+    fetch_worker,
+    get_concurrency_ceiling,
+    get_hedge_delay,
+    is_main_thread,
+    is_unresolvable,
+    latency_history,
+    digest_worker,
+    looks_like_release_file,
+    parse_index_sizes,
+    parse_release_date,
+    percentile,
+    probe_bandwidth,
+    url_exists,
+)
 from apt_smart.releases import (
     DEBIAN_KEYRING_CURRENT,
     UBUNTU_KEYRING_CURRENT,
@@ -28,6 +78,7 @@ from apt_smart.releases import (
     discover_releases,
     ubuntu_keyring_updated,
 )
+from apt_smart.tables import TableParser
 
 # Initialize a logger for this module.
 logger = logging.getLogger(__name__)
@@ -162,6 +213,736 @@ class AptMirrorUpdaterTestCase(TestCase):
         # Verify that package lists are again available.
         assert have_package_lists()
 
+    def test_fetch_concurrent_engines(self):
+        """Test that both :func:`.fetch_concurrent()` engines fetch the same data."""
+        with LocalServer({'/Release': RELEASE_CONTENTS}) as server:
+            urls = [server.url('/Release'), server.url('/missing')]
+            for engine in (ENGINE_THREADS, ENGINE_PROCESSES):
+                results = dict((url, data) for url, data, elapsed_time, timings in
+                               fetch_concurrent(urls, concurrency=2, engine=engine))
+                assert results[server.url('/Release')] == RELEASE_CONTENTS
+                assert results[server.url('/missing')] is None
+            self.assertRaises(ValueError, fetch_concurrent, urls, engine='unsupported')
+
+    def test_digest_worker(self):
+        """Test that :func:`.digest_worker()` summarizes Release files."""
+        assert parse_release_date(b'Origin: Ubuntu\nDate: Thu, 01 Jan 1970 00:01:00 UTC\n') == 60
+        assert parse_release_date(b'Date: Thu, 01 Jan 1970 01:01:00 +0100\n') == 60
+        assert parse_release_date(b'Origin: Ubuntu\n') is None
+        with LocalServer({'/Release': RELEASE_CONTENTS}) as server:
+            url, digest = digest_worker(server.url('/Release'))
+            assert digest.size == len(RELEASE_CONTENTS)
+            assert digest.date is not None
+            assert digest.body is None
+            url, digest = digest_worker(server.url('/Release'), keep_body=True)
+            assert digest.body == RELEASE_CONTENTS
+            assert digest_worker(server.url('/missing')) == (server.url('/missing'), None)
+
+    def test_fetch_url_in_thread(self):
+        """Test that :func:`.fetch_url()` works outside of the main thread."""
+        assert is_main_thread()
+        results = []
+        with LocalServer({'/Release': RELEASE_CONTENTS}) as server:
+            url = server.url('/Release')
+            thread = threading.Thread(target=lambda: results.append((is_main_thread(), fetch_url(url))))
+            thread.start()
+            thread.join()
+        assert results == [(False, RELEASE_CONTENTS)]
+
+    def test_connection_pool(self):
+        """Test that :class:`.ConnectionPool` reuses connections and follows redirects."""
+        pool = ConnectionPool()
+        with LocalServer({'/Release': RELEASE_CONTENTS, '/redirect': b'/Release'}) as server:
+            for i in range(3):
+                assert fetch_url(server.url('/Release'), pool=pool) == RELEASE_CONTENTS
+            assert fetch_url(server.url('/redirect'), pool=pool) == RELEASE_CONTENTS
+            self.assertRaises(NotFoundError, fetch_url, server.url('/missing'), pool=pool)
+            assert len(server.connections) == 1
+            # Reused connections don't pay for name resolution or connecting.
+            timings = {}
+            fetch_url(server.url('/Release'), pool=pool, timings=timings)
+            assert timings['dns'] == 0 and timings['connect'] == 0 and timings['tls'] is None
+            assert timings['ttfb'] > 0
+        pool.close()
+
+    def test_http_cache(self):
+        """Test that :class:`.HttpCache` avoids downloads and revalidates stale responses."""
+        directory = tempfile.mkdtemp()
+        try:
+            cache = HttpCache(directory)
+            with LocalServer({'/mirrors': b'mirror list', '/other': b'x' * 1024}) as server:
+                url = server.url('/mirrors')
+                assert fetch_url(url, cache=cache) == b'mirror list'
+                # Fresh responses are served without network traffic.
+                assert fetch_url(url, cache=cache) == b'mirror list'
+                assert len(server.requests) == 1
+                # Stale responses are revalidated using a conditional request.
+                cache.ttl = 0
+                assert fetch_url(url, cache=cache) == b'mirror list'
+                assert len(server.requests) == 2
+                assert 'If-None-Match' in server.requests[-1][2]
+                # The least recently used response is evicted to respect the size limit.
+                cache.max_size = 1024
+                assert fetch_url(server.url('/other'), cache=cache) == b'x' * 1024
+                assert cache.lookup(url) is None
+                assert cache.lookup(server.url('/other')) is not None
+                # The Ubuntu mirror selection goes through the cache of the updater.
+                cache.max_size = 1024 * 1024
+                updater = AptMirrorUpdater(distributor_id='ubuntu', cache_directory=directory)
+                with PatchedAttribute(ubuntu, 'MIRROR_SELECTION_URL', server.url('/mirrors.txt')):
+                    server.responses['/mirrors.txt'] = b'http://archive.ubuntu.com/ubuntu/\n'
+                    mirrors = ubuntu.discover_mirror_selection(updater)
+                assert [c.mirror_url for c in mirrors] == ['http://archive.ubuntu.com/ubuntu']
+                assert updater.http_cache.lookup(server.url('/mirrors.txt')) is not None
+        finally:
+            shutil.rmtree(directory)
+
+    def test_streaming_mirror_list(self):
+        """Test that the mirror pages are parsed incrementally and stop downloading after the relevant rows."""
+        page = b''.join([
+            b'<html><body><table><tr><td><a href="http://ftp.debian.org/debian/">ftp.debian.org</a></td></tr></table>',
+            b'<table><tr><td colspan="2"><big><strong>Germany</strong></big></td></tr>',
+            # The end tags of table rows are optional.
+            b'<tr><td><a href="http://ftp.de.debian.org/debian/">ftp.de.debian.org</a></td>',
+            b'<tr><td><a href="http://ftp2.de.debian.org/debian/">ftp2.de.debian.org</a></td>',
+            b'<tr><td colspan="2"><big><strong>Netherlands</strong></big></td></tr>',
+            b'<tr><td><a href="http://ftp.nl.debian.org/debian/">ftp.nl.debian.org</a></td></tr>',
+            b'<tr><td>padding</td></tr>' * 1024 * 64,
+            b'</table></body></html>',
+        ])
+        # Chunks that split tags and text are handled.
+        parser = MirrorListParser('Germany')
+        for offset in range(0, len(page), 7):
+            if parser.feed(page[offset:offset + 7]):
+                break
+        assert offset < 1024
+        assert parser.primary_mirrors == ['http://ftp.debian.org/debian/']
+        assert parser.country_mirrors == ['http://ftp.de.debian.org/debian/', 'http://ftp2.de.debian.org/debian/']
+        directory = tempfile.mkdtemp()
+        try:
+            with LocalServer({'/mirrors': page}) as server:
+                url = server.url('/mirrors')
+                parser = fetch_url(url, parser=lambda: MirrorListParser('Netherlands'))
+                assert parser.done
+                assert parser.country_mirrors == ['http://ftp.nl.debian.org/debian/']
+                # With a cache the complete response is downloaded and cached
+                # even though the parser stops early.
+                cache = HttpCache(directory, ttl=0)
+                parser = fetch_url(url, cache=cache, parser=lambda: MirrorListParser('Germany'))
+                assert parser.done
+                assert len(parser.country_mirrors) == 2
+                assert cache.lookup(url).body == page
+                # The cached response is revalidated using a conditional
+                # request, the server answers 304 Not Modified (so nothing is
+                # stored) and the cached response is parsed.
+                stored = []
+                with PatchedAttribute(cache, 'store', lambda *args, **kw: stored.append(args)):
+                    parser = fetch_url(url, cache=cache, parser=lambda: MirrorListParser('Germany'))
+                assert 'If-None-Match' in server.requests[-1][2]
+                assert not stored
+                assert parser.done
+                assert len(parser.country_mirrors) == 2
+        finally:
+            shutil.rmtree(directory)
+
+    def test_table_parser(self):
+        """Test that :class:`.TableParser` works without a subclass and converts character references."""
+        page = b'<table><tr><th>Caf&eacute;</th><td>Fish &amp; chips &#8364;5</td></tr></table>'
+        assert TableParser().feed(page) is False
+        rows = []
+
+        class RowRecorder(TableParser):
+            def handle_row(self, table, row):
+                rows.append(row)
+
+        parser = RowRecorder()
+        # Make Python 3 report character references like Python 2 does.
+        parser.convert_charrefs = False
+        parser.feed(page)
+        assert rows[0].header == u'Caf\xe9'
+        assert rows[0].cells == [u'Fish & chips \u20ac5']
+
+    def test_debian_masterlist(self):
+        """Test that Debian mirrors are discovered using an index of the masterlist that's cached on disk."""
+        # Records in the format of the real masterlist (trimmed to the relevant fields).
+        masterlist = b'\n\n'.join([
+            b'Site: ftp.de.debian.org\nType: Push-Primary\nArchive-architecture: amd64 i386\n'
+            b'Archive-http: /debian/\nArchive-rsync: debian/\nIPv6: yes\nArchive-upstream: syncproxy.eu.debian.org\n'
+            b'Country: DE Germany\nLocation: Erlangen\nSponsor: Friedrich-Alexander-University https://www.fau.de/',
+            b'Site: mirror.example.de\nType: leaf\nArchive-architecture: any !i386\n'
+            b'Archive-http: /debian/\nArchive-https: /debian/\nIPv6: no\nArchive-upstream: ftp.de.debian.org\n'
+            b'Country: DE Germany\nSponsor: Example GmbH https://example.de/',
+            b'Site: ftp.nl.debian.org\nType: Push-Primary\nArchive-architecture: ALL\n'
+            b'Archive-https: /debian/\nArchive-rsync: debian/\nCountry: NL Netherlands\nLocation: Amsterdam',
+            b'Site: mirror.example.com\nType: Push-Secondary\nArchive-architecture: ALL\n'
+            b'Archive-http: /debian/\nArchive-rsync: debian/\nCountry: US United States',
+        ])
+        directory = tempfile.mkdtemp()
+        try:
+            with LocalServer({'/Mirrors.masterlist': masterlist}) as server:
+                with PatchedAttribute(debian, 'MASTERLIST_URL', server.url('/Mirrors.masterlist')):
+                    updater = AptMirrorUpdater(distributor_id='debian', distribution_codename='buster',
+                                               architecture='amd64', cache_directory=directory)
+                    index = MasterlistIndex.load(updater)
+                    # Mirrors are filtered by country, architecture and protocol.
+                    assert index.lookup('Germany', 'amd64') == ['http://ftp.de.debian.org/debian/',
+                                                                'http://mirror.example.de/debian/']
+                    assert index.lookup('DE', 'i386') == ['http://ftp.de.debian.org/debian/']
+                    assert index.lookup('Germany', 'amd64', protocols=('https',)) == [
+                        'https://mirror.example.de/debian/',
+                    ]
+                    assert index.lookup(None, 'amd64') == ['http://ftp.de.debian.org/debian/',
+                                                           'https://ftp.nl.debian.org/debian/']
+                    # The cached index is used while the masterlist doesn't change.
+                    with PatchedAttribute(MasterlistIndex, 'parse', None):
+                        mirrors = debian.discover_masterlist_mirrors(updater, 'Germany')
+                    assert sorted(c.mirror_url for c in mirrors) == ['http://ftp.de.debian.org/debian',
+                                                                     'http://mirror.example.de/debian',
+                                                                     'https://ftp.nl.debian.org/debian']
+        finally:
+            shutil.rmtree(directory)
+
+    def test_ranking_cache(self):
+        """Test that :attr:`.AptMirrorUpdater.ranking_cache` avoids ranking the mirrors on every run."""
+        directory = tempfile.mkdtemp()
+        try:
+            with LocalServer({'/base/dists/bionic-security/Release': RELEASE_CONTENTS}) as server:
+
+                def create_updater(**options):
+                    updater = AptMirrorUpdater(distributor_id='ubuntu', distribution_codename='bionic',
+                                               architecture='amd64', cache_directory=directory,
+                                               base_url=server.url('/base/dists/bionic-security/Release'),
+                                               **options)
+                    set_property(updater, 'release_is_eol', False)
+                    set_property(updater, 'available_mirrors', [
+                        CandidateMirror(mirror_url=server.url(path), updater=updater)
+                        for path in ('/base', '/broken')
+                    ])
+                    return updater
+
+                updater = create_updater()
+                ranked = updater.ranked_mirrors
+                assert updater.ranking_source is None and updater.ranking_age is None
+                num_requests = len(server.requests)
+                # A fresh ranking is served from the cache without any requests.
+                updater = create_updater()
+                cached = updater.ranked_mirrors
+                assert len(server.requests) == num_requests
+                assert updater.ranking_source == 'cache' and updater.ranking_age >= 0
+                # Mirrors from a cached ranking aren't reported as tested.
+                with PatchedAttribute(cli, 'connected_to_terminal', lambda: True):
+                    with CaptureOutput() as capturer:
+                        report_available_mirrors(create_updater())
+                    assert "Tested" not in capturer.get_text()
+                    assert "Using cached ranking (from " in capturer.get_text()
+                assert [c.mirror_url for c in cached] == [c.mirror_url for c in ranked]
+                assert [c.is_available for c in cached] == [True, False]
+                assert cached[0].release_date == ranked[0].release_date
+                # The key depends on the blacklist.
+                updater = create_updater()
+                updater.blacklist.add('*/nonexisting/*')
+                assert updater.get_cached_ranking() is None
+                # The key depends on the options that change the order of the mirrors.
+                assert create_updater(tournament=True).get_cached_ranking() is None
+                assert create_updater(samples=3).get_cached_ranking() is None
+                assert create_updater(bandwidth_probe=True).get_cached_ranking() is None
+                assert create_updater(scoring_policy=rank_by_bandwidth).get_cached_ranking() is None
+                assert create_updater(ranking_budget=1024 * 1024).get_cached_ranking() is None
+                # Expired rankings are only used with stale-while-revalidate.
+                assert create_updater(ranking_cache_ttl=0).get_cached_ranking() is None
+                updater = create_updater(ranking_cache_ttl=0, stale_while_revalidate=True)
+                mirrors, age = updater.ranking_cache.lookup(updater.ranking_cache_key)
+                assert len(updater.get_cached_ranking()) == 2
+                # Wait for the background refresh to store a new ranking.
+                lock_file = updater.ranking_cache.get_filename(updater.ranking_cache_key, '.lock')
+                timer = time.time()
+                while os.path.exists(lock_file) and time.time() - timer < 30:
+                    time.sleep(0.1)
+                assert updater.ranking_cache.lookup(updater.ranking_cache_key)[1] < age
+                assert len(server.requests) > num_requests
+                # Ignoring a ranked mirror invalidates the cached ranking.
+                updater.ignore_mirror(server.url('/broken'))
+                updater.blacklist.clear()
+                assert updater.ranking_cache.lookup(updater.ranking_cache_key) is None
+                assert isinstance(updater.ranking_cache, RankingCache)
+        finally:
+            shutil.rmtree(directory)
+
+    def test_fetch_url_limits(self):
+        """Test that :func:`.fetch_url()` aborts oversized and invalid responses."""
+        squatted = b'<html>' + b'x' * 1024 * 64
+        with LocalServer({'/Release': RELEASE_CONTENTS, '/squatted': squatted}) as server:
+            assert fetch_url(server.url('/Release'), max_size=1024, validate=looks_like_release_file)
+            self.assertRaises(ResponseTooLargeError, fetch_url, server.url('/squatted'), max_size=1024)
+            self.assertRaises(InvalidResponseError, fetch_url, server.url('/squatted'),
+                              validate=looks_like_release_file)
+
+    def test_hedged_requests(self):
+        """Test that :func:`.fetch_url()` sends a hedged request when the server is slow to respond."""
+        latency_history.clear()
+        with LocalServer({'/slow': b'mirror list', '/fast': b'mirror list'},
+                         stalls={'/slow': 3}) as server:
+            timer = time.time()
+            assert fetch_url(server.url('/slow'), hedge=True, alternates=[server.url('/fast')]) == b'mirror list'
+            assert time.time() - timer < 2.5
+            assert [path for command, path, headers in server.requests] == ['/slow', '/fast']
+            self.assertRaises(NotFoundError, fetch_url, server.url('/missing'), hedge=True)
+            assert server.requests[-1][1] == '/missing'
+            assert get_hedge_delay(server.url('/slow')) >= 0.2
+            # Latencies are tracked per host.
+            assert get_hedge_delay('http://mirror.example.com/Release') == HEDGE_DEFAULT_DELAY
+            # A failed request is followed by another one right away (even
+            # though the first request is still pending).
+            latency_history.clear()
+            timer = time.time()
+            assert fetch_url(server.url('/slow'), hedge=True,
+                             alternates=[server.url('/missing'), server.url('/fast')]) == b'mirror list'
+            assert time.time() - timer < HEDGE_DEFAULT_DELAY * 1.8
+            # The timeout is an overall deadline even though the requests run in background threads.
+            timer = time.time()
+            self.assertRaises(TimeoutException, fetch_url, server.url('/slow'), hedge=True, timeout=2)
+            assert time.time() - timer < 2.5
+
+    def test_compressed_transfer(self):
+        """Test that :func:`.fetch_url()` negotiates and decompresses gzip encoded responses."""
+        page = b'<html>' + b'<tr><td>mirror</td></tr>' * 4096 + b'</html>'
+        with LocalServer({'/mirrors.html': page, '/Release': RELEASE_CONTENTS}, compress=True) as server:
+            assert fetch_url(server.url('/mirrors.html')) == page
+            assert server.requests[-1][2]['Accept-Encoding'] == 'gzip, deflate'
+            self.assertRaises(ResponseTooLargeError, fetch_url, server.url('/mirrors.html'), max_size=1024 * 64)
+            url, data, elapsed_time, timings = fetch_worker(server.url('/Release'))
+            assert data == RELEASE_CONTENTS
+            assert server.requests[-1][2].get('Accept-Encoding', 'identity') == 'identity'
+
+    def test_probe_bandwidth(self):
+        """Test that :func:`.probe_bandwidth()` only downloads the requested byte range."""
+        for ranges in (True, False):
+            with LocalServer({'/Packages.xz': b'x' * 1024 * 1024}, ranges=ranges) as server:
+                assert probe_bandwidth(server.url('/Packages.xz'), size=1024 * 256) > 0
+                assert server.requests[-1][2]['Range'] == 'bytes=0-262143'
+                self.assertRaises(NotFoundError, probe_bandwidth, server.url('/missing'))
+
+    def test_traffic_shaper(self):
+        """Test that :class:`.TrafficShaper` enforces the rate limit, byte budget and per host limit."""
+        with LocalServer({'/Release': RELEASE_CONTENTS, '/large': b'x' * 1024 * 64,
+                          '/Packages.xz': b'x' * 1024 * 256}) as server:
+            shaper = TrafficShaper(rate=1024 * 128, budget=1024 * 96, per_host=1)
+            pool = ConnectionPool(shaper=shaper)
+            timer = time.time()
+            assert fetch_url(server.url('/large'), pool=pool) == b'x' * 1024 * 64
+            # The second download exceeds the 96 KB budget.
+            self.assertRaises(BudgetExceededError, fetch_url, server.url('/large'), pool=pool)
+            assert shaper.consumed > shaper.budget
+            self.assertRaises(BudgetExceededError, fetch_url, server.url('/Release'), pool=pool)
+            assert time.time() - timer < 5
+            # Validating a mirror isn't subject to the ranking budget.
+            responses = {'/base/dists/bionic-security/Release': RELEASE_CONTENTS}
+            with LocalServer(responses) as other:
+                updater = AptMirrorUpdater(distributor_id='ubuntu', distribution_codename='bionic',
+                                           use_cache=False, ranking_budget=1024)
+                updater.base_last_updated = 0
+                updater.traffic_shaper.consumed = 1024
+                assert updater.validate_mirror(other.url('/base')) == MirrorStatus.AVAILABLE
+                assert updater.traffic_shaper.consumed == 1024
+            # Bandwidth probes count against the budget but aren't throttled
+            # (reading 256 KB at 64 KB per second would take three seconds).
+            shaper = TrafficShaper(rate=1024 * 64)
+            timer = time.time()
+            assert probe_bandwidth(server.url('/Packages.xz'), size=1024 * 256, pool=ConnectionPool(shaper=shaper)) > 0
+            assert shaper.consumed == 1024 * 256
+            assert time.time() - timer < 2
+            shaper = TrafficShaper(per_host=1)
+            active = []
+            concurrent = []
+
+            def worker(url, pool=None):
+                active.append(url)
+                concurrent.append(len(active))
+                time.sleep(0.05)
+                active.remove(url)
+                return url, True
+
+            fetch_concurrent([server.url('/Release')] * 4, concurrency=4, worker=worker,
+                             pool=ConnectionPool(shaper=shaper))
+            assert max(concurrent) == 1
+            assert str(shaper) == "1 simultaneous requests per host"
+
+    def test_url_exists(self):
+        """Test that :func:`.url_exists()` uses ``HEAD`` requests and falls back to ``GET``."""
+        for head in (True, False):
+            with LocalServer({'/Archive-Update-in-Progress': b'x' * 1024}, head=head) as server:
+                pool = ConnectionPool()
+                assert url_exists(server.url('/Archive-Update-in-Progress'), pool=pool)
+                assert not url_exists(server.url('/missing'), pool=pool)
+                methods = [command for command, path, headers in server.requests]
+                assert methods == (['HEAD', 'HEAD'] if head else ['HEAD', 'GET', 'HEAD', 'GET'])
+                assert len(server.connections) == 1
+                pool.close()
+
+    def test_adaptive_concurrency(self):
+        """Test that :class:`.AdaptiveConcurrency` grows on healthy rounds and backs off on timeouts."""
+        assert 1 <= get_concurrency_ceiling() <= 256
+        controller = AdaptiveConcurrency(initial=4, maximum=16)
+        for i in range(4):
+            controller.in_flight += 1
+            controller.record(failed=False, elapsed_time=0.1)
+        assert controller.limit == 6
+        for i in range(6):
+            controller.in_flight += 1
+            controller.record(failed=True, elapsed_time=10)
+        assert controller.limit == 3
+        with LocalServer({'/Release': RELEASE_CONTENTS}) as server:
+            urls = [server.url('/Release')] * 20 + [server.url('/missing')]
+            results = fetch_concurrent(urls, concurrency=2, adaptive=True, pool=ConnectionPool())
+            assert [url for url, data, elapsed_time, timings in results] == urls
+            assert all(data == RELEASE_CONTENTS for url, data, elapsed_time, timings in results[:-1])
+            assert results[-1][1] is None
+        # A fixed pool of worker threads is reused for all URLs.
+        threads = set()
+
+        def worker(url):
+            threads.add(threading.current_thread().ident)
+            time.sleep(0.01)
+            return url, url
+
+        controller = AdaptiveConcurrency(initial=2, maximum=4)
+        urls = ['http://mirror%i' % i for i in range(50)]
+        assert [url for url, data in controller.imap(worker, urls)] == urls
+        assert len(threads) <= 4
+        assert controller.in_flight == 0
+
+    def test_circuit_breaker(self):
+        """Test that :class:`.CircuitBreaker` skips hosts that keep failing and persists its state."""
+        directory = tempfile.mkdtemp()
+        try:
+            filename = os.path.join(directory, 'circuit-breaker.json')
+            breaker = CircuitBreaker(filename, threshold=2, cooldown=60)
+            breaker.record_failure('dead.example.com')
+            assert breaker.allow('dead.example.com')
+            breaker.record_failure('dead.example.com')
+            assert not breaker.allow('dead.example.com')
+            breaker.save()
+            # The state persists across runs.
+            breaker = CircuitBreaker(filename, threshold=2, cooldown=60)
+            assert not breaker.allow('dead.example.com')
+            # After the cool-down a single half-open probe is allowed,
+            # when it fails the cool-down doubles.
+            breaker.hosts['dead.example.com']['opened'] -= 60
+            assert breaker.allow('dead.example.com')
+            assert not breaker.allow('dead.example.com')
+            breaker.record_failure('dead.example.com')
+            assert not breaker.allow('dead.example.com')
+            assert breaker.hosts['dead.example.com']['cooldown'] == 120
+            breaker.record_success('dead.example.com')
+            assert breaker.allow('dead.example.com')
+        finally:
+            shutil.rmtree(directory)
+
+    def test_ranking_daemon(self):
+        """Test that :class:`.RankingDaemon` answers queries and can be used by :class:`.AptMirrorUpdater`."""
+        directory = tempfile.mkdtemp()
+        try:
+            socket_path = os.path.join(directory, 'daemon.sock')
+            with LocalServer({'/base/dists/bionic-security/Release': RELEASE_CONTENTS}) as server:
+
+                def create_updater(architecture='amd64', **options):
+                    updater = AptMirrorUpdater(distributor_id='ubuntu', distribution_codename='bionic',
+                                               architecture=architecture, use_cache=False,
+                                               current_mirror=server.url('/base'),
+                                               base_url=server.url('/base/dists/bionic-security/Release'),
+                                               **options)
+                    set_property(updater, 'release_is_eol', False)
+                    # Mirror discovery runs again for every ranking.
+                    set_property(updater, 'backend', type('Backend', (), dict(
+                        BASE_URL=server.url('/base/dists/codename-security/Release'),
+                        VALID_COMPONENTS=('main',),
+                        discover_mirrors=staticmethod(lambda updater: [
+                            CandidateMirror(mirror_url=server.url(path)) for path in ('/base', '/broken')
+                        ]),
+                    )))
+                    set_property(updater, 'read_custom_mirror_file', None)
+                    return updater
+
+                # A stale socket (nothing listening) is replaced.
+                stale = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+                stale.bind(socket_path)
+                stale.close()
+                updater = create_updater()
+                daemon = RankingDaemon(updater, socket_path=socket_path)
+                # Per user sockets are only accessible to their owner.
+                assert stat.S_IMODE(os.stat(socket_path).st_mode) == 0o600
+                resolver = updater.connection_pool.resolver
+                thread = threading.Thread(target=daemon.serve)
+                thread.daemon = True
+                thread.start()
+                try:
+                    client = DaemonClient(socket_path)
+                    assert daemon.ranked.wait(30)
+                    # Every refresh resolves the host names of the mirrors again.
+                    assert updater.connection_pool.resolver is not resolver
+                    assert client.query('best_mirror') == server.url('/base')
+                    assert client.query('current_mirror') == dict(mirror_url=server.url('/base'), healthy=True)
+                    self.assertRaises(DaemonError, client.query, 'nonexisting')
+                    # The updater gets its ranking from the daemon without probing the mirrors.
+                    num_requests = len(server.requests)
+                    ranked = create_updater(daemon_socket=socket_path).ranked_mirrors
+                    assert [c.mirror_url for c in ranked] == [server.url('/base'), server.url('/broken')]
+                    assert len(server.requests) == num_requests
+                    # A ranking made with different parameters isn't used.
+                    assert create_updater(daemon_socket=socket_path, architecture='i386').get_daemon_ranking() is None
+                    # A second daemon refuses to take over the socket of a running one.
+                    self.assertRaises(DaemonError, RankingDaemon, create_updater(), socket_path=socket_path)
+                    assert client.query('best_mirror') == server.url('/base')
+                finally:
+                    daemon.shutdown()
+                    thread.join()
+                assert not os.path.exists(socket_path)
+        finally:
+            shutil.rmtree(directory)
+
+    def test_mirror_history(self):
+        """Test that :class:`.MirrorHistory` smooths samples and persists them."""
+        directory = tempfile.mkdtemp()
+        try:
+            filename = os.path.join(directory, 'history.sqlite3')
+            history = MirrorHistory(filename, alpha=0.5)
+            assert history.estimate('http://a') is None
+            history.record('http://a', True, latency=0.1, bandwidth=1000, last_updated=0)
+            estimate = history.record('http://a', True, latency=0.3, bandwidth=3000, last_updated=60)
+            assert estimate == (1.0, 0.2, 2000, 30, 2)
+            # Failures only affect the availability estimate.
+            estimate = history.record('http://a', False)
+            assert estimate == (0.5, 0.2, 2000, 30, 3)
+            history.save()
+            # The estimates persist across runs.
+            assert MirrorHistory(filename).estimate('http://a') == estimate
+            # Reliable mirrors are probed before unknown and unreliable mirrors.
+            reliable, unknown, flaky = (CandidateMirror(mirror_url='http://%s' % name) for name in 'rux')
+            reliable.estimate = history.record('http://r', True, latency=1)
+            flaky.estimate = history.record('http://x', False)
+            assert sorted([flaky, unknown, reliable], key=lambda c: c.prior_key) == [reliable, unknown, flaky]
+        finally:
+            shutil.rmtree(directory)
+
+    def test_iter_ranked_mirrors(self):
+        """Test that :func:`.AptMirrorUpdater.iter_ranked_mirrors()` yields mirrors as they are tested."""
+        older = RELEASE_CONTENTS.replace(b'08:07:54', b'06:07:54')
+        with LocalServer({'/base/dists/bionic-security/Release': RELEASE_CONTENTS,
+                          '/old/dists/bionic-security/Release': older}) as server:
+            updater = AptMirrorUpdater(distributor_id='ubuntu', distribution_codename='bionic', use_cache=False,
+                                       base_url=server.url('/base/dists/bionic-security/Release'))
+            set_property(updater, 'release_is_eol', False)
+            set_property(updater, 'available_mirrors', [
+                CandidateMirror(mirror_url=server.url(path), updater=updater)
+                for path in ('/base', '/old', '/broken')
+            ])
+            # The update marker of each mirror is checked right after its Release file.
+            marker = '/old/Archive-Update-in-Progress-127.0.0.1:%i' % server.server_address[1]
+            server.responses[marker] = b''
+            tested = dict((c.mirror_url, c.is_updating) for c in updater.iter_ranked_mirrors())
+            assert sorted(tested) == sorted(server.url(path) for path in ('/base', '/old', '/broken'))
+            assert tested[server.url('/old')] and not tested[server.url('/base')]
+            assert updater.provisional_best_mirror.mirror_url == server.url('/base')
+            ranked = updater.ranked_mirrors
+            assert [c.mirror_url for c in ranked] == [server.url(path) for path in ('/base', '/old', '/broken')]
+            assert ranked[1].last_updated == 60 * 60 * 2
+            # The Release files are summarized instead of kept in memory.
+            assert ranked[0].release_gpg_contents is None
+            assert ranked[0].probe_digest.size == len(RELEASE_CONTENTS)
+            assert ranked[0].release_date == parse_release_date(RELEASE_CONTENTS)
+            assert ranked[2].probe_digest is None
+            # Failures while the base mirror is down (think offline runs) don't open circuits.
+            del server.responses['/base/dists/bionic-security/Release']
+            updater = AptMirrorUpdater(distributor_id='ubuntu', distribution_codename='bionic', use_cache=False,
+                                       base_url=server.url('/base/dists/bionic-security/Release'))
+            set_property(updater, 'release_is_eol', False)
+            set_property(updater, 'available_mirrors', [
+                CandidateMirror(mirror_url=server.url(path), updater=updater) for path in ('/base', '/broken')
+            ])
+            self.assertRaises(Exception, list, updater.iter_ranked_mirrors())
+            assert not updater.circuit_breaker.hosts
+            # Hosts whose circuit is open aren't resolved and their cool-down isn't extended.
+            server.responses['/base/dists/bionic-security/Release'] = RELEASE_CONTENTS
+            updater = AptMirrorUpdater(distributor_id='ubuntu', distribution_codename='bionic', use_cache=False,
+                                       base_url=server.url('/base/dists/bionic-security/Release'))
+            set_property(updater, 'release_is_eol', False)
+            set_property(updater, 'available_mirrors', [
+                CandidateMirror(mirror_url=url, updater=updater)
+                for url in (server.url('/base'), 'http://dead.example.invalid/ubuntu')
+            ])
+            state = dict(failures=3, opened=time.time(), cooldown=60)
+            updater.circuit_breaker.hosts['dead.example.invalid'] = dict(state)
+            resolved = []
+            prefetch = updater.connection_pool.resolver.prefetch
+
+            def record_prefetch(hosts):
+                hosts = list(hosts)
+                resolved.extend(hosts)
+                return prefetch(hosts)
+
+            with PatchedAttribute(updater.connection_pool.resolver, 'prefetch', record_prefetch):
+                assert len(updater.ranked_mirrors) == 2
+            assert resolved == ['127.0.0.1']
+            assert updater.circuit_breaker.hosts['dead.example.invalid'] == state
+
+    def test_multiple_samples(self):
+        """Test that :attr:`.AptMirrorUpdater.samples` ranks mirrors on the median and tail of their samples."""
+        assert percentile([], 50) is None
+        assert percentile([3, 1, 2], 50) == 2
+        assert percentile(range(100), 95) == 95
+
+        def sample(elapsed_time):
+            return ProbeDigest(status=200, size=1000, date=0, sha256=None, elapsed_time=elapsed_time,
+                               timings=dict(ttfb=elapsed_time / 2), body=None, index_count=None, index_size=None)
+
+        consistent, lucky = CandidateMirror(mirror_url='http://a'), CandidateMirror(mirror_url='http://b')
+        for elapsed_time in (0.2, 0.2, 0.2):
+            consistent.add_sample(sample(elapsed_time))
+        for digest in (sample(0.1), sample(0.1), None):
+            lucky.add_sample(digest)
+        assert consistent.median_bandwidth == 5000 and lucky.median_bandwidth == 10000
+        assert consistent.p95_latency == 0.1 and lucky.p95_latency == 0.05
+        assert consistent.bandwidth > lucky.bandwidth
+        with LocalServer({'/base/dists/bionic-security/Release': RELEASE_CONTENTS}) as server:
+            updater = AptMirrorUpdater(distributor_id='ubuntu', distribution_codename='bionic', use_cache=False,
+                                       samples=3, base_url=server.url('/base/dists/bionic-security/Release'))
+            set_property(updater, 'release_is_eol', False)
+            set_property(updater, 'available_mirrors', [CandidateMirror(mirror_url=server.url('/base'),
+                                                                        updater=updater)])
+            candidate = updater.ranked_mirrors[0]
+            assert len(candidate.bandwidth_samples) == 3
+            assert len(candidate.latency_samples) == 3
+            assert candidate.bandwidth > 0
+
+    def test_scoring_policy(self):
+        """Test that mirrors are ranked by the predicted duration of ``apt-get update``."""
+        release = RELEASE_CONTENTS + b"""SHA256:
+ 0000 1000000 main/binary-amd64/Packages
+ 0000 200000 main/binary-amd64/Packages.xz
+ 0000 300000 main/binary-amd64/Packages.gz
+ 0000 50000 main/i18n/Translation-en.bz2
+ 0000 9999 main/binary-i386/Packages.xz
+"""
+        index_files = ['main/binary-amd64/Packages', 'main/i18n/Translation-en', 'universe/binary-amd64/Packages']
+        assert parse_index_sizes(release, index_files) == (2, 250000)
+        # A mirror with high bandwidth but a long round trip time loses to a
+        # mirror with slightly lower bandwidth and a short round trip time.
+        distant = CandidateMirror(mirror_url='http://distant', is_available=True, is_updating=False,
+                                  last_updated=0, bandwidth=10 ** 6, first_byte_time=0.5,
+                                  index_count=50, index_size=10 ** 6)
+        nearby = CandidateMirror(mirror_url='http://nearby', is_available=True, is_updating=False,
+                                 last_updated=0, bandwidth=8 * 10 ** 5, first_byte_time=0.01,
+                                 index_count=50, index_size=10 ** 6)
+        assert nearby.predicted_update_time < distant.predicted_update_time
+        assert nearby.sort_key > distant.sort_key
+        assert rank_by_bandwidth(distant) > rank_by_bandwidth(nearby)
+        # The bandwidth measured during this run takes precedence over the
+        # history, which is only used for mirrors that weren't measured.
+        distant.estimate = MirrorEstimate(availability=1, latency=0.5, bandwidth=10 ** 3, last_updated=0, samples=9)
+        nearby.estimate = MirrorEstimate(availability=1, latency=0.01, bandwidth=10 ** 7, last_updated=0, samples=9)
+        assert rank_by_bandwidth(distant) > rank_by_bandwidth(nearby)
+        assert nearby.predicted_update_time < distant.predicted_update_time
+        nearby.bandwidth = None
+        assert rank_by_bandwidth(nearby) > rank_by_bandwidth(distant)
+        with LocalServer({'/base/dists/bionic-security/Release': release}) as server:
+            updater = AptMirrorUpdater(distributor_id='ubuntu', distribution_codename='bionic', use_cache=False,
+                                       architecture='amd64', scoring_policy=rank_by_bandwidth,
+                                       base_url=server.url('/base/dists/bionic-security/Release'))
+            set_property(updater, 'release_is_eol', False)
+            set_property(updater, 'available_mirrors', [CandidateMirror(mirror_url=server.url('/base'),
+                                                                        updater=updater)])
+            candidate = updater.ranked_mirrors[0]
+            assert (candidate.index_count, candidate.index_size) == (2, 250000)
+            assert candidate.sort_key == rank_by_bandwidth(candidate)
+
+    def test_tournament(self):
+        """Test that :attr:`.AptMirrorUpdater.tournament` only probes the bandwidth of the best mirrors."""
+        names = ['base'] + ['mirror%i' % i for i in range(9)]
+        responses = {}
+        for name in names:
+            responses['/%s/dists/bionic-security/Release' % name] = RELEASE_CONTENTS
+            responses['/%s/dists/bionic/main/binary-amd64/Packages.xz' % name] = b'x' * 1024 * 1024
+        with LocalServer(responses) as server:
+            updater = AptMirrorUpdater(distributor_id='ubuntu', distribution_codename='bionic', use_cache=False,
+                                       architecture='amd64', tournament=True,
+                                       base_url=server.url('/base/dists/bionic-security/Release'))
+            set_property(updater, 'release_is_eol', False)
+            set_property(updater, 'available_mirrors', [
+                CandidateMirror(mirror_url=server.url('/' + name), updater=updater) for name in names
+            ])
+            ranked = updater.ranked_mirrors
+            ranges = [r for r in server.requests if r[1].endswith('Packages.xz')]
+            assert len(ranges) == 5 + 4
+            assert [c.tournament_round for c in ranked] == [3] * 4 + [2] + [1] * 5
+            assert all(ranked[i].predicted_update_time <= ranked[i + 1].predicted_update_time for i in range(3))
+            # The history records the bandwidth of the Release file fetch, not that of the tournament.
+            finalist = ranked[0]
+            estimate = updater.mirror_history.estimate(finalist.mirror_url)
+            assert estimate.bandwidth == finalist.probe_digest.size / finalist.release_gpg_latency
+            assert estimate.bandwidth != finalist.bandwidth
+
+    def test_location_resolver(self):
+        """Test that :class:`.LocationResolver` finds the country without network traffic when it can."""
+        directory = tempfile.mkdtemp()
+        try:
+            with open(os.path.join(directory, 'iso3166.tab'), 'w') as handle:
+                handle.write('# ISO 3166 alpha-2 country codes\nGB\tBritain (UK)\nNL\tNetherlands\n')
+            with open(os.path.join(directory, 'zone.tab'), 'w') as handle:
+                handle.write('# tz zone descriptions\nNL\t+5222+00454\tEurope/Amsterdam\n')
+            resolver = location.LocationResolver(os.path.join(directory, 'location.json'))
+            with PatchedAttribute(location, 'ZONEINFO_DIRECTORY', directory):
+                # The time zone is mapped to a country.
+                with PatchedAttribute(location, 'get_system_timezone', lambda: 'Europe/Amsterdam'):
+                    assert resolver.from_timezone() == 'Netherlands'
+                with PatchedAttribute(location, 'get_system_timezone', lambda: 'Etc/UTC'):
+                    assert resolver.from_timezone() is None
+                # The territory of the locale is mapped to a country (with the
+                # name used by the geolocation services).
+                with PatchedItem(os.environ, 'LC_ALL', ''), PatchedItem(os.environ, 'LC_MESSAGES', ''):
+                    with PatchedItem(os.environ, 'LANG', 'en_GB.UTF-8'):
+                        assert resolver.from_locale() == 'United Kingdom'
+                    with PatchedItem(os.environ, 'LANG', 'en_US.UTF-8'):
+                        assert resolver.from_locale() is None
+            # The country of a network is cached.
+            with PatchedAttribute(location, 'get_network_fingerprint', lambda: 'network'):
+                assert resolver.lookup('network') is None
+                resolver.store('network', 'Germany')
+                assert resolver.resolve() == 'Germany'
+                assert location.LocationResolver(resolver.filename, ttl=0).lookup('network') is None
+            # An explicit country skips the resolver (and changes the ranking parameters).
+            updater = AptMirrorUpdater(distributor_id='ubuntu', distribution_codename='bionic', country='France')
+            assert updater.resolved_country == 'France'
+            assert updater.ranking_parameters['country'] == 'France'
+        finally:
+            shutil.rmtree(directory)
+
+    def test_resolver(self):
+        """Test that :class:`.Resolver` caches lookups and detects host names that don't exist."""
+        resolver = Resolver()
+        assert resolver.prefetch(['127.0.0.1', 'localhost']) == set()
+        assert set(resolver.cache) == set(['127.0.0.1', 'localhost'])
+        addresses, elapsed_time = resolver.resolve('127.0.0.1', 8080)
+        assert addresses[0][4] == ('127.0.0.1', 8080)
+        assert is_unresolvable(socket.gaierror(socket.EAI_NONAME, "Name or service not known"))
+        assert not is_unresolvable(socket.gaierror(socket.EAI_AGAIN, "Temporary failure in name resolution"))
+        # Temporary failures are retried and not cached, permanent failures are cached.
+        outcomes = [socket.gaierror(socket.EAI_AGAIN, "Temporary failure in name resolution")] * 3
+        outcomes.append(socket.gaierror(socket.EAI_NONAME, "Name or service not known"))
+
+        def getaddrinfo(*args):
+            raise outcomes.pop(0)
+
+        with PatchedAttribute(socket, 'getaddrinfo', getaddrinfo):
+            addresses, elapsed_time = resolver.lookup('flaky.example.com')
+            assert addresses.errno == socket.EAI_AGAIN and len(outcomes) == 2
+            assert 'flaky.example.com' not in resolver.cache
+            assert resolver.prefetch(['flaky.example.com']) == set(['flaky.example.com'])
+            assert is_unresolvable(resolver.lookup('flaky.example.com')[0]) and not outcomes
+        with LocalServer({'/Release': RELEASE_CONTENTS}) as server:
+            pool = ConnectionPool(resolver=resolver)
+            assert fetch_url(server.url('/Release'), pool=pool) == RELEASE_CONTENTS
+            pool.close()
+
     def test_discover_releases(self):
         """Test that release discovery works properly."""
         releases = discover_releases()
@@ -282,6 +1063,128 @@ class AptMirrorUpdaterTestCase(TestCase):
         assert updater.release_is_eol == (updater.validate_mirror(updater.old_releases_url) == MirrorStatus.AVAILABLE)
 
 
+RELEASE_CONTENTS = b"""Origin: Ubuntu
+Label: Ubuntu
+Suite: bionic-security
+Version: 18.04
+Codename: bionic
+Date: Mon, 02 Sep 2019 08:07:54 UTC
+Architectures: amd64 arm64 armhf i386 ppc64el s390x
+Components: main restricted universe multiverse
+Description: Ubuntu Bionic 18.04
+"""
+"""The contents of a ``Release`` file served by :class:`LocalServer` (a byte string)."""
+
+
+class LocalServer(ThreadingMixIn, HTTPServer):
+
+    """
+    Serve canned HTTP responses on localhost so the HTTP client can be tested offline.
+
+    Use it as a context manager: The server is started in a background thread
+    when the context is entered and shut down when the context is left.
+    """
+
+    daemon_threads = True
+
+    def __init__(self, responses, ranges=True, head=True, compress=False, stalls=None):
+        """
+        Initialize a :class:`LocalServer` object.
+
+        :param responses: A dictionary that maps URL paths (strings) to the
+                          response bodies to serve (byte strings). Other paths
+                          result in a 404 response.
+        :param ranges: :data:`True` to honor ``Range`` headers,
+                       :data:`False` to ignore them.
+        :param head: :data:`True` to support ``HEAD`` requests, :data:`False`
+                     to respond to them with 405 Method Not Allowed.
+        :param compress: :data:`True` to gzip compress response bodies when
+                         the client accepts it, :data:`False` otherwise.
+        :param stalls: A dictionary that maps URL paths (strings) to the number
+                       of seconds to wait before responding (optional).
+        """
+        HTTPServer.__init__(self, ('127.0.0.1', 0), LocalRequestHandler)
+        self.compress = compress
+        self.stalls = stalls or {}
+        self.head = head
+        self.ranges = ranges
+        self.responses = responses
+        self.connections = set()
+        self.requests = []
+
+    def url(self, path):
+        """Get the URL of the given path on this server."""
+        return 'http://127.0.0.1:%i%s' % (self.server_address[1], path)
+
+    def __enter__(self):
+        """Start serving requests in a background thread."""
+        self.thread = threading.Thread(target=self.serve_forever)
+        self.thread.daemon = True
+        self.thread.start()
+        return self
+
+    def __exit__(self, exc_type=None, exc_value=None, traceback=None):
+        """Stop serving requests."""
+        self.shutdown()
+        self.server_close()
+
+
+class LocalRequestHandler(BaseHTTPRequestHandler):
+
+    """Request handler for :class:`LocalServer`."""
+
+    protocol_version = 'HTTP/1.1'
+
+    def do_GET(self):
+        """Serve a canned response (response bodies starting with a slash are redirects)."""
+        self.server.connections.add(self.client_address)
+        self.server.requests.append((self.command, self.path, dict(self.headers.items())))
+        body = self.server.responses.get(self.path)
+        time.sleep(self.server.stalls.get(self.path, 0))
+        if self.command == 'HEAD' and not self.server.head:
+            self.send_response(405)
+            body = None
+        elif body is not None and body.startswith(b'/'):
+            self.send_response(302)
+            self.send_header('Location', body.decode('ascii'))
+            body = b''
+        elif body is not None:
+            etag = '"%s"' % hashlib.sha1(body).hexdigest()
+            byte_range = self.headers.get('Range')
+            if self.headers.get('If-None-Match') == etag:
+                self.send_response(304)
+                body = b''
+            elif byte_range and self.server.ranges:
+                first, last = map(int, byte_range.split('=')[1].split('-'))
+                self.send_response(206)
+                self.send_header('Content-Range', 'bytes %i-%i/%i' % (first, last, len(body)))
+                body = body[first:last + 1]
+            else:
+                self.send_response(200)
+                if self.server.compress and 'gzip' in self.headers.get('Accept-Encoding', ''):
+                    body = gzip_compress(body)
+                    self.send_header('Content-Encoding', 'gzip')
+            self.send_header('ETag', etag)
+        else:
+            self.send_response(404)
+        self.send_header('Content-Length', str(len(body or b'')))
+        self.end_headers()
+        if body and self.command != 'HEAD':
+            self.wfile.write(body)
+
+    do_HEAD = do_GET
+
+    def log_message(self, format, *args):
+        """Log requests using :mod:`logging` instead of writing them to standard error."""
+        logger.debug(format, *args)
+
+
+def gzip_compress(data):
+    """Compress a byte string using the gzip format."""
+    compressor = zlib.compressobj(9, zlib.DEFLATED, 16 + zlib.MAX_WBITS)
+    return compressor.compress(data) + compressor.flush()
+
+
 def have_package_lists():
     """
     Check if apt's package lists are available.